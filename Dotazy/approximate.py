@@ -0,0 +1,176 @@
+# approximate.py - Approximate answers from a $sample with confidence intervals
+#
+# Rewrites a pipeline of the form
+#   row-wise stages ($match, $addFields, ...) -> $group or $bucket -> row-wise stages
+# to run on {"$sample": {"size": n}} of the collection's N documents:
+#   $sum (and $count)  scaled by N/n; the interval is the normal approximation
+#                      of the total estimated from n draws (a count is a sum of 1s)
+#   $avg               unscaled; the interval is z * stdDevSamp / sqrt(values)
+#   other accumulators ($min, $max, $push, $addToSet, ...) only see the sample
+# The scaling happens right after the grouping stage, so later $match, $sort
+# and computed fields work on the estimates. Every result document gets an
+# "_approx" field: {accumulator: {"estimate", "low", "high"}} for the fields
+# above. Pipelines of any other shape raise UnsupportedPipeline.
+#
+# run() samples progressively: when the widest interval (relative to its
+# estimate) is above the error bound, the sample grows by the factor the
+# 1/sqrt(n) law predicts, as far as the latency budget allows. Once the
+# sample would cover the whole collection, the exact pipeline runs instead.
+# $sample reads randomly only while n is under 5% of the collection, larger
+# samples scan and sort it.
+import math
+import statistics
+import time
+
+ROW_STAGES = {"$match", "$addFields", "$set", "$project", "$unset"}
+AFTER_STAGES = ROW_STAGES | {"$sort", "$limit", "$skip"}
+GROUP_STAGES = ("$group", "$bucket")
+FIELD = "_approx"
+# Prefix of the helper accumulators, removed again after scaling
+HELPER = "__approx_"
+DEFAULT_SAMPLE = 1000
+
+
+class UnsupportedPipeline(Exception):
+    pass
+
+
+def _group_stage(pipeline):
+    positions = [i for i, stage in enumerate(pipeline) if next(iter(stage)) in GROUP_STAGES]
+    if len(positions) != 1:
+        raise UnsupportedPipeline("needs exactly one $group or $bucket")
+    position = positions[0]
+    for stage in pipeline[:position]:
+        if next(iter(stage)) not in ROW_STAGES:
+            raise UnsupportedPipeline(f"{next(iter(stage))} before the grouping stage")
+    for stage in pipeline[position + 1:]:
+        if next(iter(stage)) not in AFTER_STAGES:
+            raise UnsupportedPipeline(f"{next(iter(stage))} after the grouping stage")
+    return position
+
+
+def _accumulators(stage):
+    name, spec = next(iter(stage.items()))
+    if name == "$group":
+        return {field: value for field, value in spec.items() if field != "_id"}
+    # $bucket without output only counts
+    return spec.get("output", {"count": {"$sum": 1}})
+
+
+def _with_accumulators(stage, accumulators):
+    name, spec = next(iter(stage.items()))
+    if name == "$group":
+        return {name: {"_id": spec["_id"], **accumulators}}
+    return {name: {**spec, "output": accumulators}}
+
+
+def _bounds(estimate, half):
+    return {"estimate": estimate,
+            "low": {"$subtract": [estimate, half]},
+            "high": {"$add": [estimate, half]}}
+
+
+# Sampled group stage and the $set that scales its sums and adds the intervals
+def _rewrite_group(stage, size, total, z):
+    scale = total / size
+    # Finite population correction of the sampling variance
+    fpc = math.sqrt((total - size) / (total - 1)) if total > 1 else 0.0
+    accumulators = {}
+    scaled = {}
+    intervals = {}
+    for field, accumulator in _accumulators(stage).items():
+        operator, argument = next(iter(accumulator.items()))
+        accumulators[field] = accumulator
+        if operator == "$count":
+            operator, argument = "$sum", 1
+            accumulators[field] = {"$sum": 1}
+        if operator == "$sum":
+            squares = f"{HELPER}sq_{field}"
+            accumulators[squares] = {"$sum": {"$multiply": [argument, argument]}}
+            # Variance of the per-document value over all n draws (0 outside the group)
+            mean = {"$divide": [f"${field}", size]}
+            variance = {"$max": [0, {"$subtract": [{"$divide": [f"${squares}", size]}, {"$multiply": [mean, mean]}]}]}
+            half = {"$multiply": [z * total * fpc, {"$sqrt": {"$divide": [variance, size]}}]}
+            scaled[field] = {"$multiply": [f"${field}", scale]}
+            intervals[field] = _bounds({"$multiply": [f"${field}", scale]}, half)
+        elif operator == "$avg":
+            deviation, values = f"{HELPER}sd_{field}", f"{HELPER}n_{field}"
+            accumulators[deviation] = {"$stdDevSamp": argument}
+            accumulators[values] = {"$sum": {"$cond": [{"$isNumber": argument}, 1, 0]}}
+            half = {"$cond": [{"$gt": [f"${values}", 1]},
+                              {"$divide": [{"$multiply": [z, f"${deviation}"]}, {"$sqrt": f"${values}"}]},
+                              None]}
+            intervals[field] = _bounds(f"${field}", half)
+    helpers = [field for field in accumulators if field.startswith(HELPER)]
+    stages = [_with_accumulators(stage, accumulators),
+              # The intervals read the unscaled sums, so they are computed first
+              {"$set": {FIELD: intervals}},
+              {"$set": scaled} if scaled else None,
+              {"$unset": helpers} if helpers else None]
+    return [stage for stage in stages if stage]
+
+
+# The pipeline on a sample of `size` of `total` documents
+def rewrite(pipeline, size, total, confidence=0.95):
+    position = _group_stage(pipeline)
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    after = []
+    for stage in pipeline[position + 1:]:
+        name, spec = next(iter(stage.items()))
+        if name == "$project" and any(value not in (0, False) for field, value in spec.items() if field != "_id"):
+            # Keep the intervals through inclusion projections
+            stage = {name: {**spec, FIELD: 1}}
+        after.append(stage)
+    return ([{"$sample": {"size": size}}] + pipeline[:position]
+            + _rewrite_group(pipeline[position], size, total, z) + after)
+
+
+# Widest interval half-width relative to its estimate, over all results
+def relative_error(results):
+    widest = 0.0
+    for document in results:
+        for interval in document.get(FIELD, {}).values():
+            estimate, low, high = interval["estimate"], interval["low"], interval["high"]
+            if estimate and low is not None and high is not None:
+                widest = max(widest, (high - low) / 2 / abs(estimate))
+    return widest
+
+
+def sample_size(sample, total):
+    if sample is None:
+        return min(DEFAULT_SAMPLE, total)
+    if sample < 1:
+        return max(int(total * sample), 1)
+    return int(sample)
+
+
+# Run `pipeline` on growing samples until the error bound is met, the budget
+# runs out or the sample would be the whole collection. Returns the results
+# and {"approximate", "sample", "total", "error", "confidence", "ms"}.
+def run(collection, pipeline, sample=None, error=None, budget_ms=None, confidence=0.95, comment=None):
+    _group_stage(pipeline)
+    total = collection.estimated_document_count()
+    size = sample_size(sample, total)
+    start = time.perf_counter()
+    while True:
+        if size >= total:
+            results = list(collection.aggregate(pipeline, comment=comment))
+            achieved, approximate, size = 0.0, False, total
+            break
+        began = time.perf_counter()
+        results = list(collection.aggregate(rewrite(pipeline, size, total, confidence), comment=comment))
+        took = time.perf_counter() - began
+        achieved, approximate = relative_error(results), True
+        if error is None or achieved <= error:
+            break
+        # Half-widths shrink with 1/sqrt(n); aim 10% past the predicted size
+        wanted = int(size * (achieved / error) ** 2 * 1.1)
+        if budget_ms is not None:
+            remaining = budget_ms / 1000 - (time.perf_counter() - start)
+            # Run time grows about linearly with the sample
+            wanted = min(wanted, int(size * remaining / took) if took > 0 else wanted)
+        if wanted <= size:
+            break
+        size = min(wanted, total)
+    return results, {"approximate": approximate, "sample": size, "total": total, "error": achieved,
+                     "confidence": confidence, "ms": (time.perf_counter() - start) * 1000}
@@ -0,0 +1,178 @@
+# arrow_export.py - Stream aggregation results into Arrow RecordBatches, Parquet or Arrow IPC files
+import datetime
+
+import bson
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_BATCH_SIZE = 10000
+# Batches the first batch may grow to while a column has only nulls
+SCHEMA_BATCHES = 10
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Result types of projection expressions that are known up front
+FLOAT_OPERATORS = {"$round", "$avg", "$divide", "$multiply", "$pow", "$sqrt", "$stdDevPop", "$stdDevSamp", "$trunc"}
+INT_OPERATORS = {"$size", "$year", "$month", "$dayOfMonth", "$dayOfWeek", "$dateDiff", "$strLenCP"}
+STRING_OPERATORS = {"$toString", "$concat", "$dateToString", "$substr", "$toUpper", "$toLower"}
+BOOL_OPERATORS = {"$and", "$or", "$not", "$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in"}
+
+
+def _expression_type(expression):
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator = next(iter(expression))
+        if operator in FLOAT_OPERATORS:
+            return pa.float64()
+        if operator in INT_OPERATORS:
+            return pa.int64()
+        if operator in STRING_OPERATORS:
+            return pa.string()
+        if operator in BOOL_OPERATORS:
+            return pa.bool_()
+    return None
+
+
+# Field order and known column types taken from the last $project of the pipeline
+def projection_hints(pipeline):
+    for stage in reversed(pipeline):
+        if "$project" in stage:
+            hints = {}
+            for field, expression in stage["$project"].items():
+                if field == "_id" and expression in (0, False):
+                    continue
+                hints[field] = _expression_type(expression)
+            return hints
+        if "$group" in stage or "$facet" in stage or "$bucket" in stage:
+            break
+    return {}
+
+
+# BSON types pyarrow does not understand are converted to plain Python values
+def _to_arrow_value(value):
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    if isinstance(value, bson.Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, dict):
+        return {key: _to_arrow_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_arrow_value(item) for item in value]
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    return value
+
+
+# Array of `values` as `data_type`. Values that would change in the cast
+# (2.5 into int64, "c" into double) raise ValueError instead of being truncated;
+# string columns keep other values as their text.
+def _build_array(name, values, data_type):
+    if data_type is None:
+        return pa.array(values)
+    if pa.types.is_string(data_type):
+        values = [value if value is None or isinstance(value, str) else str(value) for value in values]
+    try:
+        # pa.array(values, type=int64) would truncate 2.5, so infer first and cast safely
+        array = pa.array(values)
+        return array if array.type == data_type else array.cast(data_type, safe=True)
+    except pa.ArrowNotImplementedError as e:
+        if not pa.types.is_nested(data_type):
+            raise ValueError(f"Column {name} does not fit its {data_type} type: {e}") from e
+        # Structs and lists with other fields than in the first batch
+        return pa.array(values, type=data_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        raise ValueError(f"Column {name} does not fit its {data_type} type: {e}") from e
+
+
+# Type of a column in the schema, from its hint or the values of the first batch
+def _column_type(name, values, hint):
+    if hint is not None:
+        return _build_array(name, values, hint).type
+    try:
+        data_type = pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed types like [1, "a"], the column keeps every value as text
+        return pa.string()
+    if pa.types.is_integer(data_type):
+        # Readings are stored as int32 when integer-valued and as double
+        # otherwise, so unhinted numbers are float64 from the start
+        return pa.float64()
+    if pa.types.is_null(data_type):
+        # No value to infer from in the first SCHEMA_BATCHES batches
+        return pa.string()
+    return data_type
+
+
+# Turn a cursor into RecordBatches of `batch_size` rows. Values are gathered
+# column by column per batch, so the full result never exists as dicts.
+# The schema is fixed by the projection hints plus the first batch. While a
+# column has only nulls the first batch keeps growing, up to SCHEMA_BATCHES
+# batches, so that the column gets the type of its first value.
+def iter_record_batches(cursor, hints=None, batch_size=DEFAULT_BATCH_SIZE):
+    hints = dict(hints or {})
+    schema = None
+    columns = {field: [] for field in hints}
+    rows = 0
+
+    def flush():
+        nonlocal schema
+        if schema is None:
+            schema = pa.schema([pa.field(name, _column_type(name, values, hints.get(name)))
+                                for name, values in columns.items()])
+        arrays = [_build_array(field.name, columns.get(field.name, [None] * rows), field.type) for field in schema]
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def untyped():
+        return any(hints.get(name) is None and all(value is None for value in values)
+                   for name, values in columns.items())
+
+    for document in cursor:
+        for name, value in document.items():
+            column = columns.get(name)
+            if column is None:
+                if schema is not None and schema.get_field_index(name) == -1:
+                    # Field that did not appear in the first batch, the schema is fixed by now
+                    continue
+                column = columns[name] = [None] * rows
+            column.append(_to_arrow_value(value))
+        rows += 1
+        for column in columns.values():
+            if len(column) < rows:
+                column.append(None)
+        if rows % batch_size == 0 and (schema is not None or rows >= SCHEMA_BATCHES * batch_size
+                                       or not untyped()):
+            yield flush()
+            columns = {field: [] for field in (schema.names if schema else hints)}
+            rows = 0
+
+    if rows or schema is None:
+        yield flush()
+
+
+# Run a pipeline and stream its results into a Parquet or Arrow IPC file
+# Returns the number of rows written
+def export_query(db, collection_name, pipeline, path, file_format="parquet",
+                 batch_size=DEFAULT_BATCH_SIZE, comment=None):
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {file_format}")
+    options = {"batchSize": batch_size}
+    if comment:
+        options["comment"] = comment
+    cursor = db[collection_name].aggregate(pipeline, **options)
+    batches = iter_record_batches(cursor, projection_hints(pipeline), batch_size)
+
+    writer = None
+    total = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                if file_format == "parquet":
+                    writer = pq.ParquetWriter(path, batch.schema)
+                else:
+                    writer = pa.ipc.new_file(path, batch.schema)
+            if batch.num_rows:
+                writer.write_batch(batch)
+            total += batch.num_rows
+    finally:
+        cursor.close()
+        if writer is not None:
+            writer.close()
+    return total
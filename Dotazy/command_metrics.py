@@ -0,0 +1,199 @@
+# command_metrics.py - Command latency and reply size metrics exported as OpenMetrics text
+import http.server
+import os
+import threading
+
+import bson
+from pymongo import monitoring
+
+# Upper bounds (in seconds) of the command duration histogram buckets
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Commands that only keep connections and sessions alive, not worth a series
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions"}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+# Histogram of command durations for one (query, collection, command) series
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+# Command listener recording duration, reply size, getMore round-trips and errors
+# labelled by query id, collection and command name. The query id is taken from
+# the command comment (execute_query sets it to "q1".."q28") and follows the
+# cursor through its getMore commands. Reply sizes re-encode every reply to
+# BSON, which costs about as much CPU as decoding it, so they are only
+# measured with measure_reply_size=True.
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self, default_query="none", measure_reply_size=False):
+        self.default_query = default_query
+        self.measure_reply_size = measure_reply_size
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._cursors = {}
+        self._durations = {}
+        self._reply_bytes = {}
+        self._getmores = {}
+        self._errors = {}
+        self._server = None
+
+    def _command_labels(self, event):
+        command = event.command
+        name = event.command_name
+        if name == "getMore":
+            cursor = self._cursors.get(command.get("getMore"))
+            query = cursor[0] if cursor else self.default_query
+            collection = command.get("collection", "")
+        else:
+            comment = command.get("comment")
+            query = comment if isinstance(comment, str) else self.default_query
+            collection = command.get(name, "")
+            if not isinstance(collection, str):
+                collection = ""
+        return (("query", query), ("collection", collection), ("command", name))
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        with self._lock:
+            cursor_id = event.command.get("getMore") if event.command_name == "getMore" else None
+            self._pending[(event.connection_id, event.request_id)] = (self._command_labels(event), cursor_id)
+            if event.command_name == "killCursors":
+                # Closed before it was exhausted, no getMore will follow
+                for killed in event.command.get("cursors", []):
+                    self._cursors.pop(killed, None)
+
+    def succeeded(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        labels, getmore_cursor = pending
+        size = len(bson.encode(event.reply)) if self.measure_reply_size else None
+        cursor = event.reply.get("cursor") if isinstance(event.reply, dict) else None
+        with self._lock:
+            self._durations.setdefault(labels, _Histogram()).observe(event.duration_micros / 1e6)
+            if size is not None:
+                self._reply_bytes[labels] = self._reply_bytes.get(labels, 0) + size
+            if event.command_name == "getMore":
+                key = labels[:2]
+                self._getmores[key] = self._getmores.get(key, 0) + 1
+            if cursor:
+                cursor_id = cursor.get("id", 0)
+                if cursor_id:
+                    self._cursors[cursor_id] = (labels[0][1], labels[1][1])
+                elif getmore_cursor is not None:
+                    # Cursor exhausted, forget it
+                    self._cursors.pop(getmore_cursor, None)
+
+    def failed(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+            if pending is None:
+                return
+            labels, getmore_cursor = pending
+            if getmore_cursor is not None:
+                # A failed getMore leaves the cursor dead on the server
+                self._cursors.pop(getmore_cursor, None)
+            code = event.failure.get("codeName", "Unknown") if isinstance(event.failure, dict) else "Unknown"
+            key = labels + (("code", code),)
+            self._errors[key] = self._errors.get(key, 0) + 1
+            self._durations.setdefault(labels, _Histogram()).observe(event.duration_micros / 1e6)
+
+    # Render all series in the OpenMetrics text exposition format
+    def render(self):
+        with self._lock:
+            durations = {labels: (list(h.buckets), h.count, h.sum) for labels, h in self._durations.items()}
+            reply_bytes = dict(self._reply_bytes)
+            getmores = dict(self._getmores)
+            errors = dict(self._errors)
+
+        lines = [
+            "# TYPE dotazy_command_duration_seconds histogram",
+            "# HELP dotazy_command_duration_seconds Round-trip time of commands sent to mongos.",
+            "# UNIT dotazy_command_duration_seconds seconds",
+        ]
+        for labels, (buckets, count, total) in sorted(durations.items()):
+            for bound, value in zip(DURATION_BUCKETS, buckets):
+                lines.append(f"dotazy_command_duration_seconds_bucket{_labels(labels, le=bound)} {value}")
+            lines.append(f"dotazy_command_duration_seconds_bucket{_labels(labels, le='+Inf')} {count}")
+            lines.append(f"dotazy_command_duration_seconds_count{_labels(labels)} {count}")
+            lines.append(f"dotazy_command_duration_seconds_sum{_labels(labels)} {total:.6f}")
+
+        lines += [
+            "# TYPE dotazy_command_reply_bytes counter",
+            "# HELP dotazy_command_reply_bytes BSON size of command replies.",
+            "# UNIT dotazy_command_reply_bytes bytes",
+        ]
+        for labels, value in sorted(reply_bytes.items()):
+            lines.append(f"dotazy_command_reply_bytes_total{_labels(labels)} {value}")
+
+        lines += [
+            "# TYPE dotazy_command_getmore counter",
+            "# HELP dotazy_command_getmore getMore round-trips needed to drain query cursors.",
+        ]
+        for labels, value in sorted(getmores.items()):
+            lines.append(f"dotazy_command_getmore_total{_labels(labels)} {value}")
+
+        lines += [
+            "# TYPE dotazy_command_errors counter",
+            "# HELP dotazy_command_errors Failed commands by server error code.",
+        ]
+        for labels, value in sorted(errors.items()):
+            lines.append(f"dotazy_command_errors_total{_labels(labels)} {value}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics to `path` atomically so a scraper never reads a partial file
+    def write(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    # Serve the metrics on http://host:port/metrics from a background thread
+    def serve(self, port, host="0.0.0.0"):
+        if self._server is not None:
+            return self._server
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="command-metrics-http", daemon=True).start()
+        return self._server
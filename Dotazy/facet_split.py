@@ -0,0 +1,36 @@
+# facet_split.py - Run the branches of a $facet as separate, concurrent aggregations
+#
+# A $facet funnels every input document through a single merging node and
+# returns one document capped at 16MB. split_facet() cuts a pipeline into the
+# shared prefix, the facet branches and the stages after the facet. run_split()
+# runs prefix + branch for every branch at the same time, each as a normal
+# aggregation the shards can work on, and reassembles the facet document.
+# Stages after the facet run on the reassembled document through $documents.
+from concurrent.futures import ThreadPoolExecutor
+
+
+# (prefix, branches, suffix) around the first $facet, None without a $facet
+def split_facet(pipeline):
+    for i, stage in enumerate(pipeline):
+        if "$facet" in stage:
+            return pipeline[:i], stage["$facet"], pipeline[i + 1:]
+    return None
+
+
+# Results of `pipeline` with its $facet split up, None when there is no $facet
+def run_split(db, collection_name, pipeline, comment=None, workers=None):
+    parts = split_facet(pipeline)
+    if parts is None:
+        return None
+    prefix, branches, suffix = parts
+    options = {"comment": comment} if comment else {}
+
+    def run(branch):
+        return list(db[collection_name].aggregate(prefix + branch, **options))
+
+    with ThreadPoolExecutor(max_workers=workers or len(branches)) as pool:
+        outputs = list(pool.map(run, branches.values()))
+    document = dict(zip(branches, outputs))
+    if not suffix:
+        return [document]
+    return list(db.aggregate([{"$documents": [document]}] + suffix, **options))
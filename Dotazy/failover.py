@@ -0,0 +1,256 @@
+# failover.py - Query latency and errors while shard and config primaries step down
+#
+#   python failover.py
+#   python failover.py --targets rs-shard-01 rs-config-server --workers 8 --settle 45
+#   python failover.py --no-retry-reads --server-selection-timeout-ms 5000 --socket-timeout-ms 10000
+#
+# Worker threads run the queries in a closed loop through the routers while
+# the primary of every target replica set (the shards, then the config
+# servers) is sent replSetStepDown in turn, --settle seconds apart. The
+# stepdowns go to the members directly (see runner.member_client). The
+# workload client is built from MONGO_URI with the retry and timeout options
+# given on the command line, so their effect can be compared run by run.
+#
+# For every stepdown and query the report gives the latency before it (p50,
+# p99 of the --baseline period), the worst latency after it, the operations
+# that failed (by error type), the commands the driver saw fail, and the
+# operations that succeeded although one of their commands failed, i.e. were
+# retried successfully. Every operation carries its own comment "q<N>#<op>",
+# so failed commands are attributed to their operation.
+# The time to recover is when the last operation that failed or took more
+# than twice the baseline p99 finished, counted from the stepdown.
+import argparse
+import statistics
+import threading
+import time
+from collections import defaultdict
+from itertools import count, cycle
+
+from pymongo import MongoClient, monitoring
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+
+import registry
+from loadgen import percentile
+from run import select_queries
+from runner import MONGO_URI, db, member_client, shard_members
+from warmup import read_only
+
+CONFIG_SET = "rs-config-server"
+# Operations slower than this multiple of the baseline p99 are part of the spike
+SPIKE_FACTOR = 2.0
+POLL_INTERVAL = 0.2
+
+
+# Failed commands per operation, from the "q<N>#<op>" comment of the workload
+class FailedCommands(monitoring.CommandListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.comments = {}
+        self.failures = defaultdict(list)
+
+    def started(self, event):
+        comment = event.command.get("comment")
+        if comment is not None:
+            with self.lock:
+                self.comments[event.request_id] = comment
+
+    def succeeded(self, event):
+        with self.lock:
+            self.comments.pop(event.request_id, None)
+
+    def failed(self, event):
+        with self.lock:
+            comment = self.comments.pop(event.request_id, None)
+            if isinstance(comment, str) and "#" in comment:
+                # Network errors have an errtype instead of a server codeName
+                reason = event.failure.get("codeName") or event.failure.get("errtype", "error")
+                self.failures[int(comment.rsplit("#", 1)[1])].append(reason)
+
+
+# {replica set: [hosts]} of the shards and the config servers
+def replica_sets():
+    sets = shard_members()
+    config = db.client.admin.command("getShardMap")["map"]["config"]
+    sets[CONFIG_SET] = config.split("/", 1)[-1].split(",")
+    return sets
+
+
+def find_primary(hosts):
+    for host in hosts:
+        client = member_client(host)
+        try:
+            if client.admin.command("hello").get("isWritablePrimary"):
+                return host, client
+        except PyMongoError:
+            pass
+        client.close()
+    return None, None
+
+
+# Step the primary down, returns (old primary, new primary, seconds to elect it)
+def step_down(hosts, step_down_secs, catch_up_secs):
+    old, client = find_primary(hosts)
+    if old is None:
+        return None, None, None
+    start = time.time()
+    try:
+        client.admin.command("replSetStepDown", step_down_secs, secondaryCatchUpPeriodSecs=catch_up_secs)
+    except ConnectionFailure:
+        # The old primary closes its connections when it steps down
+        pass
+    except OperationFailure as e:
+        print(f"replSetStepDown on {old} failed: {e}")
+    finally:
+        client.close()
+    while time.time() - start < step_down_secs:
+        new, client = find_primary(hosts)
+        if client:
+            client.close()
+        if new and new != old:
+            return old, new, time.time() - start
+        time.sleep(POLL_INTERVAL)
+    return old, None, None
+
+
+# Closed-loop workload, every operation is recorded as (start, end, query, error, op)
+class Workload:
+    def __init__(self, database, queries, workers):
+        self.database = database
+        self.queries = queries
+        self.workers = workers
+        self.records = []
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.threads = []
+        self.operations = count()
+
+    def _loop(self, offset):
+        queries = cycle(self.queries[offset % len(self.queries):] + self.queries[:offset % len(self.queries)])
+        while not self.stop.is_set():
+            query = next(queries)
+            with self.lock:
+                op = next(self.operations)
+            error = None
+            start = time.time()
+            try:
+                for _ in self.database[query.collection].aggregate(read_only(query.pipeline()),
+                                                                    comment=f"q{query.id}#{op}"):
+                    pass
+            except PyMongoError as e:
+                error = type(e).__name__
+            with self.lock:
+                self.records.append((start, time.time(), f"q{query.id}", error, op))
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._loop, args=(i,), daemon=True) for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def finish(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+
+# Per query impact of the stepdown at `at` on the operations started before `until`
+def impact(records, failures, baseline, at, until):
+    queries = defaultdict(lambda: {"base": [], "after": [], "errors": defaultdict(int), "slow_until": None,
+                                   "command_failures": 0, "retried": 0})
+    for start, end, comment, error, op in records:
+        entry = queries[comment]
+        if baseline[0] <= start < baseline[1] and error is None:
+            entry["base"].append(end - start)
+        elif at <= end and start < until:
+            entry["after"].append(end - start)
+            entry["command_failures"] += len(failures.get(op, []))
+            if error:
+                entry["errors"][error] += 1
+            elif op in failures:
+                entry["retried"] += 1
+    for start, end, comment, error, _ in records:
+        entry = queries[comment]
+        threshold = SPIKE_FACTOR * percentile(entry["base"], 0.99) if entry["base"] else None
+        if at <= end and start < until and (error or (threshold is not None and end - start > threshold)):
+            entry["slow_until"] = max(entry["slow_until"] or 0, end - at)
+    return queries
+
+
+def print_impact(target, old, new, elected, queries):
+    elected = f"{elected:.1f}s" if elected is not None else "no new primary seen"
+    print(f"\n{target}: {old} -> {new or '?'}, elected in {elected}")
+    print(f"{'query':>6} {'base p50':>9} {'base p99':>9} {'worst ms':>9} {'ops':>5} {'failed':>7} "
+          f"{'retried':>8} {'cmd fail':>9} {'recover s':>10}  errors")
+    for comment in sorted(queries, key=lambda name: int(name[1:])):
+        entry = queries[comment]
+        failed = sum(entry["errors"].values())
+        recover = f"{entry['slow_until']:.1f}" if entry["slow_until"] is not None else "-"
+        errors = ", ".join(f"{count} x {name}" for name, count in sorted(entry["errors"].items()))
+        print(f"{comment:>6} {percentile(entry['base'], 0.5) * 1000:9.0f} {percentile(entry['base'], 0.99) * 1000:9.0f} "
+              f"{max(entry['after'], default=0) * 1000:9.0f} {len(entry['after']):5d} {failed:7d} "
+              f"{entry['retried']:8d} {entry['command_failures']:9d} {recover:>10}  {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure query latency and errors during replica set stepdowns")
+    parser.add_argument("queries", nargs="*", help="query ids (q9 or 9) or 'all'")
+    parser.add_argument("--cost", choices=registry.COST_CLASSES,
+                        help="only queries of this cost class (default: medium when no queries are named)")
+    parser.add_argument("--targets", nargs="*", help="replica sets to step down (default: every shard, then config)")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent query loops")
+    parser.add_argument("--baseline", type=float, default=20, help="seconds of workload before the first stepdown")
+    parser.add_argument("--settle", type=float, default=30, help="seconds between stepdowns")
+    parser.add_argument("--step-down-secs", type=int, default=60, help="replSetStepDown stepDownSecs")
+    parser.add_argument("--catch-up-secs", type=int, default=10, help="replSetStepDown secondaryCatchUpPeriodSecs")
+    parser.add_argument("--no-retry-reads", action="store_true", help="turn retryable reads off")
+    parser.add_argument("--server-selection-timeout-ms", type=int, help="serverSelectionTimeoutMS of the workload")
+    parser.add_argument("--socket-timeout-ms", type=int, help="socketTimeoutMS of the workload")
+    args = parser.parse_args()
+
+    options = {"retryReads": not args.no_retry_reads}
+    if args.server_selection_timeout_ms is not None:
+        options["serverSelectionTimeoutMS"] = args.server_selection_timeout_ms
+    if args.socket_timeout_ms is not None:
+        options["socketTimeoutMS"] = args.socket_timeout_ms
+    failures = FailedCommands()
+    client = MongoClient(MONGO_URI, event_listeners=[failures], **options)
+    # Medium queries finish quickly enough to sample the failover densely
+    queries = select_queries(args.queries, args.cost or (None if args.queries else "medium"))
+    sets = replica_sets()
+    targets = args.targets or sorted(name for name in sets if name != CONFIG_SET) + [CONFIG_SET]
+    unknown = [name for name in targets if name not in sets]
+    if unknown:
+        raise SystemExit(f"Unknown replica sets {', '.join(unknown)}, known: {', '.join(sorted(sets))}")
+    print(f"{len(queries)} queries on {args.workers} workers, "
+          f"client options {', '.join(f'{name}={value}' for name, value in options.items())}")
+
+    workload = Workload(client[db.name], queries, args.workers)
+    events = []
+    workload.start()
+    try:
+        baseline = (time.time(), time.time() + args.baseline)
+        time.sleep(args.baseline)
+        for target in targets:
+            at = time.time()
+            print(f"Stepping down the primary of {target}", flush=True)
+            old, new, elected = step_down(sets[target], args.step_down_secs, args.catch_up_secs)
+            if old is None:
+                print(f"{target}: no primary found, skipped")
+                continue
+            events.append((target, old, new, elected, at))
+            time.sleep(max(args.settle - (time.time() - at), 0))
+    finally:
+        workload.finish()
+        client.close()
+
+    end = time.time()
+    for i, (target, old, new, elected, at) in enumerate(events):
+        until = events[i + 1][4] if i + 1 < len(events) else end
+        print_impact(target, old, new, elected, impact(workload.records, failures.failures, baseline, at, until))
+    if workload.records:
+        failed = sum(1 for record in workload.records if record[3])
+        median = statistics.median(end - start for start, end, _, _, _ in workload.records)
+        print(f"\n{len(workload.records)} operations, {failed} failed, median {median * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
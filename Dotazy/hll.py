@@ -0,0 +1,368 @@
+# hll.py - Mergeable HyperLogLog distinct-count sketches
+#
+# Values are hashed on the server with plain MQL, because $toHashedIndexKey
+# only exists from MongoDB 7.0 and the cluster runs 6.0.2: two polynomial
+# hashes modulo 2^31 - 1 over the characters of the value (positions in
+# printable ASCII, other characters count alike), each finished with a
+# square modulo the prime so that similar ids land far apart, and joined into
+# one 62-bit integer. The low P bits pick one of M = 2^P registers, and a
+# register keeps the highest rank (leading zeros + 1) of the remaining bits.
+# The distinct count is estimated from the registers (linear counting for
+# small counts), standard error 1.04 / sqrt(M), about 1.6% at P = 12.
+# Sketches of the same field merge by taking the register maximum, across
+# shards, months and collections alike.
+#
+# Exact fallback: every register also keeps the lowest and highest hash it
+# saw. While no register has seen two different hashes, the number of used
+# registers is the exact distinct count, and the hashes themselves are kept
+# (up to EXACT_LIMIT) so that merged small sketches stay exact.
+#
+# Two ways to use them:
+#   OPTIMIZE=hll  rewrites a $group/$bucket whose $addToSet field is only read
+#                 through {"$size": ...} (station_count in Q5 and Q22) into a
+#                 group by (key, register) and a merge per key, so a group holds
+#                 at most M small register documents instead of every value
+#   rollups       build_rollups() stores one sketch per key and month in
+#                 SKETCH_COLLECTION; distinct_count() merges the ones a
+#                 question needs, e.g. stations per location over 2020-2022
+#                 in globalClimate and usWeatherEvents together
+import argparse
+import math
+
+from bson.binary import Binary
+
+P = 12
+EXACT_LIMIT = 256
+SKETCH_COLLECTION = "distinctSketches"
+# Accumulators the rewrite can split into a partial per register and a merge
+SPLITTABLE = {"$sum", "$count", "$avg", "$min", "$max", "$addToSet"}
+HELPER = "__hll_"
+# Hash bits, character codes and the two polynomial hashes
+HASH_BITS = 62
+HASH_ALPHABET = "".join(chr(code) for code in range(32, 127))
+HASH_PRIME = 2 ** 31 - 1
+HASH_BASES = (131, 257)
+
+
+def _alpha(m):
+    return 0.7213 / (1 + 1.079 / m)
+
+
+# Non-negative 62-bit hash of a scalar `value` in MQL. Numbers hash by their
+# text, so 1 and 1.0 are one value as in $addToSet. Every intermediate stays
+# below 2^63, so the arithmetic never leaves 64-bit integers.
+def hash_expression(value):
+    text = {"$ifNull": [{"$cond": [{"$eq": [{"$type": value}, "string"]}, value, {"$toString": value}]}, ""]}
+    code = {"$add": [{"$indexOfCP": [HASH_ALPHABET, {"$substrCP": ["$$text", "$$this", 1]}]}, 2]}
+    state = [{"$mod": [{"$add": [{"$multiply": [{"$arrayElemAt": ["$$value", i]}, base]}, code]}, HASH_PRIME]}
+             for i, base in enumerate(HASH_BASES)]
+    # x^2 + c modulo the prime spreads hashes that differ in the last character
+    finished = [{"$mod": [{"$add": [{"$multiply": [f"$$h{i}", f"$$h{i}"]}, base]}, HASH_PRIME]}
+                for i, base in enumerate(HASH_BASES)]
+    return {"$let": {
+        "vars": {"text": text},
+        "in": {"$let": {
+            "vars": {"h": {"$reduce": {"input": {"$range": [0, {"$strLenCP": "$$text"}]},
+                                       "initialValue": [{"$toLong": 1}, {"$toLong": 1}], "in": state}}},
+            "in": {"$let": {
+                "vars": {"h0": {"$arrayElemAt": ["$$h", 0]}, "h1": {"$arrayElemAt": ["$$h", 1]}},
+                "in": {"$add": [{"$multiply": [finished[0], 2 ** 31]}, finished[1]]},
+            }},
+        }},
+    }}
+
+
+# Stages setting HELPER + "h" (hash), "r" (register) and "k" (rank) of `value`
+def hash_stages(value, p=P):
+    h, m = f"${HELPER}h", 2 ** p
+    # Remaining HASH_BITS - p bits of the hash above the register bits
+    rest = {"$floor": {"$divide": [h, m]}}
+    return [
+        {"$set": {f"{HELPER}h": {"$cond": [{"$eq": [{"$type": value}, "missing"]}, None,
+                                           hash_expression(value)]}}},
+        {"$set": {
+            f"{HELPER}r": {"$cond": [{"$eq": [h, None]}, None, {"$mod": [h, m]}]},
+            f"{HELPER}k": {"$cond": [{"$eq": [h, None]}, None, {"$cond": [
+                {"$lt": [rest, 1]}, HASH_BITS - p + 1,
+                {"$subtract": [HASH_BITS - p, {"$floor": {"$log": [rest, 2]}}]}]}]},
+        }},
+    ]
+
+
+# Estimated distinct count from the register summary (in MQL): used registers,
+# sum of 2^-rank over them and registers that saw two different hashes
+def estimate_expression(used, inverse, ambiguous, p=P):
+    m = 2 ** p
+    zeros = {"$subtract": [m, used]}
+    raw = {"$divide": [_alpha(m) * m * m, {"$add": [inverse, zeros]}]}
+    return {"$cond": [
+        {"$eq": [ambiguous, 0]}, used,
+        {"$round": [{"$cond": [
+            {"$and": [{"$lte": [raw, 2.5 * m]}, {"$gt": [zeros, 0]}]},
+            {"$multiply": [m, {"$ln": {"$divide": [m, zeros]}}]},
+            raw]}, 0]}]}
+
+
+def estimate(registers):
+    m = len(registers)
+    zeros = registers.count(0)
+    raw = _alpha(m) * m * m / sum(2.0 ** -rank for rank in registers)
+    if raw <= 2.5 * m and zeros:
+        return m * math.log(m / zeros)
+    return raw
+
+
+class Sketch:
+    def __init__(self, p=P, registers=None, hashes=()):
+        self.p = p
+        self.registers = bytearray(2 ** p) if registers is None else registers
+        # Exact hashes while the sketch is small, None once it is not
+        self.hashes = set(hashes) if hashes is not None else None
+
+    @classmethod
+    def from_registers(cls, entries, p=P):
+        sketch = cls(p)
+        exact = True
+        for entry in entries:
+            sketch.registers[entry["r"]] = max(sketch.registers[entry["r"]], entry["k"])
+            exact = exact and entry["lo"] == entry["hi"]
+            sketch.hashes.add(entry["lo"])
+        if not exact or len(sketch.hashes) > EXACT_LIMIT:
+            sketch.hashes = None
+        return sketch
+
+    @classmethod
+    def from_document(cls, document):
+        registers = bytearray(document["registers"])
+        return cls(document["p"], registers, document.get("hashes"))
+
+    def to_document(self):
+        return {"p": self.p, "registers": Binary(bytes(self.registers)),
+                "hashes": sorted(self.hashes) if self.hashes is not None else None}
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError(f"Cannot merge sketches with P {self.p} and {other.p}")
+        hashes = None
+        if self.hashes is not None and other.hashes is not None:
+            hashes = self.hashes | other.hashes
+            if len(hashes) > EXACT_LIMIT:
+                hashes = None
+        registers = bytearray(map(max, self.registers, other.registers))
+        return Sketch(self.p, registers, hashes)
+
+    def count(self):
+        if self.hashes is not None:
+            return len(self.hashes)
+        return int(round(estimate(self.registers)))
+
+    def __repr__(self):
+        return f"Sketch(p={self.p}, count={self.count()}, exact={self.hashes is not None})"
+
+
+# --- OPTIMIZE=hll ----------------------------------------------------------
+
+def _field_uses(node, field, uses):
+    if isinstance(node, dict):
+        if node == {"$size": f"${field}"}:
+            uses["size"] += 1
+            return
+        for key, value in node.items():
+            if key == field or key.startswith(f"{field}."):
+                uses["other"] += 1
+            _field_uses(value, field, uses)
+    elif isinstance(node, list):
+        for item in node:
+            _field_uses(item, field, uses)
+    elif isinstance(node, str) and (node == f"${field}" or node.startswith(f"${field}.")):
+        uses["other"] += 1
+
+
+# $addToSet fields of a grouping stage that later stages only read through $size
+def _size_only_sets(accumulators, later):
+    fields = []
+    for field, accumulator in accumulators.items():
+        if next(iter(accumulator)) != "$addToSet":
+            continue
+        uses = {"size": 0, "other": 0}
+        _field_uses(later, field, uses)
+        if uses["size"] and not uses["other"]:
+            fields.append(field)
+    return fields
+
+
+def _replace_sizes(node, field):
+    if isinstance(node, dict):
+        if node == {"$size": f"${field}"}:
+            return f"${field}"
+        return {key: _replace_sizes(value, field) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_replace_sizes(item, field) for item in node]
+    return node
+
+
+# _id expression of a $bucket as a $switch over its boundaries
+def _bucket_key(spec):
+    bounds = spec["boundaries"]
+    branches = [{"case": {"$and": [{"$gte": [spec["groupBy"], low]}, {"$lt": [spec["groupBy"], high]}]},
+                 "then": low} for low, high in zip(bounds[:-1], bounds[1:])]
+    return {"$switch": {"branches": branches, "default": spec.get("default")}}
+
+
+def _split(field, accumulator):
+    operator, argument = next(iter(accumulator.items()))
+    if operator == "$count":
+        operator, argument = "$sum", 1
+    if operator in ("$sum", "$min", "$max"):
+        return {field: {operator: argument}}, {field: {operator: f"${field}"}}, {}
+    if operator == "$avg":
+        total, values = f"{HELPER}s_{field}", f"{HELPER}n_{field}"
+        partial = {total: {"$sum": argument}, values: {"$sum": {"$cond": [{"$isNumber": argument}, 1, 0]}}}
+        merge = {total: {"$sum": f"${total}"}, values: {"$sum": f"${values}"}}
+        final = {field: {"$cond": [{"$gt": [f"${values}", 0]}, {"$divide": [f"${total}", f"${values}"]}, None]}}
+        return partial, merge, final
+    # $addToSet of a field that is used as a set
+    final = {field: {"$reduce": {"input": f"${field}", "initialValue": [],
+                                 "in": {"$setUnion": ["$$value", "$$this"]}}}}
+    return {field: accumulator}, {field: {"$push": f"${field}"}}, final
+
+
+def _sketch_stage(stage, later, p):
+    name, spec = next(iter(stage.items()))
+    if name == "$group":
+        key = spec["_id"]
+        accumulators = {field: value for field, value in spec.items() if field != "_id"}
+    else:
+        key = _bucket_key(spec)
+        accumulators = spec.get("output", {"count": {"$sum": 1}})
+    fields = _size_only_sets(accumulators, later)
+    # One register per document, so one sketched field per stage
+    if len(fields) != 1 or any(next(iter(value)) not in SPLITTABLE for value in accumulators.values()):
+        return None
+    field = fields[0]
+    partial, merge, final = {}, {}, {}
+    for other, accumulator in accumulators.items():
+        if other == field:
+            continue
+        stage_partial, stage_merge, stage_final = _split(other, accumulator)
+        partial.update(stage_partial)
+        merge.update(stage_merge)
+        final.update(stage_final)
+    register = f"${HELPER}r"
+    used = {"$cond": [{"$eq": ["$_id.r", None]}, 0, 1]}
+    stages = hash_stages(accumulators[field]["$addToSet"], p) + [
+        {"$group": {"_id": {"g": key, "r": register}, **partial,
+                    f"{HELPER}k": {"$max": f"${HELPER}k"},
+                    f"{HELPER}lo": {"$min": f"${HELPER}h"},
+                    f"{HELPER}hi": {"$max": f"${HELPER}h"}}},
+        {"$group": {"_id": "$_id.g", **merge,
+                    f"{HELPER}used": {"$sum": used},
+                    f"{HELPER}inverse": {"$sum": {"$cond": [{"$eq": ["$_id.r", None]}, 0,
+                                                            {"$pow": [2, {"$multiply": [-1, f"${HELPER}k"]}]}]}},
+                    f"{HELPER}ambiguous": {"$sum": {"$cond": [{"$ne": [f"${HELPER}lo", f"${HELPER}hi"]}, 1, 0]}}}},
+        {"$set": {**final, field: estimate_expression(f"${HELPER}used", f"${HELPER}inverse",
+                                                      f"${HELPER}ambiguous", p)}},
+    ]
+    helpers = sorted({key_ for key_ in list(merge) + [f"{HELPER}used", f"{HELPER}inverse", f"{HELPER}ambiguous"]
+                      if key_.startswith(HELPER)})
+    stages.append({"$unset": helpers})
+    if name == "$bucket":
+        # $bucket returns its buckets in boundary order
+        stages.append({"$sort": {"_id": 1}})
+    return stages, field
+
+
+# Replace size-only $addToSet accumulators with sketches (OPTIMIZE=hll)
+def sketch_distinct_counts(pipeline, p=P):
+    rewritten = []
+    for i, stage in enumerate(pipeline):
+        later = pipeline[i + 1:]
+        result = _sketch_stage(stage, later, p) if next(iter(stage)) in ("$group", "$bucket") else None
+        if result is None:
+            rewritten.append(stage)
+            continue
+        stages, field = result
+        rewritten += stages
+        # The field now holds the count, later {"$size": "$field"} read it directly
+        return rewritten + _replace_sizes(later, field)
+    return rewritten
+
+
+# --- Rollups -----------------------------------------------------------------
+
+# Rollup documents: one sketch of `field` per value of `key` (a field name)
+# and month, built in one aggregation and upserted into SKETCH_COLLECTION
+def build_rollups(db, collection, key, field, p=P):
+    month = {"$substrBytes": ["$date", 0, 7]}
+    pipeline = [{"$match": {field: {"$exists": True}}}] + hash_stages(f"${field}", p) + [
+        {"$group": {"_id": {"key": f"${key}", "month": month, "r": f"${HELPER}r"},
+                    "k": {"$max": f"${HELPER}k"},
+                    "lo": {"$min": f"${HELPER}h"},
+                    "hi": {"$max": f"${HELPER}h"}}},
+        {"$group": {"_id": {"key": "$_id.key", "month": "$_id.month"},
+                    "registers": {"$push": {"r": "$_id.r", "k": "$k", "lo": "$lo", "hi": "$hi"}}}},
+    ]
+    written = 0
+    for document in db[collection].aggregate(pipeline, comment="hll", allowDiskUse=True):
+        sketch = Sketch.from_registers(document["registers"], p)
+        _id = {"collection": collection, "field": field, "key": key,
+               "value": document["_id"]["key"], "month": document["_id"]["month"]}
+        db[SKETCH_COLLECTION].replace_one({"_id": _id}, {"_id": _id, **sketch.to_document()}, upsert=True)
+        written += 1
+    return written
+
+
+# Merged sketch of the rollups matching the arguments (None = any)
+def merged_sketch(db, field, key, value=None, collections=None, start=None, end=None):
+    query = {"_id.field": field, "_id.key": key}
+    if value is not None:
+        query["_id.value"] = value
+    if collections:
+        query["_id.collection"] = {"$in": list(collections)}
+    if start or end:
+        query["_id.month"] = {key_: month for key_, month in (("$gte", start), ("$lte", end)) if month}
+    sketch = None
+    for document in db[SKETCH_COLLECTION].find(query):
+        part = Sketch.from_document(document)
+        sketch = part if sketch is None else sketch.merge(part)
+    return sketch
+
+
+def distinct_count(db, field, key, value=None, collections=None, start=None, end=None):
+    sketch = merged_sketch(db, field, key, value, collections, start, end)
+    return sketch.count() if sketch else 0
+
+
+def main():
+    # runner is only needed for the command line, the rewrite works without a cluster
+    from runner import db
+
+    parser = argparse.ArgumentParser(description="Build and query distinct-count sketch rollups")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="sketch `field` per `key` and month")
+    build.add_argument("--collections", nargs="*", default=["globalClimate", "usWeatherEvents", "weatherHistory"])
+    build.add_argument("--key", default="location")
+    build.add_argument("--field", default="station_id")
+    count = commands.add_parser("count", help="merge the rollups and print distinct counts")
+    count.add_argument("--collections", nargs="*")
+    count.add_argument("--key", default="location")
+    count.add_argument("--field", default="station_id")
+    count.add_argument("--start", help="first month, YYYY-MM")
+    count.add_argument("--end", help="last month, YYYY-MM")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for collection in args.collections:
+            written = build_rollups(db, collection, args.key, args.field)
+            print(f"{collection}: {written} sketches of {args.field} per {args.key} and month")
+        return
+    values = db[SKETCH_COLLECTION].distinct("_id.value", {"_id.field": args.field, "_id.key": args.key})
+    for value in sorted(values, key=str):
+        sketch = merged_sketch(db, args.field, args.key, value, args.collections, args.start, args.end)
+        if sketch:
+            exact = "exact" if sketch.hashes is not None else f"+-{1.04 / math.sqrt(2 ** sketch.p):.1%}"
+            print(f"{value}: {sketch.count()} distinct {args.field} ({exact})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# loadgen.py - Open-loop mixed workload of simulated dashboard users
+#
+#   python loadgen.py --rate 20 --duration 120
+#   python loadgen.py --rate 5,10,20,40,80 --duration 60 --slo-ms 2000
+#   python loadgen.py --mix q9=5,q11=2,q20=1 --rate 30 --clients 16 --csv load.csv
+#
+# Requests arrive as a Poisson process at --rate per second, whether or not
+# earlier ones have finished (open loop). Each picks a query from the mix
+# (--mix, default: medium queries 3 times as often as heavy ones) and draws
+# its parameters: locations by a Zipf law over how many documents they have,
+# so busy cities are asked for most, and years weighted towards the recent
+# ones. Requests go to --clients MongoClients, pinned round-robin to the hosts
+# of MONGO_URI, so both routers get the same share. A request's latency
+# counts from its scheduled arrival, so time spent waiting for a free worker
+# (--max-inflight) is included rather than hidden (no coordinated omission).
+# $merge and $out stages are dropped, dashboards only read.
+#
+# Every --interval seconds a line reports offered and completed requests per
+# second, latency p50/p95/p99, errors and the backlog. Several comma
+# separated rates run one after another for --duration each; the first rate
+# whose throughput falls 10% behind the offered rate, or whose p99 exceeds
+# --slo-ms, is reported as the saturation point.
+import argparse
+import csv
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from pymongo.uri_parser import parse_uri
+
+import optimizer
+import registry
+from run import select_queries
+from runner import MONGO_URI, OPTIMIZE, db
+from warmup import read_only
+
+# Mix weight of a query by cost class
+COST_WEIGHTS = {"light": 6, "medium": 3, "heavy": 1}
+ZIPF_EXPONENT = 1.0
+# Throughput below this share of the offered rate means saturation
+SATURATION = 0.9
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(math.ceil(q * len(ordered))) - 1, len(ordered) - 1)] if q > 0 else ordered[0]
+
+
+# {query id: weight} from "q9=5,q11=2"
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        try:
+            mix[registry.get(name).id] = float(weight or 1)
+        except KeyError as e:
+            raise SystemExit(e.args[0])
+    return mix
+
+
+# One MongoClient per simulated client, pinned to the routers in turn
+def make_clients(count):
+    parsed = parse_uri(MONGO_URI)
+    options = {"username": parsed["username"], "password": parsed["password"], **dict(parsed["options"])}
+    options.pop("directconnection", None)
+    return [(f"{host}:{port}", MongoClient(host, port, directConnection=True, **options)[parsed["database"] or db.name])
+            for host, port in (parsed["nodelist"][i % len(parsed["nodelist"])] for i in range(count))]
+
+
+# Draws realistic parameter values from the data of each collection
+class ParameterSampler:
+    def __init__(self, collections):
+        self.locations = {}
+        self.years = {}
+        for collection in collections:
+            counts = db[collection].aggregate([{"$group": {"_id": "$location", "n": {"$sum": 1}}},
+                                               {"$sort": {"n": -1}}])
+            names = [document["_id"] for document in counts if document["_id"]]
+            self.locations[collection] = (names, [1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(len(names))])
+            years = sorted({int(date[:4]) for date in db[collection].distinct("date")})
+            self.years[collection] = (years, [rank + 1 for rank in range(len(years))])
+
+    def _location(self, collection):
+        names, weights = self.locations[collection]
+        return random.choices(names, weights)[0]
+
+    def values(self, query):
+        values = {}
+        for name in query.parameters:
+            if name == "location" and self.locations[query.collection][0]:
+                values[name] = self._location(query.collection)
+            elif name == "locations" and self.locations[query.collection][0]:
+                values[name] = sorted({self._location(query.collection) for _ in range(random.randint(1, 3))})
+            elif name == "year" and self.years[query.collection][0]:
+                years, weights = self.years[query.collection]
+                values[name] = random.choices(years, weights)[0]
+        return values
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.window = []
+        self.errors = defaultdict(int)
+        self.window_errors = 0
+        self.latencies = defaultdict(list)
+        self.inflight = 0
+        self.pending = set()
+
+    # Counted at submission, so queued requests are part of the backlog
+    def started(self, future):
+        with self.lock:
+            self.inflight += 1
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    # Cancel the requests that are still queued (shutdown(cancel_futures=True) needs Python 3.9)
+    def cancel_pending(self):
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+
+    def finished(self, query_id, router, latency, error=None):
+        with self.lock:
+            self.inflight -= 1
+            if error is None:
+                self.window.append(latency)
+                self.latencies[query_id].append(latency)
+            else:
+                self.window_errors += 1
+                self.errors[(query_id, router, type(error).__name__)] += 1
+
+    def take_window(self):
+        with self.lock:
+            window, errors = self.window, self.window_errors
+            self.window, self.window_errors = [], 0
+            return window, errors, self.inflight
+
+
+def execute(client, query, values, scheduled, recorder):
+    router, database = client
+    try:
+        pipeline = read_only(query.pipeline(**values))
+        if OPTIMIZE:
+            pipeline = optimizer.optimize(pipeline, OPTIMIZE)
+        for _ in database[query.collection].aggregate(pipeline, comment=f"q{query.id}"):
+            pass
+    except PyMongoError as e:
+        recorder.finished(query.id, router, time.perf_counter() - scheduled, e)
+    else:
+        recorder.finished(query.id, router, time.perf_counter() - scheduled)
+
+
+# Offer `rate` requests per second for `duration` seconds, returns the step summary
+def run_step(rate, duration, interval, queries, mix, sampler, clients, pool, recorder, writer):
+    ids = list(mix)
+    weights = [mix[query_id] for query_id in ids]
+    start = time.perf_counter()
+    next_arrival = start
+    next_report = start + interval
+    offered = completed = errors = 0
+    window_offered = 0
+    latencies = []
+    step_end = start + duration
+    while True:
+        now = time.perf_counter()
+        if now >= next_report or now >= step_end:
+            window, window_errors, inflight = recorder.take_window()
+            elapsed = max(now - (next_report - interval), 1e-9)
+            row = {"rate": rate, "second": round(now - start, 1), "offered": window_offered / elapsed,
+                   "throughput": len(window) / elapsed, "p50_ms": percentile(window, 0.5) * 1000,
+                   "p95_ms": percentile(window, 0.95) * 1000, "p99_ms": percentile(window, 0.99) * 1000,
+                   "errors": window_errors, "backlog": inflight}
+            print(f"{row['rate']:>6} {row['second']:7.1f} {row['offered']:8.1f} {row['throughput']:8.1f} "
+                  f"{row['p50_ms']:8.0f} {row['p95_ms']:8.0f} {row['p99_ms']:8.0f} {row['errors']:6d} "
+                  f"{row['backlog']:7d}", flush=True)
+            if writer:
+                writer.writerow(row)
+            completed += len(window)
+            errors += window_errors
+            latencies += window
+            window_offered = 0
+            next_report = now + interval
+            if now >= step_end:
+                break
+        if now >= next_arrival:
+            query = queries[random.choices(ids, weights)[0]]
+            client = clients[offered % len(clients)]
+            recorder.started(pool.submit(execute, client, query, sampler.values(query), next_arrival, recorder))
+            offered += 1
+            window_offered += 1
+            # Exponential gaps between arrivals make a Poisson process
+            next_arrival += random.expovariate(rate)
+            continue
+        time.sleep(max(min(next_arrival, next_report, step_end) - now, 0))
+    return {"rate": rate, "offered": offered / duration, "throughput": completed / duration,
+            "p50_ms": percentile(latencies, 0.5) * 1000, "p99_ms": percentile(latencies, 0.99) * 1000,
+            "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop mixed workload generator for the Dotazy queries")
+    parser.add_argument("queries", nargs="*", help="query ids (q9 or 9) or 'all'")
+    parser.add_argument("--cost", choices=registry.COST_CLASSES, help="only queries of this cost class")
+    parser.add_argument("--mix", help="weights, e.g. q9=5,q11=2 (default: by cost class)")
+    parser.add_argument("--rate", default="10", help="requests per second, comma separated for a ramp")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per rate")
+    parser.add_argument("--clients", type=int, default=8, help="MongoClients, pinned to the routers in turn")
+    parser.add_argument("--max-inflight", type=int, default=64, help="requests running at once")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between report lines")
+    parser.add_argument("--slo-ms", type=float, help="p99 latency above this means saturation")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--csv", help="write the report lines to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.mix:
+        mix = parse_mix(args.mix)
+        queries = {query_id: registry.get(query_id) for query_id in mix}
+    else:
+        queries = {query.id: query for query in select_queries(args.queries, args.cost)}
+        mix = {query_id: COST_WEIGHTS[query.cost] for query_id, query in queries.items()}
+    rates = [float(rate) for rate in args.rate.split(",")]
+    sampler = ParameterSampler({queries[query_id].collection for query_id in mix})
+    clients = make_clients(args.clients)
+    recorder = Recorder()
+    print(f"Mix: {', '.join(f'q{query_id}={weight:g}' for query_id, weight in mix.items())}")
+    print(f"Clients: {', '.join(sorted({router for router, _ in clients}))}, {len(clients)} in total")
+
+    csv_file = open(args.csv, "w", newline="") if args.csv else None
+    writer = None
+    if csv_file:
+        writer = csv.DictWriter(csv_file, ["rate", "second", "offered", "throughput", "p50_ms", "p95_ms",
+                                           "p99_ms", "errors", "backlog"])
+        writer.writeheader()
+    print(f"{'rate':>6} {'second':>7} {'offered':>8} {'done/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'errors':>6} {'backlog':>7}")
+    steps = []
+    try:
+        with ThreadPoolExecutor(max_workers=args.max_inflight) as pool:
+            for rate in rates:
+                steps.append(run_step(rate, args.duration, args.interval, queries, mix, sampler, clients,
+                                      pool, recorder, writer))
+            # Queued requests are cancelled, running ones finish unreported
+            recorder.cancel_pending()
+    finally:
+        if csv_file:
+            csv_file.close()
+        for _, database in clients:
+            database.client.close()
+
+    print(f"\n{'rate':>6} {'offered':>8} {'done/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    saturation = None
+    for step in steps:
+        print(f"{step['rate']:>6g} {step['offered']:8.1f} {step['throughput']:8.1f} {step['p50_ms']:8.0f} "
+              f"{step['p99_ms']:8.0f} {step['errors']:6d}")
+        saturated = (step["throughput"] < SATURATION * step["offered"]
+                     or (args.slo_ms is not None and step["p99_ms"] > args.slo_ms))
+        if saturated and saturation is None:
+            saturation = step["rate"]
+    print("Saturated at " + (f"{saturation:g} requests/s" if saturation else "none of the offered rates"))
+
+    print(f"\n{'query':>6} {'done':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for query_id in mix:
+        latencies = recorder.latencies.get(query_id, [])
+        print(f"{'q' + query_id:>6} {len(latencies):6d} {percentile(latencies, 0.5) * 1000:8.0f} "
+              f"{percentile(latencies, 0.95) * 1000:8.0f} {percentile(latencies, 0.99) * 1000:8.0f}")
+    for (query_id, router, error), count in sorted(recorder.errors.items()):
+        print(f"q{query_id} on {router}: {count} x {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1079 @@
+# local_engine.py - Vectorized in-process interpreter for aggregation pipelines over columnar data
+#
+# Evaluates the aggregation stages used by the Dotazy queries on NumPy column
+# arrays (for example a snapshot from snapshot.py) instead of documents:
+# $match, $addFields/$set, $project, $group, $bucket, $sort, $limit, $skip,
+# $unwind and $count, with the usual arithmetic, comparison, boolean, date,
+# string and array expressions. Sub-documents are kept as dotted column names
+# ("_id.location") and only reassembled into dicts in to_documents().
+# Stages that need other collections ($lookup, $unionWith, $graphLookup, ...)
+# raise UnsupportedPipeline so the caller can fall back to the cluster.
+import datetime
+import re
+
+import numpy as np
+
+
+class UnsupportedPipeline(Exception):
+    pass
+
+
+# BSON comparison order of the types that occur in our data
+def _type_order(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 0
+    if isinstance(value, (bool, np.bool_)):
+        return 5
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, (datetime.datetime, np.datetime64)):
+        return 6
+    return 7
+
+
+def _bson_key(value):
+    order = _type_order(value)
+    if order == 0:
+        return (0, 0)
+    if order == 3:
+        return (3, tuple((k, _bson_key(v)) for k, v in value.items()))
+    if order == 4:
+        return (4, tuple(_bson_key(v) for v in value))
+    return (order, value)
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+# Turn a list of Python values into the most specific NumPy array
+def _to_array(values):
+    if not values:
+        return np.array([], dtype=np.float64)
+    kinds = {_type_order(v) for v in values}
+    if kinds == {1} or kinds == {0, 1}:
+        if all(isinstance(v, (int, np.integer)) for v in values):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    if kinds == {2}:
+        return np.array(values, dtype=str)
+    if kinds == {5}:
+        return np.array(values, dtype=bool)
+    return _object_array(values)
+
+
+def _is_numeric(array):
+    return array.dtype.kind in "biuf"
+
+
+def _is_null(array):
+    if array.dtype.kind == "f":
+        return np.isnan(array)
+    if array.dtype.kind == "O":
+        return np.frompyfunc(lambda v: v is None, 1, 1)(array).astype(bool)
+    if array.dtype.kind == "M":
+        return np.isnat(array)
+    return np.zeros(len(array), dtype=bool)
+
+
+def _truthy(array):
+    if array.dtype.kind == "b":
+        return array
+    if array.dtype.kind in "iuf":
+        return (array != 0) & ~np.isnan(array.astype(np.float64))
+    if array.dtype.kind == "O":
+        return np.frompyfunc(lambda v: not (v is None or v is False or (not isinstance(v, (str, list, dict)) and v == 0)),
+                             1, 1)(array).astype(bool)
+    if array.dtype.kind == "M":
+        return ~np.isnat(array)
+    return np.ones(len(array), dtype=bool)
+
+
+# Python value of a NumPy scalar/array element for output documents
+def _python_value(value):
+    if isinstance(value, np.datetime64):
+        if np.isnat(value):
+            return None
+        return value.astype("datetime64[ms]").item()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, list):
+        return [_python_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _python_value(v) for k, v in value.items()}
+    return value
+
+
+# Columns of equal length, sub-document fields stored under dotted names
+class Frame:
+    def __init__(self, columns, n=None):
+        self.columns = dict(columns)
+        if n is None:
+            n = len(next(iter(self.columns.values()))) if self.columns else 0
+        self.n = n
+
+    def has(self, path):
+        prefix = path + "."
+        return path in self.columns or any(name.startswith(prefix) for name in self.columns)
+
+    # Values of a field path; sub-documents come back as an object array of dicts
+    def get(self, path):
+        if path in self.columns:
+            return self.columns[path]
+        prefix = path + "."
+        children = [name for name in self.columns if name.startswith(prefix)]
+        if children:
+            return _object_array(self.to_documents(children, strip=len(prefix)))
+        # Path through a column holding documents or arrays of documents
+        parts = path.split(".")
+        for i in range(len(parts) - 1, 0, -1):
+            head = ".".join(parts[:i])
+            if head in self.columns:
+                return _traverse(self.columns[head], parts[i:])
+        return _object_array([None] * self.n)
+
+    def set(self, path, values):
+        prefix = path + "."
+        for name in [name for name in self.columns if name.startswith(prefix)]:
+            del self.columns[name]
+        if isinstance(values, dict):
+            for key, value in values.items():
+                self.set(f"{path}.{key}", value)
+            return
+        self.columns[path] = _broadcast(values, self.n)
+
+    def take(self, index):
+        return Frame({name: column[index] for name, column in self.columns.items()}, len(index))
+
+    def to_documents(self, names=None, strip=0):
+        names = list(self.columns) if names is None else names
+        documents = [{} for _ in range(self.n)]
+        for name in names:
+            keys = name[strip:].split(".")
+            column = self.columns[name]
+            for document, value in zip(documents, column):
+                target = document
+                for key in keys[:-1]:
+                    target = target.setdefault(key, {})
+                target[keys[-1]] = _python_value(value)
+        return documents
+
+
+# Child rows of a parent frame (elements of $filter/$map inputs), variables
+# like "$$point" resolve to the element values, plain field paths to the parent
+class _ElementFrame:
+    def __init__(self, values):
+        self.values = values
+        self.n = len(values)
+
+    def get(self, path):
+        if path == "":
+            return self.values
+        return _traverse(self.values, path.split("."))
+
+
+class _ChildFrame:
+    def __init__(self, parent, index):
+        self.parent = parent
+        self.index = index
+        self.n = len(index)
+
+    def has(self, path):
+        return self.parent.has(path)
+
+    def get(self, path):
+        return self.parent.get(path)[self.index]
+
+
+def _traverse(values, parts):
+    def walk(value, parts):
+        for i, part in enumerate(parts):
+            if isinstance(value, list):
+                return [walk(item, parts[i:]) for item in value if isinstance(item, dict) and part in item]
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+        return value
+
+    result = [walk(value, parts) for value in values]
+    return _to_array(result) if all(not isinstance(v, (list, dict)) for v in result) else _object_array(result)
+
+
+def _broadcast(value, n):
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, (list, dict)):
+        return _object_array([value] * n)
+    if value is None:
+        return _object_array([None] * n)
+    return np.full(n, value)
+
+
+def _as_array(value, n):
+    return _broadcast(value, n) if not isinstance(value, np.ndarray) else value
+
+
+# Load a snapshot.Snapshot (or a slice of one) into a Frame with decoded strings and dates
+def frame_from_snapshot(snapshot, start=0, end=None):
+    end = snapshot.rows if end is None else end
+    columns = {}
+    for name, column in snapshot.columns.items():
+        kind = snapshot.meta["columns"][name]["kind"]
+        values = column[start:end]
+        if kind == "dictionary":
+            dictionary = np.array(snapshot.dictionaries[name], dtype=str)
+            if (values < 0).any():
+                columns[name] = _object_array(list(snapshot.decode(name, values)))
+            else:
+                columns[name] = dictionary[values]
+        elif kind == "date":
+            columns[name] = np.datetime_as_string(values.astype("datetime64[D]"))
+        else:
+            columns[name] = np.asarray(values)
+    return Frame(columns, end - start)
+
+
+# Build a Frame from a list of flat documents (tests, small inputs)
+def frame_from_documents(documents):
+    names = []
+    for document in documents:
+        for name in document:
+            if name not in names:
+                names.append(name)
+    return Frame({name: _to_array([d.get(name) for d in documents]) for name in names}, len(documents))
+
+
+# ---------------------------------------------------------------- expressions
+
+def evaluate(expression, frame, variables=None):
+    variables = variables or {}
+    if isinstance(expression, str):
+        if expression.startswith("$$"):
+            name, _, path = expression[2:].partition(".")
+            if name not in variables:
+                raise UnsupportedPipeline(f"Unknown variable $${name}")
+            return variables[name].get(path)
+        if expression.startswith("$"):
+            return frame.get(expression[1:])
+        return expression
+    if isinstance(expression, list):
+        return [evaluate(item, frame, variables) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator = next(iter(expression))
+            if operator.startswith("$"):
+                handler = OPERATORS.get(operator)
+                if handler is None:
+                    raise UnsupportedPipeline(f"Unsupported expression operator {operator}")
+                return handler(expression[operator], frame, variables)
+        # Object literal: evaluate every field into a document per row
+        fields = {key: _as_array(evaluate(value, frame, variables), frame.n) for key, value in expression.items()}
+        return _object_array([
+            {key: _python_value(column[i]) for key, column in fields.items()} for i in range(frame.n)
+        ])
+    return expression
+
+
+def _args(spec, frame, variables, n=None):
+    values = [evaluate(item, frame, variables) for item in (spec if isinstance(spec, list) else [spec])]
+    if n is None:
+        return values
+    return [_as_array(v, frame.n) for v in values]
+
+
+def _numeric(value):
+    if isinstance(value, np.ndarray) and value.dtype.kind == "O":
+        return np.array([np.nan if v is None else v for v in value], dtype=np.float64)
+    return value
+
+
+def _arith(function):
+    def handler(spec, frame, variables):
+        values = [_numeric(v) for v in _args(spec, frame, variables)]
+        result = values[0]
+        for value in values[1:]:
+            result = function(result, value)
+        return result
+    return handler
+
+
+def _add(spec, frame, variables):
+    values = [_numeric(v) for v in _args(spec, frame, variables)]
+    dates = [v for v in values if isinstance(v, np.ndarray) and v.dtype.kind == "M"]
+    if dates:
+        total = sum(v for v in values if not (isinstance(v, np.ndarray) and v.dtype.kind == "M"))
+        return dates[0].astype("datetime64[ms]") + np.asarray(total).astype("timedelta64[ms]")
+    result = values[0]
+    for value in values[1:]:
+        result = result + value
+    return result
+
+
+def _subtract(spec, frame, variables):
+    a, b = [_numeric(v) for v in _args(spec, frame, variables)]
+    if isinstance(a, np.ndarray) and a.dtype.kind == "M":
+        if isinstance(b, np.ndarray) and b.dtype.kind == "M":
+            return (a.astype("datetime64[ms]") - b.astype("datetime64[ms]")).astype(np.int64)
+        return a.astype("datetime64[ms]") - np.asarray(b).astype("timedelta64[ms]")
+    return a - b
+
+
+def _divide(spec, frame, variables):
+    a, b = [_numeric(v) for v in _args(spec, frame, variables)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.true_divide(a, b)
+
+
+def _round(spec, frame, variables):
+    args = _args(spec, frame, variables)
+    value, places = _numeric(args[0]), (args[1] if len(args) > 1 else 0)
+    result = np.round(value, places)
+    if isinstance(value, np.ndarray) and value.dtype.kind in "iu":
+        return result.astype(value.dtype)
+    return result
+
+
+def _unary(function):
+    def handler(spec, frame, variables):
+        value = _numeric(_args(spec, frame, variables)[0])
+        with np.errstate(invalid="ignore"):
+            return function(value)
+    return handler
+
+
+def _pow(spec, frame, variables):
+    base, exponent = [_numeric(v) for v in _args(spec, frame, variables)]
+    return np.power(np.asarray(base, dtype=np.float64), exponent)
+
+
+# Aggregation comparison, null/missing sorts before every other value
+def _comparison(op):
+    def compare(a, b, n):
+        a, b = _as_array(a, n), _as_array(b, n)
+        if a.dtype.kind in "biuf" and b.dtype.kind in "biuf":
+            a = np.where(np.isnan(a.astype(np.float64)), -np.inf, a) if a.dtype.kind == "f" else a
+            b = np.where(np.isnan(b.astype(np.float64)), -np.inf, b) if b.dtype.kind == "f" else b
+            return op(a, b)
+        if a.dtype.kind in "US" and b.dtype.kind in "US":
+            return op(a, b)
+        if a.dtype.kind == "M" and b.dtype.kind == "M":
+            return op(a.astype("datetime64[ms]"), b.astype("datetime64[ms]"))
+        return np.frompyfunc(lambda x, y: bool(op(_bson_key(x), _bson_key(y))), 2, 1)(a, b).astype(bool)
+
+    def handler(spec, frame, variables):
+        a, b = _args(spec, frame, variables)
+        return compare(a, b, frame.n)
+    return handler
+
+
+def _eq_values(a, b, n):
+    a, b = _as_array(a, n), _as_array(b, n)
+    if (a.dtype.kind in "biuf" and b.dtype.kind in "biuf") or (a.dtype.kind in "US" and b.dtype.kind in "US"):
+        return a == b
+    if (a.dtype.kind in "biuf" and b.dtype.kind in "US") or (a.dtype.kind in "US" and b.dtype.kind in "biuf"):
+        return np.zeros(n, dtype=bool)
+    return np.frompyfunc(lambda x, y: _bson_key(x) == _bson_key(y), 2, 1)(a, b).astype(bool)
+
+
+def _eq(spec, frame, variables):
+    a, b = _args(spec, frame, variables)
+    return _eq_values(a, b, frame.n)
+
+
+def _ne(spec, frame, variables):
+    return ~_eq(spec, frame, variables)
+
+
+def _and(spec, frame, variables):
+    result = np.ones(frame.n, dtype=bool)
+    for value in _args(spec, frame, variables, n=frame.n):
+        result &= _truthy(value)
+    return result
+
+
+def _or(spec, frame, variables):
+    result = np.zeros(frame.n, dtype=bool)
+    for value in _args(spec, frame, variables, n=frame.n):
+        result |= _truthy(value)
+    return result
+
+
+def _not(spec, frame, variables):
+    return ~_truthy(_args(spec, frame, variables, n=frame.n)[0])
+
+
+def _in(spec, frame, variables):
+    value, array = _args(spec, frame, variables)
+    if isinstance(array, list) and not any(isinstance(v, np.ndarray) for v in array):
+        value = _as_array(value, frame.n)
+        if value.dtype.kind == "O":
+            keys = {_bson_key(v) for v in array}
+            return np.frompyfunc(lambda v: _bson_key(v) in keys, 1, 1)(value).astype(bool)
+        return np.isin(value, array)
+    value, array = _as_array(value, frame.n), _as_array(array, frame.n)
+    return np.array([
+        _bson_key(v) in {_bson_key(item) for item in (items or [])} for v, items in zip(value, array)
+    ], dtype=bool)
+
+
+# Pick per row from `choices` (first true condition wins) with a common dtype
+def _select(conditions, choices, default, n):
+    choices = [_as_array(c, n) for c in choices]
+    default = _as_array(default, n)
+    arrays = choices + [default]
+    kinds = {a.dtype.kind for a in arrays}
+    if kinds <= {"U"} or kinds <= {"b"} or kinds <= {"i", "u", "f"} or kinds <= {"M"}:
+        return np.select(conditions, choices, default) if conditions else default
+    result = _object_array(list(default))
+    taken = np.zeros(n, dtype=bool)
+    for condition, choice in zip(conditions, choices):
+        mask = condition & ~taken
+        result[mask] = _object_array([_python_value(v) for v in choice[mask]])
+        taken |= condition
+    return result
+
+
+def _cond(spec, frame, variables):
+    if isinstance(spec, dict):
+        spec = [spec["if"], spec["then"], spec["else"]]
+    condition, then, otherwise = spec
+    mask = _truthy(_as_array(evaluate(condition, frame, variables), frame.n))
+    return _select([mask], [evaluate(then, frame, variables)], evaluate(otherwise, frame, variables), frame.n)
+
+
+def _switch(spec, frame, variables):
+    conditions, choices = [], []
+    for branch in spec["branches"]:
+        conditions.append(_truthy(_as_array(evaluate(branch["case"], frame, variables), frame.n)))
+        choices.append(evaluate(branch["then"], frame, variables))
+    if "default" not in spec:
+        raise UnsupportedPipeline("$switch without default")
+    return _select(conditions, choices, evaluate(spec["default"], frame, variables), frame.n)
+
+
+def _if_null(spec, frame, variables):
+    values = _args(spec, frame, variables, n=frame.n)
+    result = values[-1]
+    for value in reversed(values[:-1]):
+        result = _select([~_is_null(value)], [value], result, frame.n)
+    return result
+
+
+def _date_from_string(spec, frame, variables):
+    fmt = spec.get("format", "%Y-%m-%d")
+    if fmt != "%Y-%m-%d":
+        raise UnsupportedPipeline(f"$dateFromString format {fmt}")
+    strings = _as_array(evaluate(spec["dateString"], frame, variables), frame.n)
+    if strings.dtype.kind == "O":
+        strings = np.array(["NaT" if s is None else s for s in strings])
+    return strings.astype("datetime64[D]").astype("datetime64[ms]")
+
+
+def _date_part(unit):
+    def handler(spec, frame, variables):
+        if isinstance(spec, dict) and "date" in spec:
+            spec = spec["date"]
+        dates = _as_array(evaluate(spec, frame, variables), frame.n)
+        if dates.dtype.kind != "M":
+            dates = dates.astype("datetime64[ms]")
+        if unit == "year":
+            return dates.astype("datetime64[Y]").astype(np.int64) + 1970
+        if unit == "month":
+            return dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+        if unit == "day":
+            return (dates.astype("datetime64[D]") - dates.astype("datetime64[M]")).astype(np.int64) + 1
+        # ISO day of week is Monday=1, $dayOfWeek is Sunday=1
+        return (dates.astype("datetime64[D]").astype(np.int64) + 4) % 7 + 1
+    return handler
+
+
+def _date_to_string(spec, frame, variables):
+    fmt = spec.get("format", "%Y-%m-%dT%H:%M:%S.%LZ")
+    dates = _as_array(evaluate(spec["date"], frame, variables), frame.n)
+    if fmt == "%Y-%m-%d":
+        return np.datetime_as_string(dates.astype("datetime64[D]"))
+    if fmt == "%Y-%m":
+        return np.datetime_as_string(dates.astype("datetime64[M]"))
+    raise UnsupportedPipeline(f"$dateToString format {fmt}")
+
+
+UNITS = {"day": "D", "week": "W", "hour": "h", "minute": "m", "second": "s", "millisecond": "ms"}
+
+
+def _date_add(spec, frame, variables):
+    start = _as_array(evaluate(spec["startDate"], frame, variables), frame.n)
+    amount = evaluate(spec["amount"], frame, variables)
+    unit = spec["unit"]
+    if unit in ("month", "year"):
+        step = "M" if unit == "month" else "Y"
+        days = start.astype("datetime64[D]") - start.astype(f"datetime64[{step}]").astype("datetime64[D]")
+        return ((start.astype(f"datetime64[{step}]") + np.asarray(amount).astype(f"timedelta64[{step}]"))
+                .astype("datetime64[D]") + days).astype("datetime64[ms]")
+    return start + np.asarray(amount).astype(f"timedelta64[{UNITS[unit]}]")
+
+
+def _date_diff(spec, frame, variables):
+    start = _as_array(evaluate(spec["startDate"], frame, variables), frame.n)
+    end = _as_array(evaluate(spec["endDate"], frame, variables), frame.n)
+    unit = spec["unit"]
+    if unit in ("month", "year"):
+        step = "M" if unit == "month" else "Y"
+        return (end.astype(f"datetime64[{step}]") - start.astype(f"datetime64[{step}]")).astype(np.int64)
+    code = UNITS[unit]
+    return (end.astype(f"datetime64[{code}]") - start.astype(f"datetime64[{code}]")).astype(np.int64)
+
+
+def _rowwise(function, arity=None):
+    def handler(spec, frame, variables):
+        values = _args(spec, frame, variables, n=frame.n)
+        if arity is not None:
+            values = values[:arity]
+        result = [function(*row) for row in zip(*[list(v) for v in values])]
+        return _to_array([_python_value(v) for v in result])
+    return handler
+
+
+def _to_string_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(_python_value(value))
+
+
+def _to_string(spec, frame, variables):
+    value = _as_array(evaluate(spec, frame, variables), frame.n)
+    return _to_array([_to_string_value(v) for v in value])
+
+
+def _concat(spec, frame, variables):
+    values = _args(spec, frame, variables, n=frame.n)
+    if all(v.dtype.kind == "U" for v in values):
+        result = values[0]
+        for value in values[1:]:
+            result = np.char.add(result, value)
+        return result
+    return _rowwise(lambda *parts: None if any(p is None for p in parts) else "".join(parts))(spec, frame, variables)
+
+
+def _substr(spec, frame, variables):
+    value, start, length = _args(spec, frame, variables)
+    value = _as_array(value, frame.n)
+    if value.dtype.kind == "U" and start == 0:
+        return value.astype(f"<U{max(int(length), 1)}")
+    return _to_array(["" if v is None else str(v)[start:start + length] for v in value])
+
+
+def _size(spec, frame, variables):
+    value = _as_array(evaluate(spec[0] if isinstance(spec, list) and len(spec) == 1 and isinstance(spec[0], str) else spec,
+                               frame, variables), frame.n)
+    return np.fromiter((len(v) if isinstance(v, list) else 0 for v in value), dtype=np.int64, count=frame.n)
+
+
+def _slice(spec, frame, variables):
+    args = _args(spec, frame, variables)
+    array = _as_array(args[0], frame.n)
+    if len(args) == 2:
+        count = args[1]
+        return _object_array([(v[:count] if count >= 0 else v[count:]) if isinstance(v, list) else None for v in array])
+    position, count = args[1], args[2]
+    return _object_array([v[position:position + count] if isinstance(v, list) else None for v in array])
+
+
+def _array_elem_at(spec, frame, variables):
+    array, index = _args(spec, frame, variables)
+    array = _as_array(array, frame.n)
+    values = []
+    for v in array:
+        if isinstance(v, list) and -len(v) <= index < len(v):
+            values.append(v[index])
+        else:
+            values.append(None)
+    return _to_array(values) if all(not isinstance(v, (dict, list)) for v in values) else _object_array(values)
+
+
+# $filter and $map evaluate their expression once over all array elements of all rows
+def _explode(spec, frame, variables):
+    lists = _as_array(evaluate(spec["input"], frame, variables), frame.n)
+    lengths = np.fromiter((len(v) if isinstance(v, list) else 0 for v in lists), dtype=np.int64, count=frame.n)
+    parent = np.repeat(np.arange(frame.n), lengths)
+    elements = _object_array([item for v in lists if isinstance(v, list) for item in v])
+    child = _ChildFrame(frame, parent)
+    scope = dict(variables)
+    scope[spec.get("as", "this")] = _ElementFrame(elements)
+    return lists, lengths, elements, child, scope
+
+
+def _regroup(values, lengths):
+    bounds = np.cumsum(lengths)[:-1]
+    return _object_array([list(chunk) for chunk in np.split(values, bounds)] if len(lengths) else [])
+
+
+def _filter(spec, frame, variables):
+    lists, lengths, elements, child, scope = _explode(spec, frame, variables)
+    keep = _truthy(_as_array(evaluate(spec["cond"], child, scope), child.n))
+    parent = np.repeat(np.arange(frame.n), lengths)
+    kept = np.bincount(parent[keep], minlength=frame.n)
+    result = _regroup(_object_array([_python_value(v) for v in elements[keep]]), kept)
+    for i, value in enumerate(lists):
+        if not isinstance(value, list):
+            result[i] = None
+    return result
+
+
+def _map(spec, frame, variables):
+    lists, lengths, elements, child, scope = _explode(spec, frame, variables)
+    mapped = _as_array(evaluate(spec["in"], child, scope), child.n)
+    return _regroup(_object_array([_python_value(v) for v in mapped]), lengths)
+
+
+def _literal(spec, frame, variables):
+    return spec
+
+
+def _to_double(spec, frame, variables):
+    return np.asarray(_numeric(_as_array(evaluate(spec, frame, variables), frame.n)), dtype=np.float64)
+
+
+def _to_int(spec, frame, variables):
+    return np.trunc(_to_double(spec, frame, variables)).astype(np.int64)
+
+
+OPERATORS = {
+    "$add": _add,
+    "$subtract": _subtract,
+    "$multiply": _arith(lambda a, b: a * b),
+    "$divide": _divide,
+    "$mod": _arith(np.fmod),
+    "$round": _round,
+    "$trunc": _unary(np.trunc),
+    "$abs": _unary(np.abs),
+    "$ceil": _unary(np.ceil),
+    "$floor": _unary(np.floor),
+    "$sqrt": _unary(np.sqrt),
+    "$ln": _unary(np.log),
+    "$exp": _unary(np.exp),
+    "$pow": _pow,
+    "$eq": _eq,
+    "$ne": _ne,
+    "$gt": _comparison(lambda a, b: a > b),
+    "$gte": _comparison(lambda a, b: a >= b),
+    "$lt": _comparison(lambda a, b: a < b),
+    "$lte": _comparison(lambda a, b: a <= b),
+    "$and": _and,
+    "$or": _or,
+    "$not": _not,
+    "$in": _in,
+    "$cond": _cond,
+    "$switch": _switch,
+    "$ifNull": _if_null,
+    "$dateFromString": _date_from_string,
+    "$dateToString": _date_to_string,
+    "$dateAdd": _date_add,
+    "$dateDiff": _date_diff,
+    "$year": _date_part("year"),
+    "$month": _date_part("month"),
+    "$dayOfMonth": _date_part("day"),
+    "$dayOfWeek": _date_part("dayOfWeek"),
+    "$toString": _to_string,
+    "$toDouble": _to_double,
+    "$toInt": _to_int,
+    "$concat": _concat,
+    "$substr": _substr,
+    "$substrBytes": _substr,
+    "$size": _size,
+    "$slice": _slice,
+    "$arrayElemAt": _array_elem_at,
+    "$filter": _filter,
+    "$map": _map,
+    "$literal": _literal,
+}
+
+
+# ---------------------------------------------------------------- $match
+
+def _match_value(column, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        mask = np.ones(len(column), dtype=bool)
+        for operator, operand in condition.items():
+            mask &= _match_operator(column, operator, operand, condition)
+        return mask
+    return _match_operator(column, "$eq", condition, {})
+
+
+def _match_operator(column, operator, operand, condition):
+    numeric = _is_numeric(column)
+    null = _is_null(column)
+    if operator == "$eq":
+        if operand is None:
+            return null
+        return _eq_values(column, operand, len(column)) & ~null
+    if operator == "$ne":
+        return ~_match_operator(column, "$eq", operand, condition)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        # Query comparisons only match values of the operand's type
+        if isinstance(operand, (int, float)) and not numeric:
+            values = _numeric(column) if column.dtype.kind == "O" else None
+            if values is None:
+                return np.zeros(len(column), dtype=bool)
+            column, null = values, np.isnan(values)
+        ops = {"$gt": np.greater, "$gte": np.greater_equal, "$lt": np.less, "$lte": np.less_equal}
+        with np.errstate(invalid="ignore"):
+            return ops[operator](column, operand) & ~null
+    if operator == "$in":
+        return np.isin(column, operand) & ~null if column.dtype.kind != "O" else \
+            np.frompyfunc(lambda v: v in operand, 1, 1)(column).astype(bool)
+    if operator == "$nin":
+        return ~_match_operator(column, "$in", operand, condition)
+    if operator == "$exists":
+        return ~null if operand else null
+    if operator == "$regex":
+        options = condition.get("$options", "")
+        pattern = re.compile(operand, re.IGNORECASE if "i" in options else 0)
+        # The prefix fast path is case sensitive, options go through re
+        if column.dtype.kind == "U" and not options and re.fullmatch(r"\^[\w\- ]+", operand):
+            return np.char.startswith(column, operand[1:])
+        return np.frompyfunc(lambda v: isinstance(v, str) and pattern.search(v) is not None, 1, 1)(column).astype(bool)
+    if operator == "$options":
+        return np.ones(len(column), dtype=bool)
+    if operator == "$not":
+        return ~_match_value(column, operand)
+    raise UnsupportedPipeline(f"Unsupported query operator {operator}")
+
+
+def match_mask(frame, query):
+    mask = np.ones(frame.n, dtype=bool)
+    for key, condition in query.items():
+        if key == "$and":
+            for clause in condition:
+                mask &= match_mask(frame, clause)
+        elif key == "$or":
+            any_mask = np.zeros(frame.n, dtype=bool)
+            for clause in condition:
+                any_mask |= match_mask(frame, clause)
+            mask &= any_mask
+        elif key == "$nor":
+            for clause in condition:
+                mask &= ~match_mask(frame, clause)
+        elif key == "$expr":
+            mask &= _truthy(_as_array(evaluate(condition, frame), frame.n))
+        elif key.startswith("$"):
+            raise UnsupportedPipeline(f"Unsupported query operator {key}")
+        else:
+            # A missing field reads as an all-null column, which $ne, $nin,
+            # $exists: false and {field: null} match like the server does
+            mask &= _match_value(frame.get(key), condition)
+    return mask
+
+
+# ---------------------------------------------------------------- grouping
+
+def _unique_inverse(values):
+    try:
+        if values.dtype.kind == "O":
+            raise TypeError
+        uniques, inverse = np.unique(values, return_inverse=True)
+        return uniques, inverse.reshape(-1)
+    except TypeError:
+        keys = {}
+        inverse = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            inverse[i] = keys.setdefault(_bson_key(_python_value(value)), len(keys))
+        order = sorted(keys, key=lambda k: k)
+        remap = np.empty(len(keys), dtype=np.int64)
+        uniques = []
+        for rank, key in enumerate(order):
+            remap[keys[key]] = rank
+        first = {}
+        for i, code in enumerate(inverse):
+            first.setdefault(remap[code], values[i])
+        uniques = _object_array([first[rank] for rank in range(len(order))])
+        return uniques, remap[inverse] if len(inverse) else inverse
+
+
+# Group ids for rows keyed by several columns plus the key value of every group
+def _group_ids(keys, n):
+    if not keys:
+        return np.zeros(n, dtype=np.int64), (1 if n else 0), []
+    uniques, codes = zip(*[_unique_inverse(key) for key in keys])
+    if len(codes) == 1:
+        return codes[0], len(uniques[0]), [uniques[0]]
+    dims = [max(len(u), 1) for u in uniques]
+    combined = np.ravel_multi_index(codes, dims)
+    groups, ids = np.unique(combined, return_inverse=True)
+    parts = np.unravel_index(groups, dims)
+    return ids.reshape(-1), len(groups), [u[p] for u, p in zip(uniques, parts)]
+
+
+def _sorted_groups(ids, count):
+    order = np.argsort(ids, kind="stable")
+    starts = np.searchsorted(ids[order], np.arange(count + 1))
+    return order, starts
+
+
+def _accumulate(operator, values, ids, count, frame):
+    if operator == "$sum":
+        if not isinstance(values, np.ndarray):
+            counts = np.bincount(ids, minlength=count)
+            return counts * values if isinstance(values, (int, float)) else np.zeros(count, dtype=np.int64)
+        values = _numeric(values)
+        if values.dtype.kind in "biu":
+            return np.bincount(ids, weights=values, minlength=count).astype(np.int64)
+        valid = ~np.isnan(values)
+        return np.bincount(ids[valid], weights=values[valid], minlength=count)
+    if operator == "$count":
+        return np.bincount(ids, minlength=count)
+    values = _as_array(values, frame.n)
+    if operator in ("$avg", "$stdDevPop", "$stdDevSamp"):
+        values = _numeric(values).astype(np.float64)
+        valid = ~np.isnan(values)
+        sums = np.bincount(ids[valid], weights=values[valid], minlength=count)
+        counts = np.bincount(ids[valid], minlength=count)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = sums / counts
+            if operator == "$avg":
+                return means
+            deviations = (values[valid] - means[ids[valid]]) ** 2
+            squares = np.bincount(ids[valid], weights=deviations, minlength=count)
+            if operator == "$stdDevPop":
+                return np.sqrt(squares / counts)
+            return np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+    if operator in ("$min", "$max"):
+        if _is_numeric(values):
+            values = values.astype(np.float64) if values.dtype.kind == "f" else values
+            valid = ~_is_null(values)
+            fill = np.inf if operator == "$min" else -np.inf
+            result = np.full(count, fill)
+            (np.minimum if operator == "$min" else np.maximum).at(result, ids[valid], values[valid])
+            result[np.isinf(result) & (result == fill)] = np.nan
+            if values.dtype.kind in "iu" and not np.isnan(result).any():
+                return result.astype(values.dtype)
+            return result
+        ranks = _sort_rank(values)
+        valid = ~_is_null(values)
+        sign = 1 if operator == "$min" else -1
+        order = np.lexsort((sign * ranks, ~valid, ids))
+        starts = np.searchsorted(ids[order], np.arange(count))
+        return values[order[starts]]
+    if operator in ("$first", "$last"):
+        order, starts = _sorted_groups(ids, count)
+        index = order[starts[:-1]] if operator == "$first" else order[starts[1:] - 1]
+        return values[index]
+    if operator == "$push":
+        order, starts = _sorted_groups(ids, count)
+        pushed = [_python_value(v) for v in values[order]]
+        return _object_array([pushed[starts[g]:starts[g + 1]] for g in range(count)])
+    if operator == "$addToSet":
+        valid = ~_is_null(values) if values.dtype.kind != "O" else np.ones(frame.n, dtype=bool)
+        uniques, codes = _unique_inverse(values[valid])
+        pairs = np.unique(ids[valid] * max(len(uniques), 1) + codes)
+        group_of, code_of = np.divmod(pairs, max(len(uniques), 1))
+        starts = np.searchsorted(group_of, np.arange(count + 1))
+        members = [_python_value(v) for v in uniques[code_of]] if len(pairs) else []
+        return _object_array([members[starts[g]:starts[g + 1]] for g in range(count)])
+    raise UnsupportedPipeline(f"Unsupported accumulator {operator}")
+
+
+def _group_output(frame, ids, count, output):
+    columns = {}
+    for field, accumulator in output.items():
+        operator, argument = next(iter(accumulator.items()))
+        values = evaluate(argument, frame) if operator != "$count" else None
+        columns[field] = _accumulate(operator, values, ids, count, frame)
+    return columns
+
+
+def _id_keys(spec):
+    if isinstance(spec, dict) and spec and not next(iter(spec)).startswith("$"):
+        return [(f"_id.{key}", value) for key, value in spec.items()]
+    return [("_id", spec)]
+
+
+def _group(frame, spec):
+    id_fields = _id_keys(spec["_id"])
+    keys = []
+    for name, expression in id_fields:
+        if expression is None:
+            continue
+        keys.append(_as_array(evaluate(expression, frame), frame.n))
+    ids, count, key_values = _group_ids(keys, frame.n)
+    columns = {}
+    values = iter(key_values)
+    for name, expression in id_fields:
+        columns[name] = next(values) if expression is not None else _object_array([None] * count)
+    columns.update(_group_output(frame, ids, count, {k: v for k, v in spec.items() if k != "_id"}))
+    return Frame(columns, count)
+
+
+def _bucket(frame, spec):
+    values = _as_array(evaluate(spec["groupBy"], frame), frame.n)
+    boundaries = spec["boundaries"]
+    output = spec.get("output", {"count": {"$sum": 1}})
+    if all(isinstance(b, str) for b in boundaries):
+        comparable = values.dtype.kind == "U"
+        bounds = np.array(boundaries, dtype=str)
+    else:
+        comparable = _is_numeric(values)
+        bounds = np.array(boundaries, dtype=np.float64)
+    if comparable:
+        position = np.searchsorted(bounds, values, side="right") - 1
+        inside = (position >= 0) & (position < len(boundaries) - 1) & ~_is_null(values)
+    else:
+        position = np.zeros(frame.n, dtype=np.int64)
+        inside = np.zeros(frame.n, dtype=bool)
+    if (~inside).any() and "default" not in spec:
+        raise UnsupportedPipeline("$bucket value outside boundaries without default")
+    # Default bucket goes last, like the server does
+    ids = np.where(inside, position, len(boundaries) - 1)
+    present = np.unique(ids)
+    remap = np.full(len(boundaries), -1)
+    remap[present] = np.arange(len(present))
+    ids = remap[ids]
+    labels = [boundaries[i] if i < len(boundaries) - 1 else spec.get("default") for i in present]
+    columns = {"_id": _to_array(labels)}
+    columns.update(_group_output(frame, ids, len(present), output))
+    return Frame(columns, len(present))
+
+
+# ---------------------------------------------------------------- other stages
+
+def _sort_rank(values):
+    if values.dtype.kind == "f":
+        return np.where(np.isnan(values), -np.inf, values)
+    if values.dtype.kind in "biu":
+        return values.astype(np.int64)
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[ms]").astype(np.int64)
+    return _unique_inverse(values)[1].astype(np.float64)
+
+
+def _sort(frame, spec):
+    keys = []
+    for field, direction in reversed(list(spec.items())):
+        if not frame.has(field):
+            continue
+        rank = _sort_rank(_as_array(frame.get(field), frame.n)).astype(np.float64)
+        keys.append(rank if direction == 1 else -rank)
+    if not keys:
+        return frame
+    return frame.take(np.lexsort(keys))
+
+
+def _add_fields(frame, spec):
+    computed = [(field, evaluate(value, frame) if not _is_object_literal(value) else _evaluate_object(value, frame))
+                for field, value in spec.items()]
+    frame = Frame(frame.columns, frame.n)
+    for field, value in computed:
+        frame.set(field, value)
+    return frame
+
+
+def _is_object_literal(value):
+    return isinstance(value, dict) and value and not any(key.startswith("$") for key in value)
+
+
+def _evaluate_object(spec, frame):
+    return {key: _evaluate_object(value, frame) if _is_object_literal(value) else evaluate(value, frame)
+            for key, value in spec.items()}
+
+
+def _project(frame, spec):
+    include_id = spec.get("_id", 1) not in (0, False)
+    fields = {k: v for k, v in spec.items() if k != "_id"}
+    if fields and all(v in (0, False) for v in fields.values()):
+        columns = {name: column for name, column in frame.columns.items()
+                   if not any(name == f or name.startswith(f + ".") for f in fields)}
+        if not include_id:
+            columns = {name: column for name, column in columns.items() if not (name == "_id" or name.startswith("_id."))}
+        return Frame(columns, frame.n)
+
+    result = Frame({}, frame.n)
+    if include_id:
+        for name, column in frame.columns.items():
+            if name == "_id" or name.startswith("_id."):
+                result.columns[name] = column
+        if "_id" in spec and spec["_id"] not in (1, True):
+            result.set("_id", evaluate(spec["_id"], frame))
+    for field, value in fields.items():
+        if value in (1, True):
+            for name, column in frame.columns.items():
+                if name == field or name.startswith(field + "."):
+                    result.columns[name] = column
+            if not frame.has(field) and "." in field:
+                result.set(field, frame.get(field))
+        elif _is_object_literal(value):
+            result.set(field, _evaluate_object(value, frame))
+        else:
+            result.set(field, evaluate(value, frame))
+    return result
+
+
+def _unwind(frame, spec):
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec["path"][1:]
+    preserve = spec.get("preserveNullAndEmptyArrays", False)
+    lists = _as_array(frame.get(path), frame.n)
+    lengths = np.fromiter((len(v) if isinstance(v, list) else (0 if v is None else -1) for v in lists),
+                          dtype=np.int64, count=frame.n)
+    # Non-array values unwind to themselves
+    singles = lengths == -1
+    counts = np.where(singles, 1, lengths)
+    if preserve:
+        counts = np.maximum(counts, 1)
+    index = np.repeat(np.arange(frame.n), counts)
+    values = []
+    for value, n in zip(lists, counts):
+        if isinstance(value, list):
+            values.extend(value if value else [None] * n)
+        else:
+            values.extend([value] * n)
+    result = frame.take(index)
+    result.set(path, _to_array([_python_value(v) for v in values]))
+    return result
+
+
+def run_pipeline(frame, pipeline):
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            frame = frame.take(np.flatnonzero(match_mask(frame, spec)))
+        elif name in ("$addFields", "$set"):
+            frame = _add_fields(frame, spec)
+        elif name == "$project":
+            frame = _project(frame, spec)
+        elif name == "$unset":
+            fields = [spec] if isinstance(spec, str) else spec
+            frame = _project(frame, {field: 0 for field in fields})
+        elif name == "$group":
+            frame = _group(frame, spec)
+        elif name == "$bucket":
+            frame = _bucket(frame, spec)
+        elif name == "$sort":
+            frame = _sort(frame, spec)
+        elif name == "$limit":
+            frame = frame.take(np.arange(min(spec, frame.n)))
+        elif name == "$skip":
+            frame = frame.take(np.arange(min(spec, frame.n), frame.n))
+        elif name == "$unwind":
+            frame = _unwind(frame, spec)
+        elif name == "$count":
+            frame = Frame({spec: np.array([frame.n])}, 1) if frame.n else Frame({}, 0)
+        else:
+            raise UnsupportedPipeline(f"Unsupported stage {name}")
+    return frame
+
+
+# Run `pipeline` over a snapshot.Snapshot and return documents shaped like the server's output
+def aggregate(snapshot, pipeline):
+    return run_pipeline(frame_from_snapshot(snapshot), pipeline).to_documents()
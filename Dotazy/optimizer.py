@@ -0,0 +1,547 @@
+# optimizer.py - Rewrite passes for Dotazy aggregation pipelines
+#
+# pushdown  field-usage analysis from the last stage backwards (including
+#           $lookup let variables, $facet branches and window stages), then a
+#           minimal inclusion $project right after the leading $match, so the
+#           shards only carry and ship the fields later stages read
+# cse       common-subexpression elimination: an operator expression that a
+#           stage evaluates more than once is computed once in an $addFields
+#           placed before the stage and referenced as a field
+# dead      drops $addFields/$set, $project and $group fields no later stage reads
+# hll       replaces $addToSet fields only read through $size by HyperLogLog
+#           sketches with fixed memory per group (see hll.py)
+#
+# Passes are enabled in runner.py with OPTIMIZE=pushdown; OPTIMIZER_REPORT=1
+# measures their effect on the cluster.
+import copy
+import json
+import statistics
+
+import hll
+
+# Marker for "the whole document is needed" ($$ROOT, unknown stages, ...)
+ROOT = "$$ROOT"
+
+# Stages whose output shape does not depend on the input fields they do not read
+SHAPE_STAGES = {"$group", "$bucket", "$bucketAuto", "$sortByCount", "$count", "$project",
+                "$replaceRoot", "$replaceWith", "$facet"}
+
+
+def _root(path):
+    return path.split(".")[0]
+
+
+def _collect(expression, fields):
+    if isinstance(expression, str):
+        if expression.startswith("$$"):
+            variable, _, path = expression[2:].partition(".")
+            if variable in ("ROOT", "CURRENT"):
+                fields.add(_root(path) if path else ROOT)
+        elif expression.startswith("$"):
+            fields.add(_root(expression[1:]))
+    elif isinstance(expression, dict):
+        for key, value in expression.items():
+            if key != "$literal":
+                _collect(value, fields)
+    elif isinstance(expression, list):
+        for item in expression:
+            _collect(item, fields)
+
+
+# Top-level fields of the current document an expression reads
+def expression_fields(expression):
+    fields = set()
+    _collect(expression, fields)
+    return fields
+
+
+# Top-level fields a $match query reads
+def query_fields(query):
+    fields = set()
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            for clause in value:
+                fields |= query_fields(clause)
+        elif key == "$expr":
+            _collect(value, fields)
+        elif key in ("$where", "$jsonSchema"):
+            fields.add(ROOT)
+        elif not key.startswith("$"):
+            fields.add(_root(key))
+    return fields
+
+
+def _union(needed, fields):
+    if needed is None or ROOT in fields:
+        return None
+    return needed | fields
+
+
+def _without(needed, produced):
+    if needed is None:
+        return None
+    return needed - {field for field in produced if "." not in field}
+
+
+def _shape(fields):
+    return None if ROOT in fields else fields
+
+
+# Whether a $project value includes the input path itself ({"a": 1} or {"a": {"b": 1}})
+# rather than computing a new value
+def _includes_path(value):
+    if isinstance(value, dict) and not any(key.startswith("$") for key in value):
+        return any(_includes_path(item) for item in value.values())
+    return not isinstance(value, (dict, list, str)) and value not in (0, False)
+
+
+def _is_inclusion(projection):
+    return any(value not in (0, False) for field, value in projection.items() if field != "_id")
+
+
+def _project_needs(spec, needed):
+    if not _is_inclusion(spec):
+        return _without(needed, [field for field in spec])
+    fields = set() if spec.get("_id", 1) in (0, False) else {"_id"}
+    for field, value in spec.items():
+        if value in (0, False):
+            continue
+        if _includes_path(value):
+            fields.add(_root(field))
+        fields |= expression_fields(value)
+    return _shape(fields)
+
+
+# Fields needed from a stage's input given the fields needed from its output
+# (None = the whole document)
+def needed_before(stage, needed):
+    name, spec = next(iter(stage.items()))
+    if name == "$match":
+        return _union(needed, query_fields(spec))
+    if name in ("$limit", "$skip", "$sample", "$unionWith"):
+        return needed
+    if name == "$sort":
+        return _union(needed, {_root(field) for field in spec})
+    if name in ("$addFields", "$set"):
+        return _union(_without(needed, spec), expression_fields(list(spec.values())))
+    if name == "$unset":
+        return _without(needed, [spec] if isinstance(spec, str) else spec)
+    if name == "$unwind":
+        path = spec if isinstance(spec, str) else spec["path"]
+        produced = [spec["includeArrayIndex"]] if isinstance(spec, dict) and "includeArrayIndex" in spec else []
+        return _union(_without(needed, produced), expression_fields(path))
+    if name == "$lookup":
+        fields = expression_fields(spec.get("let", {}))
+        if "localField" in spec:
+            fields.add(_root(spec["localField"]))
+        return _union(_without(needed, [spec["as"]]), fields)
+    if name == "$graphLookup":
+        return _union(_without(needed, [spec["as"]]), expression_fields(spec["startWith"]))
+    if name == "$setWindowFields":
+        fields = expression_fields([spec.get("partitionBy"), list(spec["output"].values())])
+        fields |= {_root(field) for field in spec.get("sortBy", {})}
+        return _union(_without(needed, spec["output"]), fields)
+    if name == "$densify":
+        return _union(needed, {_root(field) for field in [spec["field"]] + spec.get("partitionByFields", [])})
+    if name == "$fill":
+        fields = expression_fields(spec.get("partitionBy"))
+        fields |= {_root(field) for field in list(spec.get("partitionByFields", [])) + list(spec.get("sortBy", {}))}
+        fields |= {_root(field) for field in spec["output"]}
+        return _union(needed, fields)
+    if name == "$group":
+        return _shape(expression_fields(list(spec.values())))
+    if name in ("$bucket", "$bucketAuto"):
+        return _shape(expression_fields([spec["groupBy"], spec.get("output", {})]))
+    if name == "$sortByCount":
+        return _shape(expression_fields(spec))
+    if name == "$count":
+        return set()
+    if name == "$replaceRoot":
+        return _shape(expression_fields(spec["newRoot"]))
+    if name == "$replaceWith":
+        return _shape(expression_fields(spec))
+    if name == "$project":
+        return _project_needs(spec, needed)
+    if name == "$facet":
+        fields = set()
+        for branch in spec.values():
+            branch_fields = required_fields(branch)
+            if branch_fields is None:
+                return None
+            fields |= branch_fields
+        return fields
+    # $redact, $out, $merge, $geoNear, ... may touch anything
+    return None
+
+
+# Top-level input fields a pipeline reads, None when it needs whole documents
+def required_fields(pipeline):
+    needed = None
+    for stage in reversed(pipeline):
+        needed = needed_before(stage, needed)
+    return needed
+
+
+# Where the pushed-down $project goes and what it keeps, (None, None) when it would not help
+def pushdown_point(pipeline):
+    position = 1 if pipeline and "$match" in pipeline[0] else 0
+    if position < len(pipeline) and next(iter(pipeline[position])) in SHAPE_STAGES:
+        # The server's own dependency analysis already trims the input of these
+        return None, None
+    needed = required_fields(pipeline[position:])
+    if needed is None:
+        return None, None
+    if not needed:
+        # e.g. a bare $count, keep documents as small as possible
+        return position, {"_id": 1}
+    projection = {field: 1 for field in sorted(needed)}
+    if "_id" not in needed:
+        projection["_id"] = 0
+    return position, projection
+
+
+def pushdown_projection(pipeline):
+    pipeline = copy.deepcopy(pipeline)
+    position, projection = pushdown_point(pipeline)
+    if projection is not None:
+        pipeline.insert(position, {"$project": projection})
+    return pipeline
+
+
+def _is_operator(expression):
+    return isinstance(expression, dict) and len(expression) == 1 and next(iter(expression)).startswith("$")
+
+
+# Whether an expression reads a variable ($$this, $$point, let variables, ...),
+# such expressions cannot leave the scope that binds the variable
+def _uses_variables(expression):
+    if isinstance(expression, str):
+        return expression.startswith("$$") and expression[2:].partition(".")[0] not in ("ROOT", "CURRENT")
+    if isinstance(expression, dict):
+        return any(_uses_variables(value) for key, value in expression.items() if key != "$literal")
+    if isinstance(expression, list):
+        return any(_uses_variables(item) for item in expression)
+    return False
+
+
+# Operands of an operator with whether they are only evaluated conditionally
+def _operands(operator, value):
+    if operator == "$cond":
+        operands = value if isinstance(value, list) else [value.get("if"), value.get("then"), value.get("else")]
+        return [(operand, i > 0) for i, operand in enumerate(operands)]
+    if operator == "$switch":
+        operands = []
+        for i, branch in enumerate(value.get("branches", [])):
+            operands += [(branch.get("case"), i > 0), (branch.get("then"), True)]
+        if "default" in value:
+            operands.append((value["default"], True))
+        return operands
+    if operator in ("$ifNull", "$and", "$or") and isinstance(value, list):
+        return [(operand, i > 0) for i, operand in enumerate(value)]
+    if operator in ("$filter", "$map", "$reduce") and isinstance(value, dict):
+        return [(operand, key not in ("input", "initialValue")) for key, operand in value.items()]
+    return [(value, False)]
+
+
+# Collect (subexpression, conditional) for every operator expression without variables
+def _walk(expression, conditional, found):
+    if isinstance(expression, list):
+        for item in expression:
+            _walk(item, conditional, found)
+    elif _is_operator(expression):
+        operator, value = next(iter(expression.items()))
+        if operator == "$literal":
+            return
+        if not _uses_variables(expression):
+            found.append((expression, conditional))
+        for operand, operand_conditional in _operands(operator, value):
+            _walk(operand, conditional or operand_conditional, found)
+    elif isinstance(expression, dict):
+        for value in expression.values():
+            _walk(value, conditional, found)
+
+
+def _map_accumulator(accumulator, function):
+    operator, argument = next(iter(accumulator.items()))
+    return {operator: function(argument)}
+
+
+# Apply `function` to every per-document expression of a stage
+def _map_expressions(stage, function):
+    name, spec = next(iter(stage.items()))
+    if name in ("$addFields", "$set"):
+        return {name: {field: function(value) for field, value in spec.items()}}
+    if name == "$project":
+        return {name: {field: value if value in (0, False) or _includes_path(value) else function(value)
+                       for field, value in spec.items()}}
+    if name == "$group":
+        return {name: {field: function(value) if field == "_id" else _map_accumulator(value, function)
+                       for field, value in spec.items()}}
+    if name == "$bucket":
+        spec = dict(spec, groupBy=function(spec["groupBy"]))
+        if "output" in spec:
+            spec["output"] = {field: _map_accumulator(value, function) for field, value in spec["output"].items()}
+        return {name: spec}
+    return stage
+
+
+def _replace(expression, target, reference):
+    if expression == target:
+        return reference
+    if isinstance(expression, list):
+        return [_replace(item, target, reference) for item in expression]
+    if isinstance(expression, dict):
+        return {key: value if key == "$literal" else _replace(value, target, reference)
+                for key, value in expression.items()}
+    return expression
+
+
+def _operator_count(expression):
+    if isinstance(expression, list):
+        return sum(_operator_count(item) for item in expression)
+    if isinstance(expression, dict):
+        return int(_is_operator(expression)) + sum(_operator_count(value) for value in expression.values())
+    return 0
+
+
+# The repeated subexpression to hoist next: the largest one that occurs at least
+# twice and is evaluated unconditionally at least once (hoisting must not make a
+# guarded expression, e.g. a $divide behind a $cond, run where it did not before)
+def _repeated_subexpression(stage):
+    found = []
+    _map_expressions(stage, lambda expression: _walk(expression, False, found))
+    occurrences = {}
+    for expression, conditional in found:
+        key = json.dumps(expression, default=str)
+        entry = occurrences.setdefault(key, [expression, 0, False])
+        entry[1] += 1
+        entry[2] = entry[2] or not conditional
+    # An extra $addFields is not free, a single cheap operator repeated once is left alone
+    candidates = [(len(key), expression) for key, (expression, count, unconditional) in occurrences.items()
+                  if count >= 2 and unconditional and (count - 1) * _operator_count(expression) >= 2]
+    return max(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+
+# Hoist the repeated subexpressions of one stage; returns the new stage, the
+# $addFields stages to run before it and the temporary fields to drop after it
+def _hoist_stage(stage, reserved):
+    name = next(iter(stage))
+    hoisted = []
+    temporary = []
+    while True:
+        expression = _repeated_subexpression(stage)
+        if expression is None:
+            break
+        field = None
+        if name in ("$addFields", "$set"):
+            spec = stage[name]
+            read = expression_fields(list(spec.values()))
+            # Reuse a field the stage defines as exactly this expression (date_obj, month, ...)
+            field = next((f for f, value in spec.items()
+                          if value == expression and "." not in f and f not in read), None)
+        if field is None:
+            field = next(f"_cse{i}" for i in range(len(reserved) + 1) if f"_cse{i}" not in reserved)
+            temporary.append(field)
+        else:
+            stage = {name: {f: value for f, value in stage[name].items() if f != field}}
+        reserved.add(field)
+        hoisted.append((field, expression))
+        stage = _map_expressions(stage, lambda e: _replace(e, expression, f"${field}"))
+
+    # Independent hoisted expressions share an $addFields, dependent ones follow it
+    before = []
+    for field, expression in hoisted:
+        if not before or expression_fields(expression) & set(before[-1]["$addFields"]):
+            before.append({"$addFields": {}})
+        before[-1]["$addFields"][field] = expression
+    if name in ("$group", "$bucket") or (name == "$project" and _is_inclusion(stage[name])):
+        # The stage drops the temporary fields itself
+        temporary = []
+    return stage, before, temporary, hoisted
+
+
+def _hoist(pipeline):
+    reserved = set()
+    _collect_names(pipeline, reserved)
+    result = []
+    hoisted = []
+    for stage in copy.deepcopy(pipeline):
+        stage, before, temporary, stage_hoisted = _hoist_stage(stage, reserved)
+        result.extend(before)
+        if next(iter(stage.values())):
+            result.append(stage)
+        if temporary:
+            result.append({"$unset": temporary})
+        hoisted.extend(stage_hoisted)
+    return result, hoisted
+
+
+# Every field name used anywhere in the pipeline, so temporary names never clash
+def _collect_names(expression, names):
+    if isinstance(expression, dict):
+        for key, value in expression.items():
+            names.add(_root(key))
+            _collect_names(value, names)
+    elif isinstance(expression, list):
+        for item in expression:
+            _collect_names(item, names)
+    elif isinstance(expression, str) and expression.startswith("$"):
+        names.add(_root(expression.lstrip("$")))
+
+
+def hoist_common_subexpressions(pipeline):
+    return _hoist(pipeline)[0]
+
+
+# Fields a stage defines that are candidates for removal
+def _defined_fields(stage):
+    name, spec = next(iter(stage.items()))
+    if name in ("$addFields", "$set", "$group"):
+        return [field for field in spec if field != "_id" and "." not in field]
+    if name == "$project" and _is_inclusion(spec):
+        return [field for field, value in spec.items() if field != "_id" and "." not in field
+                and value not in (0, False)]
+    return []
+
+
+def _eliminate(pipeline):
+    pipeline = copy.deepcopy(pipeline)
+    removed = []
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(pipeline) - 1, -1, -1):
+            fields = _defined_fields(pipeline[i])
+            if not fields:
+                continue
+            needed = required_fields(pipeline[i + 1:])
+            if needed is None:
+                continue
+            dead = [field for field in fields if field not in needed]
+            name, spec = next(iter(pipeline[i].items()))
+            if name == "$project" and len(dead) == len(fields):
+                # An inclusion $project needs at least one field, or it turns into an exclusion
+                dead = dead[1:]
+            if not dead:
+                continue
+            for field in dead:
+                del spec[field]
+            removed.extend(f"{name} {field}" for field in dead)
+            if not spec and name in ("$addFields", "$set"):
+                del pipeline[i]
+            changed = True
+    return pipeline, removed
+
+
+def eliminate_dead_fields(pipeline):
+    return _eliminate(pipeline)[0]
+
+
+PASSES = {
+    "pushdown": pushdown_projection,
+    "cse": hoist_common_subexpressions,
+    "dead": eliminate_dead_fields,
+    "hll": hll.sketch_distinct_counts,
+}
+
+
+def optimize(pipeline, passes):
+    for name in passes:
+        if name not in PASSES:
+            raise ValueError(f"Unknown optimizer pass: {name}")
+        pipeline = PASSES[name](pipeline)
+    return pipeline
+
+
+# Number and total BSON size of the documents a pipeline (prefix) produces
+def transfer_bytes(collection, pipeline):
+    totals = list(collection.aggregate(pipeline + [{"$group": {
+        "_id": None,
+        "documents": {"$sum": 1},
+        "bytes": {"$sum": {"$bsonSize": "$$ROOT"}},
+    }}], comment="optimizer"))
+    if not totals:
+        return 0, 0
+    return totals[0]["documents"], totals[0]["bytes"]
+
+
+# Bytes leaving the pushdown point without and with the projection
+def pushdown_report(collection, pipeline):
+    position, projection = pushdown_point(pipeline)
+    if projection is None:
+        return ["pushdown: no projection inserted (needs whole documents or already trimmed by the server)"]
+    documents, before = transfer_bytes(collection, pipeline[:position])
+    _, after = transfer_bytes(collection, pipeline[:position] + [{"$project": projection}])
+    saved = (1 - after / before) * 100 if before else 0.0
+    return [f"pushdown: keeps {', '.join(field for field, keep in projection.items() if keep)}; "
+            f"{documents} documents, {before / 1024:.1f} KB -> {after / 1024:.1f} KB after stage {position} "
+            f"(-{saved:.0f}%)"]
+
+
+def _execution_times(explain, times):
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key in ("executionTimeMillisEstimate", "executionTimeMillis") and isinstance(value, (int, float)):
+                times.append(value)
+            else:
+                _execution_times(value, times)
+    elif isinstance(explain, list):
+        for item in explain:
+            _execution_times(item, times)
+
+
+# Execution time of a pipeline from explain("executionStats"), summed over the
+# shards. Stage estimates are cumulative, so the largest one of a shard is the
+# time of its whole part of the pipeline.
+def explain_millis(collection, pipeline):
+    explain = collection.database.command(
+        "explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+        verbosity="executionStats", comment="optimizer")
+    parts = explain["shards"].values() if "shards" in explain else [explain]
+    total = 0
+    for part in parts:
+        times = []
+        _execution_times(part, times)
+        total += max(times, default=0)
+    return total
+
+
+EXPLAIN_REPEAT = 5
+
+
+def _explain_report(name, collection, before, after, changes):
+    if not changes:
+        return [f"{name}: nothing to rewrite"]
+    old = statistics.median(explain_millis(collection, before) for _ in range(EXPLAIN_REPEAT))
+    new = statistics.median(explain_millis(collection, after) for _ in range(EXPLAIN_REPEAT))
+    return [f"{name}: {'; '.join(changes)}",
+            f"{name}: explain executionStats {old:.0f} ms -> {new:.0f} ms summed over shards "
+            f"(median of {EXPLAIN_REPEAT})"]
+
+
+def cse_report(collection, pipeline):
+    optimized, hoisted = _hoist(pipeline)
+    changes = [f"{field} = {json.dumps(expression, default=str)}" for field, expression in hoisted]
+    return _explain_report("cse", collection, pipeline, optimized, changes)
+
+
+def dead_report(collection, pipeline):
+    optimized, removed = _eliminate(pipeline)
+    return _explain_report("dead", collection, pipeline, optimized, [f"removed {field}" for field in removed])
+
+
+REPORTS = {
+    "pushdown": pushdown_report,
+    "cse": cse_report,
+    "dead": dead_report,
+}
+
+
+# Report lines for every pass that has a report, each pass on the output of the previous ones
+def report(collection, pipeline, passes):
+    lines = []
+    for name in passes:
+        if name in REPORTS:
+            lines.extend(REPORTS[name](collection, pipeline))
+        pipeline = PASSES[name](pipeline)
+    return lines
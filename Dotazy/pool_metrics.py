@@ -0,0 +1,194 @@
+# pool_metrics.py - Connection pool metrics collected from pymongo CMAP events
+import json
+import threading
+import time
+
+from pymongo import monitoring
+
+# Upper bounds (in seconds) of the wait-queue time histogram buckets
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+
+# Counters for the connection pool of a single mongos
+class _PoolStats:
+    def __init__(self):
+        self.created_at = time.monotonic()
+        self.pool_size = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.checkouts = 0
+        self.checkout_failures = {}
+        self.pool_cleared = 0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds):
+        index = len(WAIT_BUCKETS)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if seconds <= bound:
+                index = i
+                break
+        self.wait_buckets[index] += 1
+        self.wait_sum += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self):
+        elapsed = max(time.monotonic() - self.created_at, 1e-9)
+        waits = sum(self.wait_buckets)
+        histogram = {}
+        cumulative = 0
+        for bound, count in zip(WAIT_BUCKETS + ["+Inf"], self.wait_buckets):
+            cumulative += count
+            histogram[str(bound)] = cumulative
+        return {
+            "pool_size": self.pool_size,
+            "checked_out": self.checked_out,
+            "max_checked_out": self.max_checked_out,
+            "connections_created": self.connections_created,
+            "connections_closed": self.connections_closed,
+            "connection_creation_rate_per_s": round(self.connections_created / elapsed, 3),
+            "checkouts": self.checkouts,
+            "checkout_failures": dict(self.checkout_failures),
+            "pool_cleared": self.pool_cleared,
+            "wait_queue_seconds": {
+                "count": waits,
+                "sum": round(self.wait_sum, 6),
+                "avg": round(self.wait_sum / waits, 6) if waits else 0.0,
+                "max": round(self.wait_max, 6),
+                "buckets": histogram,
+            },
+        }
+
+
+# CMAP listener keeping per-mongos pool statistics
+# Register it with MongoClient(event_listeners=[...]) and read snapshot()
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+        # Check-out start times keyed by (address, thread), the driver
+        # emits "started" and "checked out" on the thread that waits
+        self._waiting = {}
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def _stats(self, address):
+        key = f"{address[0]}:{address[1]}"
+        stats = self._pools.get(key)
+        if stats is None:
+            stats = self._pools[key] = _PoolStats()
+        return stats
+
+    def _finish_wait(self, address):
+        started = self._waiting.pop((address, threading.get_ident()), None)
+        if started is None:
+            return None
+        return time.monotonic() - started
+
+    def pool_created(self, event):
+        with self._lock:
+            self._stats(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._stats(event.address).pool_cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.connections_created += 1
+            stats.pool_size += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.connections_closed += 1
+            stats.pool_size = max(stats.pool_size - 1, 0)
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self._waiting[(event.address, threading.get_ident())] = time.monotonic()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.checkout_failures[event.reason] = stats.checkout_failures.get(event.reason, 0) + 1
+            waited = self._finish_wait(event.address)
+            if waited is not None:
+                stats.record_wait(waited)
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.checkouts += 1
+            stats.checked_out += 1
+            stats.max_checked_out = max(stats.max_checked_out, stats.checked_out)
+            waited = self._finish_wait(event.address)
+            if waited is not None:
+                stats.record_wait(waited)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.checked_out = max(stats.checked_out - 1, 0)
+
+    # Current statistics of every pool, keyed by "host:port" of the mongos
+    def snapshot(self):
+        with self._lock:
+            return {address: stats.as_dict() for address, stats in self._pools.items()}
+
+    # Short human readable summary, one line per mongos
+    def format_report(self):
+        lines = []
+        for address, stats in sorted(self.snapshot().items()):
+            wait = stats["wait_queue_seconds"]
+            failures = sum(stats["checkout_failures"].values())
+            lines.append(
+                f"{address}: pool={stats['pool_size']} checked_out={stats['checked_out']} "
+                f"(max {stats['max_checked_out']}) created={stats['connections_created']} "
+                f"({stats['connection_creation_rate_per_s']}/s) checkouts={stats['checkouts']} "
+                f"failures={failures} wait avg={wait['avg'] * 1000:.2f}ms max={wait['max'] * 1000:.2f}ms"
+            )
+        return "\n".join(lines) if lines else "No connection pools created yet."
+
+    # Append a JSON snapshot to `path` every `interval` seconds (stdout when path is None)
+    def start_reporter(self, interval, path=None):
+        if self._reporter is not None:
+            return
+        self._stop.clear()
+
+        def report():
+            while not self._stop.wait(interval):
+                self.dump(path)
+
+        self._reporter = threading.Thread(target=report, name="pool-metrics-reporter", daemon=True)
+        self._reporter.start()
+
+    def stop_reporter(self, path=None):
+        if self._reporter is None:
+            return
+        self._stop.set()
+        self._reporter.join()
+        self._reporter = None
+        # Final snapshot so short runs still leave a record
+        self.dump(path)
+
+    def dump(self, path=None):
+        line = json.dumps({"timestamp": time.time(), "pools": self.snapshot()})
+        if path is None:
+            print(line, flush=True)
+        else:
+            with open(path, "a") as f:
+                f.write(line + "\n")
@@ -0,0 +1,174 @@
+# profile_shards.py - Per-shard execution profile of the Dotazy queries
+#
+#   python profile_shards.py                     profile the whole suite once
+#   python profile_shards.py q9 q11 --repeat 3
+#   python profile_shards.py --wait 600          profile whatever runs in the next 10 minutes
+#
+# Enables the database profiler of weatherDB on every shard primary (level 1,
+# every operation slower than --slowms, a --sample-rate share of them), runs
+# the queries through the routers and then reads system.profile from each
+# primary directly (see runner.member_client). The runner tags every
+# aggregate with the comment "q<N>", mongos passes it on to the shards and
+# their getMores carry it in originatingCommand, so each profile entry maps
+# back to its query. The previous profiler settings are restored afterwards.
+#
+# The report gives, per query and shard, the operations, their execution and
+# planning time, documents and keys examined, yields and documents returned,
+# next to the median time the query took through mongos. The shard with the
+# most execution time is the straggler the router timing hides.
+import argparse
+import re
+import statistics
+import time
+from collections import defaultdict
+
+from bson import json_util
+
+import registry
+from run import select_queries, timed_run
+from runner import db, member_client, shard_members
+
+COMMENT = re.compile(r"^q\d+$")
+# Summed fields of a profile entry
+FIELDS = {
+    "ms": "millis",
+    "plan_ms": "planningTimeMicros",
+    "docs": "docsExamined",
+    "keys": "keysExamined",
+    "yields": "numYield",
+    "returned": "nreturned",
+}
+
+
+# (shard, host, client) of every shard primary
+def primaries():
+    hosts = []
+    for shard, members in shard_members().items():
+        for host in members:
+            client = member_client(host)
+            if client.admin.command("hello").get("isWritablePrimary"):
+                hosts.append((shard, host, client))
+            else:
+                client.close()
+    return hosts
+
+
+# Enable the profiler, returns the previous settings
+def enable_profiler(database, slowms, sample_rate, profile_mb):
+    previous = database.command("profile", -1)
+    if profile_mb:
+        # system.profile can only be replaced while the profiler is off
+        database.command("profile", 0)
+        database.drop_collection("system.profile")
+        database.create_collection("system.profile", capped=True, size=profile_mb * 1024 * 1024)
+    database.command("profile", 1, slowms=slowms, sampleRate=sample_rate)
+    return previous
+
+
+def restore_profiler(database, previous):
+    database.command("profile", previous["was"], slowms=previous["slowms"],
+                     sampleRate=previous.get("sampleRate", 1.0))
+
+
+def _comment(entry):
+    for key in ("command", "originatingCommand"):
+        comment = entry.get(key, {}).get("comment")
+        if isinstance(comment, str) and COMMENT.match(comment):
+            return comment
+    return None
+
+
+# Profile entries of the tagged queries since `since`
+def harvest(database, since):
+    query = {"ts": {"$gte": since},
+             "$or": [{"command.comment": COMMENT}, {"originatingCommand.comment": COMMENT}]}
+    return list(database["system.profile"].find(query))
+
+
+# {query: {shard: {"ops", "ms", "plan_ms", ...}}}
+def summarize(entries_by_shard):
+    report = defaultdict(lambda: defaultdict(lambda: dict.fromkeys(["ops", *FIELDS], 0)))
+    for shard, entries in entries_by_shard.items():
+        for entry in entries:
+            comment = _comment(entry)
+            if comment is None:
+                continue
+            totals = report[comment][shard]
+            totals["ops"] += 1
+            for name, field in FIELDS.items():
+                totals[name] += entry.get(field, 0)
+    for shards in report.values():
+        for totals in shards.values():
+            totals["plan_ms"] /= 1000
+    return report
+
+
+def run_suite(queries, repeat):
+    timings = defaultdict(list)
+    for _ in range(repeat):
+        for query in queries:
+            seconds, rows = timed_run(query, {})
+            timings[f"q{query.id}"].append(seconds * 1000)
+            print(f"q{query.id}: {rows} rows in {seconds * 1000:.1f} ms", flush=True)
+    return {comment: statistics.median(times) for comment, times in timings.items()}
+
+
+def print_report(report, router_ms):
+    print(f"\n{'query':>6} {'shard':<12} {'ops':>5} {'exec ms':>9} {'plan ms':>8} {'docs':>9} "
+          f"{'keys':>9} {'yields':>7} {'returned':>9}")
+    for comment in sorted(report, key=lambda name: int(name[1:])):
+        shards = report[comment]
+        for shard, totals in sorted(shards.items()):
+            print(f"{comment:>6} {shard:<12} {totals['ops']:5d} {totals['ms']:9.0f} {totals['plan_ms']:8.1f} "
+                  f"{totals['docs']:9d} {totals['keys']:9d} {totals['yields']:7d} {totals['returned']:9d}")
+        slowest = max(shards, key=lambda shard: shards[shard]["ms"])
+        fastest = min(shard["ms"] for shard in shards.values())
+        mongos = f", {router_ms[comment]:.0f} ms through mongos" if comment in router_ms else ""
+        print(f"{'':>6} straggler {slowest} ({shards[slowest]['ms']:.0f} ms, fastest shard {fastest:.0f} ms)"
+              f"{mongos}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the Dotazy queries on every shard primary")
+    parser.add_argument("queries", nargs="*", help="query ids (q9 or 9) or 'all'")
+    parser.add_argument("--cost", choices=registry.COST_CLASSES, help="only queries of this cost class")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each query")
+    parser.add_argument("--wait", type=float, help="do not run queries, profile for this many seconds")
+    parser.add_argument("--slowms", type=int, default=0, help="profile operations slower than this")
+    parser.add_argument("--sample-rate", type=float, default=1.0, help="share of those operations profiled")
+    parser.add_argument("--profile-mb", type=int, help="recreate system.profile with this size")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    members = primaries()
+    print(f"Profiling {db.name} on {', '.join(f'{shard} ({host})' for shard, host, _ in members)}")
+    previous = {}
+    entries = {}
+    router_ms = {}
+    try:
+        for shard, _, client in members:
+            previous[shard] = enable_profiler(client[db.name], args.slowms, args.sample_rate, args.profile_mb)
+        # Profile timestamps come from the shards, read the start from one of them
+        since = members[0][2].admin.command("hello")["localTime"]
+        if args.wait:
+            time.sleep(args.wait)
+        else:
+            router_ms = run_suite(select_queries(args.queries, args.cost), args.repeat)
+        for shard, _, client in members:
+            entries[shard] = harvest(client[db.name], since)
+    finally:
+        for shard, _, client in members:
+            if shard in previous:
+                restore_profiler(client[db.name], previous[shard])
+            client.close()
+
+    print(f"Harvested {sum(len(found) for found in entries.values())} profile entries")
+    report = summarize(entries)
+    print_report(report, router_ms)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json_util.dumps({"shards": report, "router_ms": router_ms}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
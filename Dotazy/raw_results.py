@@ -0,0 +1,93 @@
+# raw_results.py - Query results as undecoded BSON
+#
+# RAW_RESULTS modes of the runner:
+#   documents  the cursor returns RawBSONDocuments. They keep the reply bytes
+#              and only decode a field when it is read
+#   batches    aggregate_raw_batches returns every reply batch as one bytes
+#              object. Documents are only located by their length prefixes
+#              and wrapped in a RawBSONDocument when they are accessed
+# Either way printing the first five results decodes just those five, and
+# write_bson() copies the batches into a .bson file (the format of mongodump
+# and bsondump) without decoding anything.
+import struct
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+RAW_MODES = ("documents", "batches")
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+BATCH_SIZE = 10000
+
+
+# Start offsets of the documents in a batch of concatenated BSON documents
+def document_offsets(batch):
+    offsets = []
+    offset = 0
+    while offset < len(batch):
+        offsets.append(offset)
+        # Every BSON document starts with its length as a little-endian int32
+        offset += struct.unpack_from("<i", batch, offset)[0]
+    return offsets
+
+
+# Read-only sequence over raw batches, a document is sliced out when accessed
+class RawBatches:
+    def __init__(self, batches):
+        self.batches = []
+        self.offsets = []
+        for batch in batches:
+            offsets = document_offsets(batch)
+            if offsets:
+                self.batches.append(batch)
+                self.offsets.append(offsets + [len(batch)])
+        self._count = sum(len(offsets) - 1 for offsets in self.offsets)
+
+    def __len__(self):
+        return self._count
+
+    def _document(self, batch, position):
+        offsets = self.offsets[batch]
+        return RawBSONDocument(self.batches[batch][offsets[position]:offsets[position + 1]])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        for batch, offsets in enumerate(self.offsets):
+            if index < len(offsets) - 1:
+                return self._document(batch, index)
+            index -= len(offsets) - 1
+
+    def __iter__(self):
+        for batch, offsets in enumerate(self.offsets):
+            for position in range(len(offsets) - 1):
+                yield self._document(batch, position)
+
+
+def aggregate(collection, pipeline, mode="documents", comment=None):
+    if mode == "batches":
+        return RawBatches(collection.aggregate_raw_batches(pipeline, comment=comment))
+    if mode == "documents":
+        return list(collection.with_options(codec_options=RAW_CODEC_OPTIONS).aggregate(pipeline, comment=comment))
+    raise ValueError(f"Unknown RAW_RESULTS mode: {mode}")
+
+
+# Plain dict of a result for printing, raw documents are decoded here
+def decoded(document):
+    if isinstance(document, RawBSONDocument):
+        return bson.decode(document.raw)
+    return document
+
+
+# Stream the results of a pipeline into a .bson file, returns the number of documents
+def write_bson(collection, pipeline, path, batch_size=BATCH_SIZE, comment=None):
+    total = 0
+    with open(path, "wb") as f:
+        for batch in collection.aggregate_raw_batches(pipeline, batchSize=batch_size, comment=comment):
+            f.write(batch)
+            total += len(document_offsets(batch))
+    return total
@@ -0,0 +1,142 @@
+# registry.py - Parameterized templates and metadata for the Dotazy queries
+#
+# The part files mark the values that can change with param("location",
+# "Prague") inside their pipeline literals. render() replaces the markers with
+# the given values or the defaults. The registry knows which part file defines
+# which query, so get("q9") imports only queries_part2. Every Query keeps the
+# pipelines it has rendered, one per parameter set, so repeated runs reuse the
+# same objects; callers must not modify them.
+import importlib
+import json
+
+# Query id -> part file that defines it
+PARTS = {
+    **{str(i): "queries_part1" for i in range(1, 9)},
+    **{str(i): "queries_part2" for i in range(9, 17)},
+    **{str(i): "queries_part3" for i in range(17, 23)},
+    **{str(i): "queries_part4a" for i in range(23, 27)},
+    **{str(i): "queries_part4b" for i in range(27, 29)},
+}
+
+# Stages that read other collections, fan out or reorder per partition
+HEAVY_STAGES = {"$lookup", "$graphLookup", "$unionWith", "$facet", "$setWindowFields", "$densify", "$fill"}
+MEDIUM_STAGES = {"$group", "$bucket", "$bucketAuto", "$sort", "$unwind"}
+COST_CLASSES = ("light", "medium", "heavy")
+
+
+# Placeholder for a parameter inside a pipeline template; `template` formats
+# the value, e.g. param("year", 2021, "^{}") for a date prefix regex
+class Param:
+    def __init__(self, name, default, template=None):
+        self.name = name
+        self.default = default
+        self.template = template
+
+    def value(self, values):
+        value = values.get(self.name, self.default)
+        return self.template.format(value) if self.template else value
+
+    def __repr__(self):
+        return f"param({self.name!r}, {self.default!r})"
+
+
+def param(name, default, template=None):
+    return Param(name, default, template)
+
+
+# Pipeline with every param() replaced by its value from `values` or its default
+def render(template, values=None):
+    values = values or {}
+    if isinstance(template, Param):
+        return template.value(values)
+    if isinstance(template, dict):
+        return {key: render(value, values) for key, value in template.items()}
+    if isinstance(template, list):
+        return [render(item, values) for item in template]
+    return template
+
+
+# Parameter names of a template with their defaults
+def parameters(template, found=None):
+    found = {} if found is None else found
+    if isinstance(template, Param):
+        found.setdefault(template.name, template.default)
+    elif isinstance(template, dict):
+        for value in template.values():
+            parameters(value, found)
+    elif isinstance(template, list):
+        for item in template:
+            parameters(item, found)
+    return found
+
+
+# Stage names of a pipeline, including $lookup subpipelines and $facet branches
+def stage_names(pipeline):
+    names = set()
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        names.add(name)
+        if name == "$lookup" and "pipeline" in spec:
+            names |= stage_names(spec["pipeline"])
+        elif name == "$unionWith" and isinstance(spec, dict) and "pipeline" in spec:
+            names |= stage_names(spec["pipeline"])
+        elif name == "$facet":
+            for branch in spec.values():
+                names |= stage_names(branch)
+    return names
+
+
+def cost_class(template):
+    names = stage_names(template)
+    if names & HEAVY_STAGES or '"$function"' in json.dumps(template, default=repr):
+        return "heavy"
+    if names & MEDIUM_STAGES:
+        return "medium"
+    return "light"
+
+
+class Query:
+    def __init__(self, query_id, collection, template):
+        self.id = query_id
+        self.collection = collection
+        self.template = template
+        self.parameters = parameters(template)
+        self.cost = cost_class(template)
+        self._pipelines = {}
+
+    # Rendered pipeline for the given parameter values, built once per value set
+    def pipeline(self, **values):
+        unknown = set(values) - set(self.parameters)
+        if unknown:
+            raise ValueError(f"q{self.id} has no parameter {', '.join(sorted(unknown))}")
+        key = json.dumps(sorted(values.items()), default=str)
+        pipeline = self._pipelines.get(key)
+        if pipeline is None:
+            pipeline = self._pipelines[key] = render(self.template, values)
+        return pipeline
+
+    def __repr__(self):
+        return f"Query(q{self.id}, {self.collection}, {self.cost}, {self.parameters})"
+
+
+_queries = {}
+
+
+def normalize_id(query_id):
+    return str(query_id).lower().lstrip("q")
+
+
+# The Query for an id such as "q9" or "9", importing only its part file
+def get(query_id):
+    query_id = normalize_id(query_id)
+    if query_id not in PARTS:
+        raise KeyError(f"Unknown query q{query_id}")
+    query = _queries.get(query_id)
+    if query is None:
+        collection, template = importlib.import_module(PARTS[query_id]).QUERIES[query_id]
+        query = _queries[query_id] = Query(query_id, collection, template)
+    return query
+
+
+def all_queries():
+    return [get(query_id) for query_id in PARTS]
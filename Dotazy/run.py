@@ -0,0 +1,158 @@
+# run.py - Run registered Dotazy queries from the command line
+#
+#   python run.py q9 --location Brno
+#   python run.py q9 --sweep location --parallel 8
+#   python run.py all --cost light --repeat 5 --parallel 4
+#   python run.py --list
+#
+# Options the CLI itself does not define (--location, --year, --hot-c, ...)
+# are query parameters, parsed as JSON when possible (numbers, lists). A
+# single plain run goes through execute_query and prints the results. With
+# --parallel, --repeat or --sweep every run is timed and summarized instead.
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import optimizer
+import registry
+from runner import OPTIMIZE, db, execute_query
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+# {"location": "Brno", "hot_c": 30} from ["--location", "Brno", "--hot-c=30"]
+def parse_parameters(arguments):
+    values = {}
+    i = 0
+    while i < len(arguments):
+        option = arguments[i]
+        if not option.startswith("--"):
+            raise SystemExit(f"Unexpected argument {option}")
+        name, _, value = option[2:].partition("=")
+        if not value:
+            if i + 1 >= len(arguments):
+                raise SystemExit(f"Missing value for {option}")
+            i += 1
+            value = arguments[i]
+        values[name.replace("-", "_")] = _parse_value(value)
+        i += 1
+    return values
+
+
+def select_queries(names, cost):
+    if not names or names == ["all"]:
+        queries = registry.all_queries()
+    else:
+        try:
+            queries = [registry.get(name) for name in names]
+        except KeyError as e:
+            raise SystemExit(e.args[0])
+    return [query for query in queries if cost is None or query.cost == cost]
+
+
+# Every value a parameter takes in the data (locations, years) unless given
+def sweep_values(query, name, given=None):
+    if given:
+        values = [_parse_value(value) for value in given.split(",")]
+    elif name in ("location", "locations"):
+        values = sorted(db[query.collection].distinct("location"))
+    elif name == "year":
+        values = sorted({int(date[:4]) for date in db[query.collection].distinct("date")})
+    else:
+        raise SystemExit(f"No known values for {name}, pass them with --values")
+    if isinstance(query.parameters[name], list):
+        values = [[value] for value in values]
+    return values
+
+
+def timed_run(query, values):
+    pipeline = query.pipeline(**values)
+    if OPTIMIZE:
+        pipeline = optimizer.optimize(pipeline, OPTIMIZE)
+    start = time.perf_counter()
+    rows = sum(1 for _ in db[query.collection].aggregate(pipeline, comment=f"q{query.id}"))
+    return time.perf_counter() - start, rows
+
+
+def _describe(values, empty="defaults"):
+    return " ".join(f"{name}={json.dumps(value)}" for name, value in values.items()) or empty
+
+
+def list_queries():
+    print(f"{'query':>6} {'collection':<16} {'cost':<7} parameters")
+    for query in registry.all_queries():
+        print(f"{'q' + query.id:>6} {query.collection:<16} {query.cost:<7} {_describe(query.parameters, '-')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Dotazy queries by id with parameters",
+                                     epilog="Any other --name value pair is passed to the queries as a parameter.")
+    parser.add_argument("queries", nargs="*", help="query ids (q9 or 9) or 'all'")
+    parser.add_argument("--list", action="store_true", help="list the queries, their cost class and parameters")
+    parser.add_argument("--cost", choices=registry.COST_CLASSES, help="only queries of this cost class")
+    parser.add_argument("--parallel", type=int, default=1, help="concurrent runs")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per query and parameter set")
+    parser.add_argument("--sweep", metavar="PARAMETER", help="run once for every value of a parameter")
+    parser.add_argument("--values", help="comma separated values for --sweep (default: taken from the data)")
+    args, extra = parser.parse_known_args()
+    values = parse_parameters(extra)
+
+    if args.list:
+        return list_queries()
+    queries = select_queries(args.queries, args.cost)
+    explicit = args.queries and args.queries != ["all"]
+
+    jobs = []
+    for query in queries:
+        if explicit:
+            query_values = dict(values)
+            unknown = set(query_values) - set(query.parameters)
+            if unknown:
+                raise SystemExit(f"q{query.id} has no parameter {', '.join(sorted(unknown))}")
+        else:
+            query_values = {name: value for name, value in values.items() if name in query.parameters}
+        if args.sweep:
+            if args.sweep not in query.parameters:
+                if explicit:
+                    raise SystemExit(f"q{query.id} has no parameter {args.sweep}")
+                continue
+            sets = [dict(query_values, **{args.sweep: value})
+                    for value in sweep_values(query, args.sweep, args.values)]
+        else:
+            sets = [query_values]
+        jobs += [(query, value_set) for value_set in sets for _ in range(args.repeat)]
+
+    if args.parallel == 1 and args.repeat == 1 and not args.sweep:
+        for query, query_values in jobs:
+            execute_query(query.id, query.collection, query.pipeline(**query_values))
+        return
+
+    timings = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+        futures = {pool.submit(timed_run, query, query_values): (query, query_values)
+                   for query, query_values in jobs}
+        for future in as_completed(futures):
+            query, query_values = futures[future]
+            seconds, rows = future.result()
+            timings.setdefault(query.id, []).append(seconds)
+            print(f"q{query.id} {_describe(query_values)}: {rows} rows in {seconds * 1000:.1f} ms", flush=True)
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{'query':>6} {'runs':>5} {'median ms':>10} {'max ms':>10}")
+    for query_id, seconds in timings.items():
+        print(f"{'q' + query_id:>6} {len(seconds):5d} {statistics.median(seconds) * 1000:10.1f} "
+              f"{max(seconds) * 1000:10.1f}")
+    print(f"{len(jobs)} runs in {elapsed:.2f}s with {args.parallel} in parallel "
+          f"({len(jobs) / elapsed:.1f} runs/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# service.py - Long-running HTTP service streaming Dotazy query results as NDJSON
+#
+#   GET /queries                          list of queries, their collections and parameters
+#   GET /queries/<id>?location=Brno&year=2021&limit=100
+#                                         results of one query, one JSON document per line
+#   GET /queries/<id>?format=bson         the raw BSON reply batches, concatenated documents
+#
+# Uses the warm, pooled client of runner.py, so a request costs one aggregate
+# instead of an interpreter start, a connection and an authentication.
+# Query string values fill the parameters of the query template (see
+# registry.py). location and year of queries without such a parameter are
+# applied as a $match in front of the pipeline.
+# Results are streamed from the cursor with chunked transfer encoding. With
+# format=bson the reply batches are forwarded to the socket undecoded.
+# At most SERVICE_MAX_CONCURRENCY queries run at the same time, and requests
+# that wait longer than SERVICE_QUEUE_TIMEOUT seconds for a slot get a 503.
+# Server-Timing headers report the queue wait and the time to the first batch,
+# and a trailer reports the total time.
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import bson
+from bson import json_util
+from pymongo.errors import PyMongoError
+
+import optimizer
+import registry
+from raw_results import document_offsets
+from runner import OPTIMIZE, db
+
+PORT = int(os.environ.get("SERVICE_PORT", "8080"))
+MAX_CONCURRENCY = int(os.environ.get("SERVICE_MAX_CONCURRENCY", "8"))
+QUEUE_TIMEOUT = float(os.environ.get("SERVICE_QUEUE_TIMEOUT", "10"))
+MAX_TIME_MS = int(os.environ.get("SERVICE_MAX_TIME_MS", "0"))
+# Documents per chunk written to the socket
+CHUNK_DOCUMENTS = 100
+FORMATS = {"ndjson": "application/x-ndjson", "bson": "application/bson"}
+
+QUERIES = {query.id: query for query in registry.all_queries()}
+_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+
+# $match for the request parameters, None when there are none
+def parameter_filter(params):
+    query = {}
+    if "location" in params:
+        query["location"] = params["location"]
+    if "year" in params:
+        year = int(params["year"])
+        query["date"] = {"$gte": f"{year:04d}-01-01", "$lt": f"{year + 1:04d}-01-01"}
+    return {"$match": query} if query else None
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def build_pipeline(query_id, params):
+    query = QUERIES[query_id]
+    values = {name: _parse_value(value) for name, value in params.items() if name in query.parameters}
+    unknown = set(params) - set(values) - {"location", "year", "limit"}
+    if unknown:
+        raise ValueError(f"q{query_id} has no parameter {', '.join(sorted(unknown))}")
+    # The rendered pipeline is shared between requests, copy before changing it
+    pipeline = list(query.pipeline(**values))
+    match = parameter_filter({name: value for name, value in params.items() if name not in values})
+    if match:
+        pipeline.insert(0, match)
+    if "limit" in params:
+        pipeline.append({"$limit": int(params["limit"])})
+    if OPTIMIZE:
+        pipeline = optimizer.optimize(pipeline, OPTIMIZE)
+    return query.collection, pipeline
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # Chunked transfer encoding needs HTTP/1.1
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+        if parts == ["queries"]:
+            listing = {query_id: {"collection": query.collection, "cost": query.cost, "parameters": query.parameters}
+                       for query_id, query in QUERIES.items()}
+            return self.send_json(200, listing)
+        if len(parts) == 2 and parts[0] == "queries":
+            query_id = registry.normalize_id(parts[1])
+            if query_id not in QUERIES:
+                return self.send_json(404, {"error": f"Unknown query {parts[1]}"})
+            result_format = params.pop("format", "ndjson")
+            if result_format not in FORMATS:
+                return self.send_json(400, {"error": f"Unknown format {result_format}"})
+            try:
+                collection_name, pipeline = build_pipeline(query_id, params)
+            except ValueError as e:
+                return self.send_json(400, {"error": str(e)})
+            return self.stream_query(query_id, collection_name, pipeline, result_format)
+        return self.send_json(404, {"error": "Not found"})
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def stream_query(self, query_id, collection_name, pipeline, result_format="ndjson"):
+        start = time.perf_counter()
+        if not _slots.acquire(timeout=QUEUE_TIMEOUT):
+            return self.send_json(503, {"error": "Too many concurrent queries"}, {"Retry-After": "1"})
+        try:
+            queued = time.perf_counter() - start
+            options = {"comment": f"q{query_id}"}
+            if MAX_TIME_MS:
+                options["maxTimeMS"] = MAX_TIME_MS
+            try:
+                # aggregate() runs the command and returns the first batch
+                if result_format == "bson":
+                    cursor = db[collection_name].aggregate_raw_batches(pipeline, **options)
+                else:
+                    cursor = db[collection_name].aggregate(pipeline, **options)
+            except PyMongoError as e:
+                return self.send_json(500, {"error": str(e)})
+            first_batch = time.perf_counter() - start - queued
+
+            self.send_response(200)
+            self.send_header("Content-Type", FORMATS[result_format])
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Server-Timing",
+                             f"queue;dur={queued * 1000:.1f}, db;desc=\"first batch\";dur={first_batch * 1000:.1f}")
+            self.send_header("Trailer", "Server-Timing")
+            self.end_headers()
+
+            count = 0
+            lines = []
+            try:
+                if result_format == "bson":
+                    for batch in cursor:
+                        count += len(document_offsets(batch))
+                        self.write_chunk(batch)
+                else:
+                    for document in cursor:
+                        lines.append(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS))
+                        count += 1
+                        if len(lines) == CHUNK_DOCUMENTS:
+                            self.write_chunk(("\n".join(lines) + "\n").encode())
+                            lines = []
+            except PyMongoError as e:
+                # The status line is already sent, report the error in the stream
+                if result_format == "bson":
+                    self.write_chunk(bson.encode({"error": str(e)}))
+                else:
+                    lines.append(json.dumps({"error": str(e)}))
+            finally:
+                cursor.close()
+            if lines:
+                self.write_chunk(("\n".join(lines) + "\n").encode())
+            total = time.perf_counter() - start
+            self.wfile.write(f"0\r\nServer-Timing: total;dur={total * 1000:.1f}, "
+                             f"rows;desc=\"{count}\"\r\n\r\n".encode())
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away, the cursor is closed above
+            pass
+        finally:
+            _slots.release()
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}", flush=True)
+
+
+def main():
+    server = ThreadingHTTPServer(("0.0.0.0", PORT), QueryHandler)
+    print(f"Serving {len(QUERIES)} queries on http://0.0.0.0:{PORT}/queries "
+          f"(max {MAX_CONCURRENCY} concurrent)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
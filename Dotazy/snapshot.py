@@ -0,0 +1,204 @@
+# snapshot.py - Columnar, memory-mapped snapshots of the weather collections
+#
+# Layout of a snapshot directory (one subdirectory per collection):
+#   <collection>/meta.json     row count, column kinds/dtypes, dictionaries, location index
+#   <collection>/<field>.npy   one contiguous array per field, loaded with mmap_mode="r"
+# Numeric fields are float64/int64 arrays, strings are dictionary encoded into
+# small integer codes (-1 = missing) and dates are int64 days since 1970-01-01.
+# Rows are sorted by (location, date) so a location/date range is a slice.
+import argparse
+import json
+import os
+
+import numpy as np
+
+COLLECTIONS = {
+    "globalClimate": "global_climate.json",
+    "usWeatherEvents": "us_weather_events.json",
+    "weatherHistory": "weather_history.json",
+}
+NUMERIC_FIELDS = ["temperature_c", "humidity_percent", "wind_speed_kmh", "precipitation_mm"]
+DICTIONARY_FIELDS = ["location", "event_type", "station_id", "description"]
+DATE_FIELDS = ["date"]
+
+
+def _code_dtype(size):
+    if size < 2 ** 7:
+        return np.int8
+    if size < 2 ** 15:
+        return np.int16
+    return np.int32
+
+
+def _numeric_column(values):
+    present = [v for v in values if v is not None]
+    if present and all(isinstance(v, int) and not isinstance(v, bool) for v in present) and len(present) == len(values):
+        return np.array(values, dtype=np.int64)
+    return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+
+
+def _dictionary_column(values):
+    # Sorted dictionary, so code order is string order and sorting by code sorts by value
+    dictionary = sorted({v for v in values if v is not None})
+    lookup = {value: code for code, value in enumerate(dictionary)}
+    codes = np.array([lookup.get(v, -1) if v is not None else -1 for v in values],
+                     dtype=_code_dtype(len(dictionary)))
+    return codes, dictionary
+
+
+def _date_column(values):
+    return np.array(["NaT" if v is None else v[:10] for v in values], dtype="datetime64[D]").astype(np.int64)
+
+
+# Write `documents` of one collection as a columnar snapshot into `directory`
+def export_collection(documents, directory):
+    fields = {name: [] for name in NUMERIC_FIELDS + DICTIONARY_FIELDS + DATE_FIELDS}
+    rows = 0
+    for document in documents:
+        for name, column in fields.items():
+            value = document.get(name)
+            if name in NUMERIC_FIELDS and isinstance(value, str):
+                # Same coercion as the data loader
+                value = float(value) if value.strip() else None
+            column.append(value)
+        rows += 1
+
+    columns = {}
+    meta = {"rows": rows, "columns": {}, "dictionaries": {}, "sorted_by": ["location", "date"]}
+    for name in NUMERIC_FIELDS:
+        columns[name] = _numeric_column(fields[name])
+        meta["columns"][name] = {"kind": "numeric"}
+    for name in DICTIONARY_FIELDS:
+        if all(v is None for v in fields[name]):
+            continue
+        columns[name], meta["dictionaries"][name] = _dictionary_column(fields[name])
+        meta["columns"][name] = {"kind": "dictionary"}
+    for name in DATE_FIELDS:
+        columns[name] = _date_column(fields[name])
+        meta["columns"][name] = {"kind": "date"}
+
+    order = np.lexsort((columns["date"], columns["location"]))
+    os.makedirs(directory, exist_ok=True)
+    for name, column in columns.items():
+        column = np.ascontiguousarray(column[order])
+        columns[name] = column
+        meta["columns"][name]["dtype"] = column.dtype.str
+        np.save(os.path.join(directory, f"{name}.npy"), column, allow_pickle=False)
+
+    # Row range [start, end) of every location code
+    boundaries = np.searchsorted(columns["location"], np.arange(len(meta["dictionaries"]["location"]) + 1))
+    meta["location_index"] = {
+        location: [int(boundaries[code]), int(boundaries[code + 1])]
+        for code, location in enumerate(meta["dictionaries"]["location"])
+    }
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return rows
+
+
+# Read-only view of a snapshot, every column is a zero-copy memory-mapped array
+class Snapshot:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.rows = self.meta["rows"]
+        self.dictionaries = self.meta["dictionaries"]
+        self.columns = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in self.meta["columns"]
+        }
+        self._codes = {field: {value: code for code, value in enumerate(values)}
+                       for field, values in self.dictionaries.items()}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.rows
+
+    # Integer code of a dictionary encoded value, -1 when the value does not occur
+    def code(self, field, value):
+        return self._codes[field].get(value, -1)
+
+    # Decode dictionary codes (or date days) back into Python values
+    def decode(self, field, values):
+        kind = self.meta["columns"][field]["kind"]
+        if kind == "dictionary":
+            dictionary = np.array(self.dictionaries[field] + [None], dtype=object)
+            return dictionary[np.asarray(values)]
+        if kind == "date":
+            return np.datetime_as_string(np.asarray(values).astype("datetime64[D]"))
+        return np.asarray(values)
+
+    # Row range of one location, or of a date range ("YYYY-MM-DD", end exclusive) within it
+    def location_range(self, location, start_date=None, end_date=None):
+        start, end = self.meta["location_index"].get(location, (0, 0))
+        if start_date is None and end_date is None:
+            return start, end
+        dates = self.columns["date"][start:end]
+        lo = 0 if start_date is None else np.searchsorted(dates, to_days(start_date), side="left")
+        hi = len(dates) if end_date is None else np.searchsorted(dates, to_days(end_date), side="left")
+        return start + int(lo), start + int(hi)
+
+    # Column views (no copies) for a location/date range
+    def slice(self, location, start_date=None, end_date=None):
+        start, end = self.location_range(location, start_date, end_date)
+        return {name: column[start:end] for name, column in self.columns.items()}
+
+    # Rebuild documents (with decoded strings and dates) for rows [start, end)
+    def to_documents(self, start=0, end=None):
+        end = self.rows if end is None else end
+        decoded = {name: self.decode(name, column[start:end]) for name, column in self.columns.items()}
+        documents = []
+        for i in range(end - start):
+            document = {}
+            for name, values in decoded.items():
+                value = values[i]
+                if value is None or (isinstance(value, float) and np.isnan(value)):
+                    continue
+                document[name] = value.item() if hasattr(value, "item") else value
+            documents.append(document)
+        return documents
+
+
+def to_days(date):
+    return np.datetime64(date[:10], "D").astype(np.int64)
+
+
+# Open every collection of a snapshot directory
+def open_snapshot(directory):
+    return {
+        name: Snapshot(os.path.join(directory, name))
+        for name in COLLECTIONS
+        if os.path.exists(os.path.join(directory, name, "meta.json"))
+    }
+
+
+def _documents_from_file(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the weather collections into a columnar snapshot")
+    parser.add_argument("--out", default="snapshot", help="snapshot directory")
+    parser.add_argument("--from-files", metavar="DATA_DIR",
+                        help="read the JSON data files instead of the cluster (e.g. ../Data)")
+    parser.add_argument("--collections", nargs="*", default=list(COLLECTIONS))
+    args = parser.parse_args()
+
+    for name in args.collections:
+        if args.from_files:
+            documents = _documents_from_file(os.path.join(args.from_files, COLLECTIONS[name]))
+        else:
+            from runner import db
+            projection = {field: 1 for field in NUMERIC_FIELDS + DICTIONARY_FIELDS + DATE_FIELDS}
+            projection["_id"] = 0
+            documents = db[name].find({}, projection, batch_size=10000, comment="snapshot")
+        rows = export_collection(documents, os.path.join(args.out, name))
+        print(f"Exported {rows} documents from {name} to {os.path.join(args.out, name)}")
+
+
+if __name__ == "__main__":
+    main()
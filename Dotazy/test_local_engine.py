@@ -0,0 +1,73 @@
+# test_local_engine.py - local_engine against hand-computed results on a small frame
+#
+#   python -m pytest test_local_engine.py
+import numpy as np
+import pytest
+
+import registry
+from local_engine import frame_from_documents, match_mask, run_pipeline
+
+CLIMATE = [
+    {"location": "Prague", "event_type": "Rain", "temperature_c": 10.0, "precipitation_mm": 4.0},
+    {"location": "Prague", "event_type": "Rain", "temperature_c": 14.0, "precipitation_mm": 2.0},
+    {"location": "Prague", "event_type": "Snow", "temperature_c": -3.0, "precipitation_mm": 1.0},
+    {"location": "Brno", "event_type": "Rain", "temperature_c": 20.0, "precipitation_mm": 1.0},
+    {"location": "Brno", "event_type": "Rain", "temperature_c": 22.0, "precipitation_mm": 3.0},
+    {"location": "Brno", "temperature_c": 40.0, "precipitation_mm": 0.0},
+]
+
+
+def run(query_id, documents):
+    return run_pipeline(frame_from_documents(documents), registry.get(query_id).pipeline()).to_documents()
+
+
+def test_q1_averages_per_location_and_event_type():
+    # Prague/Snow has a single event and the Brno row without event_type is skipped
+    assert run("q1", CLIMATE) == [
+        {"location": "Brno", "event_type": "Rain", "avg_temperature_c": 21.0,
+         "avg_precipitation_mm": 2.0, "event_count": 2},
+        {"location": "Prague", "event_type": "Rain", "avg_temperature_c": 12.0,
+         "avg_precipitation_mm": 3.0, "event_count": 2},
+    ]
+
+
+def test_q8_flags_values_beyond_one_and_a_half_sigma():
+    temperatures = [10.0, 10.0, 10.0, 10.0, 20.0]
+    history = [{"location": "Prague", "station_id": f"S{i}", "date": f"2021-01-0{i + 1}",
+                "temperature_c": value, "humidity_percent": 50, "wind_speed_kmh": 5.0}
+               for i, value in enumerate(temperatures)]
+    # Too few records to be analyzed
+    history += [{"location": "Brno", "station_id": "B", "date": "2021-01-01", "temperature_c": 1.0,
+                 "humidity_percent": 50, "wind_speed_kmh": 5.0}]
+    # Mean 12, population standard deviation 4, thresholds 12 +- 6
+    [result] = run("q8", history)
+    assert result["location"] == "Prague"
+    assert result["avg_temperature_c"] == 12.0
+    assert result["std_dev_temperature"] == 4.0
+    assert (result["temperature_threshold_low"], result["temperature_threshold_high"]) == (6.0, 18.0)
+    assert result["record_count"] == 5
+    assert result["anomaly_count"] == 1
+    assert result["anomaly_percentage"] == 20.0
+    assert [point["station_id"] for point in result["temperature_anomalies"]] == ["S4"]
+
+
+@pytest.mark.parametrize("condition, expected", [
+    ({"$ne": "Hail"}, [True, True]),
+    ({"$nin": ["Hail", "Rain"]}, [True, True]),
+    ({"$exists": False}, [True, True]),
+    (None, [True, True]),
+    ({"$in": [None]}, [True, True]),
+    ("Hail", [False, False]),
+    ({"$exists": True}, [False, False]),
+    ({"$gt": 0}, [False, False]),
+])
+def test_missing_field_matches_like_null(condition, expected):
+    frame = frame_from_documents([{"location": "Prague"}, {"location": "Brno"}])
+    assert match_mask(frame, {"severity": condition}).tolist() == expected
+
+
+def test_prefix_regex_honours_options():
+    frame = frame_from_documents([{"location": name} for name in ["Prague", "prague", "Brno"]])
+    assert match_mask(frame, {"location": {"$regex": "^Pra"}}).tolist() == [True, False, False]
+    assert match_mask(frame, {"location": {"$regex": "^Pra", "$options": "i"}}).tolist() == [True, True, False]
+    assert np.count_nonzero(match_mask(frame, {"location": {"$regex": "^PRA", "$options": "i"}})) == 2
@@ -0,0 +1,144 @@
+# test_timeseries.py - The kernels against plain row-by-row reference loops
+#
+#   python -m pytest test_timeseries.py
+import datetime
+
+import numpy as np
+import pytest
+
+from timeseries import calendar, densify, derivative, ewma, linear_fill, locf, rolling_count, rolling_mean, rolling_sum
+
+# Partitions of daily(): rows 0-3, 4, 5-10 and 11-14
+STARTS = np.array([0, 4, 5, 11])
+
+
+# s_t = alpha * x_t + (1 - alpha) * s_(t-1) row by row, NaN carried forward
+def reference_ewma(values, starts, alpha):
+    ends = list(starts[1:]) + [len(values)]
+    result = np.full(len(values), np.nan)
+    for start, end in zip(starts, ends):
+        state = last = np.nan
+        for i in range(start, end):
+            if not np.isnan(values[i]):
+                last = values[i]
+            if np.isnan(last):
+                continue
+            state = last if np.isnan(state) else alpha * last + (1 - alpha) * state
+            result[i] = state
+    return result
+
+
+def series(n=300, seed=1):
+    values = np.random.default_rng(seed).normal(10, 5, n)
+    values[[5, 6, 100, 201]] = np.nan
+    return values
+
+
+@pytest.mark.parametrize("block", [1, 7, 64, 1000])
+def test_leading_nan_seeds_from_first_value(block):
+    values = series()
+    values[[0, 150, 151]] = np.nan
+    starts = np.array([0, 150])
+    result = ewma(values, starts, 0.3, block)
+    np.testing.assert_allclose(result, reference_ewma(values, starts, 0.3), equal_nan=True)
+    assert np.isnan(result).sum() == 3
+
+
+def test_alpha_one_keeps_the_values():
+    values = np.array([1.0, 2.0, np.nan, 4.0])
+    np.testing.assert_allclose(ewma(values, np.array([0]), 1.0), [1.0, 2.0, 2.0, 4.0])
+
+
+@pytest.mark.parametrize("alpha", [0.99999, 1 - 1e-12, 0.5, 1e-6])
+def test_extreme_alpha_does_not_overflow(alpha):
+    values = series()
+    starts = np.array([0, 120])
+    result = ewma(values, starts, alpha)
+    assert np.isfinite(result).all()
+    np.testing.assert_allclose(result, reference_ewma(values, starts, alpha), rtol=1e-9)
+
+
+def partitions(starts, n):
+    return zip(starts, list(starts[1:]) + [n])
+
+
+# Rows of three partitions with gaps, repeated days and a one-row partition
+def daily(seed=2):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(10, 5, 15)
+    values[[1, 4, 5, 6, 10, 14]] = np.nan
+    days = np.array([0, 1, 3, 7, 2, 10, 12, 12, 13, 20, 21, 40, 41, 43, 60]) + 18000
+    return values, days
+
+
+@pytest.mark.parametrize("before, after", [(0, 0), (2, 0), (1, 2), (20, 20)])
+def test_rolling_windows_match_reference(before, after):
+    values, _ = daily()
+    sums, counts, means = (np.full(len(values), np.nan) for _ in range(3))
+    for start, end in partitions(STARTS, len(values)):
+        for i in range(start, end):
+            window = values[max(i - before, start):min(i + after + 1, end)]
+            window = window[~np.isnan(window)]
+            sums[i], counts[i] = window.sum(), len(window)
+            means[i] = window.mean() if len(window) else np.nan
+    np.testing.assert_allclose(rolling_sum(values, STARTS, before, after), sums)
+    np.testing.assert_array_equal(rolling_count(values, STARTS, before, after), counts)
+    np.testing.assert_allclose(rolling_mean(values, STARTS, before, after), means, equal_nan=True)
+
+
+def test_derivative_per_day_within_partitions():
+    values, days = daily()
+    expected = np.full(len(values), np.nan)
+    for start, end in partitions(STARTS, len(values)):
+        for i in range(start + 1, end):
+            if days[i] != days[i - 1]:
+                expected[i] = (values[i] - values[i - 1]) / (days[i] - days[i - 1])
+    np.testing.assert_allclose(derivative(values, days, STARTS), expected, equal_nan=True)
+
+
+def test_locf_and_linear_fill_stay_in_their_partition():
+    values, days = daily()
+    carried, interpolated = values.copy(), values.copy()
+    for start, end in partitions(STARTS, len(values)):
+        last = None
+        for i in range(start, end):
+            if not np.isnan(values[i]):
+                last = i
+            elif last is not None:
+                carried[i] = values[last]
+                following = next((j for j in range(i + 1, end) if not np.isnan(values[j])), None)
+                if following is not None:
+                    share = (days[i] - days[last]) / (days[following] - days[last])
+                    interpolated[i] = values[last] + (values[following] - values[last]) * share
+    np.testing.assert_allclose(locf(values, STARTS), carried, equal_nan=True)
+    np.testing.assert_allclose(linear_fill(values, days, STARTS), interpolated, equal_nan=True)
+
+
+def test_calendar_days_and_months():
+    days = np.array([18000, 18003, 18010, 18100])
+    starts = np.array([0, 2])
+    partition, points = calendar(days, starts)
+    assert partition.tolist() == [0] * 4 + [1] * 91
+    assert points.tolist() == list(range(18000, 18004)) + list(range(18010, 18101))
+    partition, points = calendar(days, starts, full=True)
+    assert partition.tolist() == [0] * 101 + [1] * 101
+    month_starts = [datetime.date(2019, month, 1) for month in range(4, 8)]
+    partition, points = calendar(days, starts, step="month")
+    # 18000 is 2019-04-14, 18100 is 2019-07-23
+    assert partition.tolist() == [0, 1, 1, 1, 1]
+    expected = [(month - datetime.date(1970, 1, 1)).days for month in month_starts]
+    assert points.tolist() == [expected[0]] + expected
+
+
+def test_densify_averages_slots_and_flags_gaps():
+    values = np.array([1.0, 3.0, np.nan, 5.0, 7.0])
+    days = np.array([100, 100, 101, 103, 200])
+    starts = np.array([0, 4])
+    dense = densify(values, days, starts)
+    assert dense["days"].tolist() == [100, 101, 102, 103, 200]
+    assert dense["partition"].tolist() == [0, 0, 0, 0, 1]
+    assert dense["starts"].tolist() == [0, 4]
+    np.testing.assert_allclose(dense["values"], [2.0, np.nan, np.nan, 5.0, 7.0], equal_nan=True)
+    # Day 101 was observed, only without a value
+    assert dense["filled"].tolist() == [False, False, True, False, False]
+    np.testing.assert_allclose(locf(dense["values"], dense["starts"]), [2.0, 2.0, 2.0, 5.0, 7.0])
@@ -0,0 +1,252 @@
+# timeseries.py - Vectorized per-location time-series kernels (windows, gap filling, smoothing)
+#
+# All kernels work on arrays sorted by (location, date) and a `starts` array
+# with the first row of every partition (location), as produced by
+# partition_starts() or snapshot_partitions(). Windows and fills never cross
+# partition boundaries. Dates are int64 days since 1970-01-01, missing values
+# are NaN. They are the client-side counterparts of $window/$setWindowFields
+# (Q9, Q13), $densify + $fill (Q11), $linearFill (Q25) and the exponential
+# smoothing of Q27.
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# First row of every run of equal keys in a sorted key array
+def partition_starts(keys):
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1)).astype(np.int64)
+
+
+# Partition starts of a snapshot.Snapshot, which is sorted by (location, date)
+def snapshot_partitions(snapshot):
+    starts = sorted(start for start, end in snapshot.meta["location_index"].values() if end > start)
+    return np.array(starts, dtype=np.int64)
+
+
+# Start and end (exclusive) of the partition of every row
+def _row_bounds(starts, n):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.append(starts[1:], n)
+    lengths = ends - starts
+    return np.repeat(starts, lengths), np.repeat(ends, lengths)
+
+
+def _window_sums(values, starts, before, after):
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    row_start, row_end = _row_bounds(starts, n)
+    index = np.arange(n)
+    lo = np.maximum(index - before, row_start)
+    hi = np.minimum(index + after + 1, row_end)
+    return sums[hi] - sums[lo], counts[hi] - counts[lo]
+
+
+# Mean over the document window [-before, +after] ("documents": [-before, after])
+def rolling_mean(values, starts, before, after=0):
+    sums, counts = _window_sums(values, starts, before, after)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+# Sum over the document window [-before, +after]
+def rolling_sum(values, starts, before, after=0):
+    return _window_sums(values, starts, before, after)[0]
+
+
+# Number of non-missing values in the document window [-before, +after]
+def rolling_count(values, starts, before, after=0):
+    return _window_sums(values, starts, before, after)[1]
+
+
+# Change per day between consecutive rows ($derivative with unit "day" over
+# the documents window [-1, 0]); NaN for the first row of a partition and for
+# rows with the same date as the previous one
+def derivative(values, days, starts):
+    values = np.asarray(values, dtype=np.float64)
+    days = np.asarray(days, dtype=np.int64)
+    result = np.full(len(values), np.nan)
+    if len(values) < 2:
+        return result
+    delta_days = np.diff(days).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = np.diff(values) / np.where(delta_days == 0, np.nan, delta_days)
+    result[1:] = slope
+    result[np.asarray(starts, dtype=np.int64)] = np.nan
+    return result
+
+
+# Index of the last non-missing row at or before every row within its partition (-1 = none)
+def _previous_valid(values, starts):
+    n = len(values)
+    index = np.where(~np.isnan(values), np.arange(n), -1)
+    index = np.maximum.accumulate(index) if n else index
+    row_start, _ = _row_bounds(starts, n)
+    return np.where(index >= row_start, index, -1)
+
+
+def _next_valid(values, starts):
+    n = len(values)
+    index = np.where(~np.isnan(values), np.arange(n), n)
+    index = np.minimum.accumulate(index[::-1])[::-1] if n else index
+    _, row_end = _row_bounds(starts, n)
+    return np.where(index < row_end, index, -1)
+
+
+# Last observation carried forward within each partition ($fill method "locf")
+def locf(values, starts):
+    values = np.asarray(values, dtype=np.float64)
+    previous = _previous_valid(values, starts)
+    return np.where(previous >= 0, values[np.maximum(previous, 0)], np.nan)
+
+
+# Linear interpolation of missing values against the day axis ($linearFill);
+# leading and trailing gaps of a partition stay missing
+def linear_fill(values, days, starts):
+    values = np.asarray(values, dtype=np.float64)
+    days = np.asarray(days, dtype=np.float64)
+    previous = _previous_valid(values, starts)
+    following = _next_valid(values, starts)
+    gap = np.isnan(values) & (previous >= 0) & (following >= 0)
+    p, f = np.maximum(previous, 0), np.maximum(following, 0)
+    span = days[f] - days[p]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(span > 0, (days - days[p]) / span, 0.0)
+    filled = values[p] + (values[f] - values[p]) * weight
+    return np.where(gap, filled, values)
+
+
+# Exponentially weighted moving average s_t = alpha * x_t + (1 - alpha) * s_(t-1),
+# starting from the first value of every partition ($expMovingAvg with alpha).
+# Missing values are carried forward first; leading missing values stay
+# missing and the first value seeds the average. Evaluated in blocks with the
+# closed form, short enough that the powers of (1 - alpha) never underflow.
+def ewma(values, starts, alpha, block=64):
+    values = locf(values, starts)
+    n = len(values)
+    decay = 1.0 - alpha
+    if decay == 0:
+        # alpha = 1 keeps every value as it is
+        return values
+    if decay < 1:
+        # decay^block stays above 1e-150, so x / decay^k cannot overflow
+        block = max(1, min(block, int(np.log(1e-150) / np.log(decay))))
+    result = np.full(n, np.nan)
+    powers = decay ** np.arange(block + 1)
+    boundaries = np.union1d(np.asarray(starts, dtype=np.int64), np.arange(0, n, block))
+    boundaries = np.append(boundaries, n)
+    partition_start = set(np.asarray(starts, dtype=np.int64).tolist())
+    state = np.nan
+    for lo, hi in zip(boundaries[:-1], boundaries[1:]):
+        if lo in partition_start:
+            state = np.nan
+        if np.isnan(state):
+            valid = np.flatnonzero(~np.isnan(values[lo:hi]))
+            if len(valid) == 0:
+                continue
+            lo += valid[0]
+            state = values[lo]
+        x = values[lo:hi]
+        length = hi - lo
+        # s_t = decay^(t+1) * state + alpha * sum_k decay^(t-k) * x_k
+        weights = powers[:length]
+        scaled = np.cumsum(x / weights) * weights
+        result[lo:hi] = powers[1:length + 1] * state + alpha * scaled
+        state = result[hi - 1]
+    return result
+
+
+# Regular calendar between each partition's first and last day (or global
+# bounds with full=True, like $densify "bounds": "full"); step is "day" or
+# "month". Returns the partition id and day of every calendar row.
+def calendar(days, starts, step="day", full=False):
+    days = np.asarray(days, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.append(starts[1:], len(days))
+    unit = "D" if step == "day" else "M"
+    firsts = days[starts].astype("datetime64[D]").astype(f"datetime64[{unit}]")
+    lasts = days[ends - 1].astype("datetime64[D]").astype(f"datetime64[{unit}]")
+    if full:
+        firsts = np.full_like(firsts, firsts.min())
+        lasts = np.full_like(lasts, lasts.max())
+    lengths = (lasts - firsts).astype(np.int64) + 1
+    partition = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    points = np.repeat(firsts, lengths) + offsets.astype(f"timedelta64[{unit}]")
+    return partition, points.astype("datetime64[D]").astype(np.int64)
+
+
+# Place observations on a regular calendar. Every calendar slot takes the
+# mean of the observations that fall into it; slots without observations are
+# NaN and flagged in `filled` so locf()/linear_fill() can fill them (Q11/Q25).
+def densify(values, days, starts, step="day", full=False):
+    values = np.asarray(values, dtype=np.float64)
+    days = np.asarray(days, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    partition, slots = calendar(days, starts, step, full)
+    lengths = np.bincount(partition, minlength=len(starts))
+    slot_starts = np.cumsum(lengths) - lengths
+    row_partition = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(days))))
+    unit = "D" if step == "day" else "M"
+    as_unit = lambda d: d.astype("datetime64[D]").astype(f"datetime64[{unit}]").astype(np.int64)
+    first_slot = as_unit(slots[slot_starts])
+    position = slot_starts[row_partition] + as_unit(days) - first_slot[row_partition]
+    valid = ~np.isnan(values)
+    sums = np.bincount(position[valid], weights=values[valid], minlength=len(slots))
+    counts = np.bincount(position[valid], minlength=len(slots))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dense = np.where(counts > 0, sums / counts, np.nan)
+    observed = np.bincount(position, minlength=len(slots)) > 0
+    return {
+        "partition": partition,
+        "days": slots,
+        "values": dense,
+        "filled": ~observed,
+        "starts": slot_starts.astype(np.int64),
+    }
+
+
+# Run a kernel on contiguous groups of partitions in parallel threads (NumPy
+# releases the GIL inside the kernels) and concatenate the results.
+# `arrays` are the row-aligned inputs, passed positionally before `starts`.
+def parallel(kernel, arrays, starts, *args, workers=4, **kwargs):
+    starts = np.asarray(starts, dtype=np.int64)
+    n = len(arrays[0])
+    if workers <= 1 or len(starts) <= 1:
+        return kernel(*arrays, starts, *args, **kwargs)
+    chunks = np.array_split(np.arange(len(starts)), min(workers, len(starts)))
+
+    def run(chunk):
+        lo = starts[chunk[0]]
+        hi = starts[chunk[-1] + 1] if chunk[-1] + 1 < len(starts) else n
+        return kernel(*[a[lo:hi] for a in arrays], starts[chunk] - lo, *args, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        return np.concatenate(list(pool.map(run, chunks)))
+
+
+# Stream (location, date) sorted rows of a collection into kernel inputs:
+# returns the numeric columns, int64 days, location per row and partition starts
+def load_series(db, collection_name, fields, match=None, batch_size=10000):
+    pipeline = [{"$match": match or {}},
+                {"$sort": {"location": 1, "date": 1}},
+                {"$project": {"_id": 0, "location": 1, "date": 1, **{field: 1 for field in fields}}}]
+    locations, dates = [], []
+    columns = {field: [] for field in fields}
+    for document in db[collection_name].aggregate(pipeline, batchSize=batch_size, allowDiskUse=True):
+        locations.append(document["location"])
+        dates.append(document["date"][:10])
+        for field in fields:
+            value = document.get(field)
+            columns[field].append(np.nan if value is None else value)
+    locations = np.array(locations, dtype=str)
+    series = {field: np.array(values, dtype=np.float64) for field, values in columns.items()}
+    series["days"] = np.array(dates, dtype="datetime64[D]").astype(np.int64)
+    series["location"] = locations
+    series["starts"] = partition_starts(locations)
+    return series
@@ -0,0 +1,221 @@
+# warmup.py - Warm the shards' plan caches and indexes, and measure cold versus warm runs
+#
+#   python warmup.py                       warm every registered query
+#   python warmup.py --cost heavy q9 q11   warm some of them
+#   python warmup.py --benchmark           first-run versus steady-state latency per query
+#
+# Warming runs each query WARM_RUNS times through the routers with its default
+# parameters (every location with --all-locations). The first run creates an
+# inactive plan cache entry on every shard primary and the second activates it.
+# $lookup subpipelines are planned on the shards while the query runs, so
+# they are warmed too. Then every index the winning plans and the $lookup
+# subpipelines use is scanned once so that its pages are in the WiredTiger
+# cache. With --secondaries, or when the runner reads from secondaries, the
+# same is done directly on every shard secondary (see runner.member_client).
+# $merge and $out stages are dropped, so warming never writes.
+#
+# --benchmark clears the plan caches of the collections a query reads, runs it
+# once (first run) and then --repeat times (steady state). planCacheClear does
+# not evict the WiredTiger cache: right after a cluster restart use
+# --no-clear to measure truly cold first runs.
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ReadPreference
+from pymongo.errors import PyMongoError
+
+import optimizer
+import registry
+from run import select_queries, sweep_values
+from runner import db, member_client, shard_members
+
+# Runs per query and parameter set: the second run activates the cache entry
+WARM_RUNS = 2
+WRITE_STAGES = ("$merge", "$out")
+
+
+def read_only(pipeline):
+    return [stage for stage in pipeline if next(iter(stage)) not in WRITE_STAGES]
+
+
+# (from collection, fields its subpipeline matches on) for every $lookup,
+# including nested ones and those inside $facet branches
+def lookups(pipeline):
+    found = []
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == "$lookup":
+            fields = {spec["foreignField"]} if "foreignField" in spec else set()
+            for inner in spec.get("pipeline", []):
+                if "$match" in inner:
+                    fields |= optimizer.query_fields(inner["$match"])
+            found.append((spec["from"], fields))
+            found += lookups(spec.get("pipeline", []))
+        elif name == "$facet":
+            for branch in spec.values():
+                found += lookups(branch)
+    return found
+
+
+def _index_names(explain, names):
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "indexName":
+                names.add(value)
+            else:
+                _index_names(value, names)
+    elif isinstance(explain, list):
+        for item in explain:
+            _index_names(item, names)
+
+
+# {collection: {index name, ...}} a query reads through
+def needed_indexes(query, pipeline):
+    explain = db.command("explain", {"aggregate": query.collection, "pipeline": pipeline, "cursor": {}},
+                         verbosity="queryPlanner", comment="warmup")
+    names = set()
+    _index_names(explain, names)
+    needed = {query.collection: names}
+    for collection, fields in lookups(pipeline):
+        for name, info in db[collection].index_information().items():
+            # key is [(field, direction), ...], the leading field decides usability
+            if info["key"][0][0] in fields:
+                needed.setdefault(collection, set()).add(name)
+    return needed
+
+
+# Scan a whole index; count needs no document fields, so it reads only the index
+def touch_index(database, collection, name):
+    return database[collection].count_documents({}, hint=name, comment="warmup")
+
+
+def run_pipeline(database, collection, pipeline, comment):
+    start = time.perf_counter()
+    for _ in database[collection].aggregate(pipeline, comment=comment):
+        pass
+    return time.perf_counter() - start
+
+
+def parameter_sets(query, all_locations):
+    for name in ("location", "locations"):
+        if all_locations and name in query.parameters:
+            return [{name: value} for value in sweep_values(query, name)]
+    return [{}]
+
+
+def secondaries():
+    hosts = []
+    for shard, members in shard_members().items():
+        for host in members:
+            client = member_client(host)
+            if client.admin.command("hello").get("secondary"):
+                hosts.append((shard, host, client))
+            else:
+                client.close()
+    return hosts
+
+
+def warm_query(query, all_locations, members):
+    start = time.perf_counter()
+    indexes = {}
+    for values in parameter_sets(query, all_locations):
+        pipeline = read_only(query.pipeline(**values))
+        for _ in range(WARM_RUNS):
+            run_pipeline(db, query.collection, pipeline, f"warmup q{query.id}")
+        for shard, host, client in members:
+            try:
+                for _ in range(WARM_RUNS):
+                    run_pipeline(client[db.name], query.collection, pipeline, f"warmup q{query.id}")
+            except PyMongoError as e:
+                print(f"q{query.id}: not warmed on {shard} secondary {host}: {e}")
+        for collection, names in needed_indexes(query, pipeline).items():
+            indexes.setdefault(collection, set()).update(names)
+    return time.perf_counter() - start, indexes
+
+
+def warm(queries, parallel, all_locations, members):
+    indexes = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        for query, (seconds, needed) in zip(queries, pool.map(
+                lambda query: warm_query(query, all_locations, members), queries)):
+            print(f"q{query.id}: warmed in {seconds * 1000:.0f} ms", flush=True)
+            for collection, names in needed.items():
+                indexes.setdefault(collection, set()).update(names)
+
+    targets = [(db, "routers")] + [(client[db.name], f"{shard} secondary {host}") for shard, host, client in members]
+    jobs = [(database, where, collection, name)
+            for database, where in targets for collection, names in indexes.items() for name in sorted(names)]
+
+    def touch(job):
+        database, where, collection, name = job
+        began = time.perf_counter()
+        try:
+            entries = touch_index(database, collection, name)
+        except PyMongoError as e:
+            return f"{collection}.{name} via {where}: not touched: {e}"
+        return f"{collection}.{name} via {where}: {entries} entries in {(time.perf_counter() - began) * 1000:.0f} ms"
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        for line in pool.map(touch, jobs):
+            print(line, flush=True)
+    print(f"Warmed {len(queries)} queries and {len(jobs)} indexes in {time.perf_counter() - start:.1f}s")
+
+
+def clear_plan_caches(query, pipeline, members):
+    collections = {query.collection} | {collection for collection, _ in lookups(pipeline)}
+    for collection in collections:
+        # Through the routers this clears the cache on every shard primary
+        db.command("planCacheClear", collection)
+        for _, _, client in members:
+            client[db.name].command("planCacheClear", collection)
+
+
+def benchmark(queries, repeat, clear, members):
+    print(f"{'query':>6} {'first ms':>10} {'steady ms':>10} {'first/steady':>13}")
+    for query in queries:
+        pipeline = read_only(query.pipeline())
+        if clear:
+            clear_plan_caches(query, pipeline, members)
+        first = run_pipeline(db, query.collection, pipeline, f"q{query.id}")
+        steady = statistics.median(run_pipeline(db, query.collection, pipeline, f"q{query.id}")
+                                   for _ in range(repeat))
+        print(f"{'q' + query.id:>6} {first * 1000:10.1f} {steady * 1000:10.1f} {first / steady:12.1f}x",
+              flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm plan caches and indexes for the Dotazy queries")
+    parser.add_argument("queries", nargs="*", help="query ids (q9 or 9), default all")
+    parser.add_argument("--cost", choices=registry.COST_CLASSES, help="only queries of this cost class")
+    parser.add_argument("--parallel", type=int, default=4, help="queries warmed at the same time")
+    parser.add_argument("--all-locations", action="store_true",
+                        help="warm location parameters with every location in the data")
+    parser.add_argument("--secondaries", action="store_true", default=None,
+                        help="also warm every shard secondary (default: when the runner reads from secondaries)")
+    parser.add_argument("--benchmark", action="store_true", help="report first-run versus steady-state latency")
+    parser.add_argument("--repeat", type=int, default=5, help="steady-state runs per query in the benchmark")
+    parser.add_argument("--no-clear", dest="clear", action="store_false",
+                        help="do not clear the plan caches before the first run")
+    args = parser.parse_args()
+
+    queries = select_queries(args.queries, args.cost)
+    use_secondaries = args.secondaries
+    if use_secondaries is None:
+        use_secondaries = db.client.read_preference != ReadPreference.PRIMARY
+    members = secondaries() if use_secondaries else []
+    if members:
+        print(f"Warming {len(members)} shard secondaries: {', '.join(host for _, host, _ in members)}")
+
+    if args.benchmark:
+        benchmark(queries, args.repeat, args.clear, members)
+    else:
+        warm(queries, args.parallel, args.all_locations, members)
+    for _, _, client in members:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
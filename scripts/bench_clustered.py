@@ -0,0 +1,103 @@
+# bench_clustered.py - ObjectId versus clustered (location|date|station_id|event_type) layout
+#
+# Loads the same documents into two scratch collections of weatherDB, one per
+# layout, and compares insert speed, storage and index size (summed over the
+# shards) and the latency of sorted location/date range reads:
+#   objectid   find({location, date range}).sort(location, date) through the
+#              indexes of the collection in indexes.json
+#   clustered  find(cluster_range(...)).sort(_id), a bounded clustered scan
+#              that needs neither secondary indexes nor a blocking sort
+# --copies repeats the data with renamed stations for a larger data set.
+import argparse
+import os
+import statistics
+import time
+
+from pymongo import MongoClient
+
+from data_loader import (BATCH_SIZE, COLLECTIONS, DATA_DIR, DATABASE, LAYOUTS, MONGO_URI, cluster_range,
+                         create_indexes, load_documents, load_schema, read_documents, setup_collection)
+
+SCRATCH_COLLECTIONS = {"objectid": "benchObjectId", "clustered": "benchClustered"}
+RANGE_DAYS = ("01-01", "07-01")
+
+
+def copies(documents, count):
+    if count <= 1:
+        return documents
+    return [dict(document, station_id=f"{document['station_id']}-{copy}")
+            for copy in range(count) for document in documents]
+
+
+# Storage and index bytes of a sharded collection, summed over the shards
+def storage_sizes(collection):
+    totals = {"storageSize": 0, "totalIndexSize": 0}
+    for stats in collection.aggregate([{"$collStats": {"storageStats": {}}}]):
+        for key in totals:
+            totals[key] += stats["storageStats"][key]
+    return totals
+
+
+def range_filter(layout, location, year):
+    start, end = (f"{year}-{day}" for day in RANGE_DAYS)
+    if layout == "clustered":
+        return cluster_range(location, start, end), [("_id", 1)]
+    return {"location": location, "date": {"$gte": start, "$lt": end}}, [("location", 1), ("date", 1)]
+
+
+# Median latency in ms of reading every location's first half of `year`
+def range_scan_ms(collection, layout, locations, year, repeat):
+    times = []
+    for _ in range(repeat):
+        for location in locations:
+            query, sort = range_filter(layout, location, year)
+            start = time.perf_counter()
+            list(collection.find(query, sort=sort, comment="bench_clustered"))
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ObjectId and clustered collection layouts")
+    parser.add_argument("--collection", choices=list(COLLECTIONS), default="weatherHistory",
+                        help="data file to load")
+    parser.add_argument("--copies", type=int, default=1, help="load the data this many times")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--year", default="2021", help="year of the range reads")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args()
+
+    schema = load_schema()
+    documents = copies(read_documents(os.path.join(args.data_dir, COLLECTIONS[args.collection])), args.copies)
+    locations = sorted({document["location"] for document in documents})
+    print(f"{len(documents)} documents, {len(locations)} locations, batch size {args.batch_size}")
+
+    results = {layout: {"rates": [], "scans": []} for layout in LAYOUTS}
+    with MongoClient(MONGO_URI) as client:
+        for run in range(args.repeat):
+            # Interleave the layouts so drift in the cluster hits both alike
+            for layout in LAYOUTS:
+                name = SCRATCH_COLLECTIONS[layout]
+                client[DATABASE].drop_collection(name)
+                collection = setup_collection(client, name, schema, layout)
+                stats = load_documents(collection, documents, "client", schema, args.batch_size, layout)
+                if layout == "objectid":
+                    create_indexes(collection, args.collection)
+                rate = stats["inserted"] / stats["seconds"]
+                scan = range_scan_ms(collection, layout, locations, args.year, args.repeat)
+                results[layout]["rates"].append(rate)
+                results[layout]["scans"].append(scan)
+                results[layout].update(storage_sizes(collection))
+                print(f"run {run + 1} {layout:>9}: {rate:8.0f} docs/s, range read {scan:6.1f} ms")
+        for name in SCRATCH_COLLECTIONS.values():
+            client[DATABASE].drop_collection(name)
+
+    print(f"{'layout':>9} {'docs/s':>9} {'range ms':>9} {'storage KB':>11} {'indexes KB':>11}")
+    for layout, result in results.items():
+        print(f"{layout:>9} {statistics.median(result['rates']):9.0f} {statistics.median(result['scans']):9.1f} "
+              f"{result['storageSize'] / 1024:11.0f} {result['totalIndexSize'] / 1024:11.0f}")
+
+
+if __name__ == "__main__":
+    main()
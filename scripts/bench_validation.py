@@ -0,0 +1,54 @@
+# bench_validation.py - Ingest throughput with server, client and both validation modes
+#
+# Loads the same documents into a scratch collection of weatherDB (sharded by
+# hashed station_id, with the strict $jsonSchema validator) once per mode and
+# repetition, and reports docs/s plus the share of time spent validating
+# client-side. The scratch collection is dropped before every run.
+import argparse
+import os
+import statistics
+
+from pymongo import MongoClient
+
+from data_loader import (BATCH_SIZE, COLLECTIONS, DATA_DIR, DATABASE, MONGO_URI, VALIDATION_MODES,
+                         load_documents, load_schema, read_documents, setup_collection)
+
+SCRATCH_COLLECTION = "benchValidation"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest throughput per validation mode")
+    parser.add_argument("--collection", choices=list(COLLECTIONS), default="globalClimate",
+                        help="data file to load")
+    parser.add_argument("--modes", nargs="*", choices=VALIDATION_MODES, default=list(VALIDATION_MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args()
+
+    schema = load_schema()
+    documents = read_documents(os.path.join(args.data_dir, COLLECTIONS[args.collection]))
+    print(f"{len(documents)} documents from {COLLECTIONS[args.collection]}, batch size {args.batch_size}")
+
+    results = {mode: [] for mode in args.modes}
+    with MongoClient(MONGO_URI) as client:
+        for run in range(args.repeat):
+            # Interleave the modes so drift in the cluster hits all of them alike
+            for mode in args.modes:
+                client[DATABASE].drop_collection(SCRATCH_COLLECTION)
+                collection = setup_collection(client, SCRATCH_COLLECTION, schema)
+                stats = load_documents(collection, documents, mode, schema, args.batch_size)
+                results[mode].append(stats)
+                print(f"run {run + 1} {mode:>6}: {stats['inserted'] / stats['seconds']:8.0f} docs/s")
+        client[DATABASE].drop_collection(SCRATCH_COLLECTION)
+
+    print(f"{'mode':>6} {'docs/s':>10} {'best':>10} {'validate %':>11} {'rejected':>9}")
+    for mode, runs in results.items():
+        rates = [stats["inserted"] / stats["seconds"] for stats in runs]
+        validate = statistics.median(stats["validate_seconds"] / stats["seconds"] for stats in runs)
+        print(f"{mode:>6} {statistics.median(rates):10.0f} {max(rates):10.0f} "
+              f"{validate * 100:10.1f}% {runs[-1]['rejected']:9d}")
+
+
+if __name__ == "__main__":
+    main()
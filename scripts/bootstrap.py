@@ -0,0 +1,207 @@
+# bootstrap.py - Initialize the sharded cluster and hand off to the data loader
+#
+# Replaces the fixed "sleep 60" of the data-loader container and the manual
+# init-configserver.js / init-shard0X.js / init-router.js steps:
+#   1. initiate the config server and the three shard replica sets in parallel
+#   2. poll hello/replSetGetStatus until each set has elected a primary
+#   3. create a shard-local admin user on every shard replica set
+#   4. add every shard once by replica set name through router01
+#   5. create the admin user and enable sharding for weatherDB
+#   6. exec the loader command given after "--"
+# Before any user exists the script authenticates with the internal __system
+# user and the cluster keyfile, which works on every member. That session
+# stands in for the localhost exception, which only accepts clients inside the
+# member's own container. Users created through mongos live on the config
+# servers only, so the tools that talk to shard members directly
+# (runner.member_client) log in as the shard-local user instead.
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure, OperationFailure
+
+KEYFILE = "/data/mongodb-keyfile"
+ROUTER = "router01:27017"
+DATABASE = "weatherDB"
+ADMIN_USER = "admin"
+ADMIN_PASSWORD = "admin"
+SHARD_USER = os.environ.get("MONGO_SHARD_USER", "shardAdmin")
+SHARD_PASSWORD = os.environ.get("MONGO_SHARD_PASSWORD", "shardAdmin")
+# Enough to profile, warm up and step down members, not to write data
+SHARD_ROLES = ["clusterManager", "clusterMonitor", "readAnyDatabase", "dbAdminAnyDatabase"]
+
+# Same members and priorities as init-configserver.js and init-shard0X.js
+REPLICA_SETS = {
+    "rs-config-server": {"configsvr": True, "members": ["configsvr01:27017", "configsvr02:27017", "configsvr03:27017"]},
+    "rs-shard-01": {"configsvr": False, "members": ["shard01-a:27017", "shard01-b:27017", "shard01-c:27017"]},
+    "rs-shard-02": {"configsvr": False, "members": ["shard02-a:27017", "shard02-b:27017", "shard02-c:27017"]},
+    "rs-shard-03": {"configsvr": False, "members": ["shard03-a:27017", "shard03-b:27017", "shard03-c:27017"]},
+}
+
+# Server error codes
+ALREADY_INITIALIZED = 23
+NOT_WRITABLE_PRIMARY = 10107
+NOT_YET_INITIALIZED = 94
+NODE_NOT_FOUND = 74
+INVALID_REPLICA_SET_CONFIG = 93
+# depends_on only orders the container starts, so replSetInitiate fails its
+# quorum check while a member is not listening yet
+MEMBER_NOT_UP = (NODE_NOT_FOUND, INVALID_REPLICA_SET_CONFIG)
+
+
+# Credentials of the internal __system user, mongod ignores whitespace in the keyfile
+def keyfile_credentials(path=KEYFILE):
+    with open(path) as f:
+        key = re.sub(r"\s", "", f.read())
+    return {"username": "__system", "password": key, "authSource": "local"}
+
+
+def connect(host, credentials, direct=True, **options):
+    return MongoClient(
+        host,
+        directConnection=direct,
+        serverSelectionTimeoutMS=2000,
+        connectTimeoutMS=2000,
+        **credentials,
+        **options,
+    )
+
+
+# Retry `action` until it stops raising connection errors (or server errors
+# with one of `codes`) or the deadline passes
+def retry(action, deadline, interval=0.5, codes=(NOT_YET_INITIALIZED,)):
+    while True:
+        try:
+            return action()
+        except (ConnectionFailure, OperationFailure) as err:
+            if isinstance(err, OperationFailure) and err.code is not None and err.code not in codes:
+                raise
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(interval)
+
+
+# The shard-local user is created on the primary and replicates to the members
+def create_shard_user(name, spec, credentials, deadline):
+    with connect(",".join(spec["members"]), credentials, direct=False, replicaSet=name) as client:
+        if retry(lambda: client.admin.command("usersInfo", SHARD_USER), deadline)["users"]:
+            print(f"{name}: shard user {SHARD_USER} already exists", flush=True)
+            return
+        roles = [{"role": role, "db": "admin"} for role in SHARD_ROLES]
+        retry(lambda: client.admin.command("createUser", SHARD_USER, pwd=SHARD_PASSWORD, roles=roles),
+              deadline, codes=(NOT_YET_INITIALIZED, NOT_WRITABLE_PRIMARY))
+        print(f"{name}: shard user {SHARD_USER} created", flush=True)
+
+
+def initiate_replica_set(name, spec, credentials, deadline):
+    start = time.monotonic()
+    seed = spec["members"][0]
+    config = {
+        "_id": name,
+        "version": 1,
+        "members": [
+            {"_id": i, "host": host, "priority": 1 if i == 0 else 0.5}
+            for i, host in enumerate(spec["members"])
+        ],
+    }
+    if spec["configsvr"]:
+        config["configsvr"] = True
+
+    with connect(seed, credentials) as client:
+        def initiate():
+            try:
+                client.admin.command("replSetInitiate", config)
+                return "initiated"
+            except OperationFailure as err:
+                if err.code == ALREADY_INITIALIZED:
+                    return "already initialized"
+                raise
+
+        state = retry(initiate, deadline, codes=(NOT_YET_INITIALIZED, *MEMBER_NOT_UP))
+
+        # Wait for the election instead of sleeping a fixed time
+        def primary():
+            hello = client.admin.command("hello")
+            if not hello.get("primary"):
+                raise ConnectionFailure("no primary yet")
+            return hello["primary"]
+
+        elected = retry(primary, deadline)
+        status = client.admin.command("replSetGetStatus")
+        members = ", ".join(f"{m['name']}={m['stateStr']}" for m in status["members"])
+
+    elapsed = time.monotonic() - start
+    print(f"{name}: {state}, primary {elected} after {elapsed:.1f}s ({members})", flush=True)
+    if not spec["configsvr"]:
+        create_shard_user(name, spec, credentials, deadline)
+    return elapsed
+
+
+def wait_for_router(credentials, deadline):
+    client = connect(ROUTER, credentials, direct=False)
+    retry(lambda: client.admin.command("hello"), deadline)
+    return client
+
+
+def add_shards(router, deadline):
+    existing = {shard["_id"] for shard in router.admin.command("listShards")["shards"]}
+    for name, spec in REPLICA_SETS.items():
+        if spec["configsvr"] or name in existing:
+            continue
+        # One addShard per replica set, mongos discovers the other members itself
+        seed_list = f"{name}/{','.join(spec['members'])}"
+        retry(lambda: router.admin.command("addShard", seed_list, name=name), deadline)
+        print(f"Added shard {seed_list}", flush=True)
+
+
+def create_admin_user(router):
+    if router.admin.command("usersInfo", ADMIN_USER)["users"]:
+        print("Admin user already exists", flush=True)
+        return
+    router.admin.command("createUser", ADMIN_USER, pwd=ADMIN_PASSWORD, roles=[{"role": "root", "db": "admin"}])
+    print("Admin user created", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Initialize the sharded cluster, then run the loader")
+    parser.add_argument("--keyfile", default=KEYFILE)
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the cluster")
+    parser.add_argument("loader", nargs=argparse.REMAINDER, help="command to exec once ready (after --)")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    deadline = start + args.timeout
+    credentials = keyfile_credentials(args.keyfile)
+
+    with ThreadPoolExecutor(max_workers=len(REPLICA_SETS)) as pool:
+        futures = {
+            name: pool.submit(initiate_replica_set, name, spec, credentials, deadline)
+            for name, spec in REPLICA_SETS.items()
+        }
+        for future in futures.values():
+            future.result()
+    replica_sets_ready = time.monotonic() - start
+
+    router = wait_for_router(credentials, deadline)
+    with router:
+        add_shards(router, deadline)
+        create_admin_user(router)
+        router.admin.command("enableSharding", DATABASE)
+        print(f"Sharding enabled for {DATABASE}", flush=True)
+
+    total = time.monotonic() - start
+    print(f"Replica sets ready after {replica_sets_ready:.1f}s, cluster ready after {total:.1f}s", flush=True)
+
+    command = args.loader[1:] if args.loader[:1] == ["--"] else args.loader
+    if command:
+        print(f"Handing off to: {' '.join(command)}", flush=True)
+        sys.stdout.flush()
+        os.execvp(command[0], command)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+// command-metrics.js - Command latency and reply size metrics exported as OpenMetrics text
+// Mirrors Dotazy/command_metrics.py so loader and query metrics share metric names
+
+const fs = require('fs');
+const { BSON } = require('mongodb');
+
+// Upper bounds (in seconds) of the command duration histogram buckets
+const DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0];
+
+// Commands that only keep connections and sessions alive, not worth a series
+const IGNORED_COMMANDS = new Set(["hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions"]);
+
+function escapeLabel(value) {
+  return String(value).replace(/\\/g, "\\\\").replace(/\n/g, "\\n").replace(/"/g, '\\"');
+}
+
+function formatLabels(labels) {
+  return "{" + Object.entries(labels).map(([name, value]) => `${name}="${escapeLabel(value)}"`).join(",") + "}";
+}
+
+// Attach command listeners to a MongoClient created with monitorCommands: true
+function attachCommandMetrics(client, queryId) {
+  const pending = new Map();
+  const series = new Map();
+  const errors = new Map();
+
+  function seriesFor(labels) {
+    const key = JSON.stringify(labels);
+    if (!series.has(key)) {
+      series.set(key, { labels, buckets: DURATION_BUCKETS.map(() => 0), count: 0, sum: 0, replyBytes: 0, getMores: 0 });
+    }
+    return series.get(key);
+  }
+
+  function observe(entry, seconds) {
+    DURATION_BUCKETS.forEach((bound, i) => {
+      if (seconds <= bound) entry.buckets[i] += 1;
+    });
+    entry.count += 1;
+    entry.sum += seconds;
+  }
+
+  client.on('commandStarted', event => {
+    if (IGNORED_COMMANDS.has(event.commandName)) return;
+    const collection = event.commandName === "getMore"
+      ? event.command.collection
+      : event.command[event.commandName];
+    pending.set(event.requestId, {
+      query: queryId,
+      collection: typeof collection === "string" ? collection : "",
+      command: event.commandName
+    });
+  });
+
+  client.on('commandSucceeded', event => {
+    const labels = pending.get(event.requestId);
+    if (!labels) return;
+    pending.delete(event.requestId);
+    const entry = seriesFor(labels);
+    observe(entry, event.duration / 1000);
+    entry.replyBytes += BSON.calculateObjectSize(event.reply || {});
+    if (event.commandName === "getMore") entry.getMores += 1;
+  });
+
+  client.on('commandFailed', event => {
+    const labels = pending.get(event.requestId);
+    if (!labels) return;
+    pending.delete(event.requestId);
+    observe(seriesFor(labels), event.duration / 1000);
+    const code = (event.failure && event.failure.codeName) || "Unknown";
+    const key = JSON.stringify({ ...labels, code });
+    errors.set(key, (errors.get(key) || 0) + 1);
+  });
+
+  // Render all series in the OpenMetrics text exposition format
+  function render() {
+    const lines = [
+      "# TYPE dotazy_command_duration_seconds histogram",
+      "# HELP dotazy_command_duration_seconds Round-trip time of commands sent to mongos.",
+      "# UNIT dotazy_command_duration_seconds seconds"
+    ];
+    for (const entry of series.values()) {
+      DURATION_BUCKETS.forEach((bound, i) => {
+        lines.push(`dotazy_command_duration_seconds_bucket${formatLabels({ ...entry.labels, le: bound })} ${entry.buckets[i]}`);
+      });
+      lines.push(`dotazy_command_duration_seconds_bucket${formatLabels({ ...entry.labels, le: "+Inf" })} ${entry.count}`);
+      lines.push(`dotazy_command_duration_seconds_count${formatLabels(entry.labels)} ${entry.count}`);
+      lines.push(`dotazy_command_duration_seconds_sum${formatLabels(entry.labels)} ${entry.sum.toFixed(6)}`);
+    }
+    lines.push(
+      "# TYPE dotazy_command_reply_bytes counter",
+      "# HELP dotazy_command_reply_bytes BSON size of command replies.",
+      "# UNIT dotazy_command_reply_bytes bytes"
+    );
+    for (const entry of series.values()) {
+      lines.push(`dotazy_command_reply_bytes_total${formatLabels(entry.labels)} ${entry.replyBytes}`);
+    }
+    lines.push(
+      "# TYPE dotazy_command_getmore counter",
+      "# HELP dotazy_command_getmore getMore round-trips needed to drain query cursors."
+    );
+    for (const entry of series.values()) {
+      if (entry.labels.command !== "getMore") continue;
+      const { query, collection } = entry.labels;
+      lines.push(`dotazy_command_getmore_total${formatLabels({ query, collection })} ${entry.getMores}`);
+    }
+    lines.push(
+      "# TYPE dotazy_command_errors counter",
+      "# HELP dotazy_command_errors Failed commands by server error code."
+    );
+    for (const [key, value] of errors) {
+      lines.push(`dotazy_command_errors_total${formatLabels(JSON.parse(key))} ${value}`);
+    }
+    lines.push("# EOF");
+    return lines.join("\n") + "\n";
+  }
+
+  // Write the metrics atomically so a scraper never reads a partial file
+  function write(path) {
+    fs.writeFileSync(`${path}.tmp`, render());
+    fs.renameSync(`${path}.tmp`, path);
+  }
+
+  return { render, write };
+}
+
+module.exports = { attachCommandMetrics };
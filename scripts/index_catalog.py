@@ -0,0 +1,100 @@
+# index_catalog.py - Build the indexes declared in indexes.json
+#
+# indexes.json lists the indexes of every collection in createIndexes form
+# (key, name and options such as partialFilterExpression), shared with
+# data-loader.js. Each collection gets a single createIndexes command, so its
+# indexes are built in one scan per shard, and the collections are built in
+# parallel. commitQuorum decides how many data-bearing members of each shard
+# must finish the build before it commits ("votingMembers", "majority" or a
+# number).
+#
+# Per-shard build times are sampled from $currentOp while the build runs, so
+# builds shorter than POLL_INTERVAL show up as "<" the interval. Index sizes
+# per shard come from $collStats.
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes.json")
+COMMIT_QUORUM = os.environ.get("INDEX_COMMIT_QUORUM", "votingMembers")
+# Build the indexes before or after the bulk load
+INDEX_TIMINGS = ("before", "after")
+POLL_INTERVAL = 0.1
+
+
+def load_catalog(path=INDEX_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def commit_quorum(value):
+    return int(value) if str(value).isdigit() else value
+
+
+# {shard: longest running time in seconds seen} of the index builds on a collection
+def _sample_builds(client, namespace, seen, done):
+    pipeline = [
+        {"$currentOp": {"allUsers": True, "idleConnections": False}},
+        {"$match": {"ns": namespace, "command.createIndexes": {"$exists": True}}},
+    ]
+    while not done.is_set():
+        for op in client.admin.aggregate(pipeline):
+            shard = op.get("shard", "mongod")
+            seen[shard] = max(seen.get(shard, 0), op.get("microsecs_running", 0) / 1e6)
+        done.wait(POLL_INTERVAL)
+
+
+# {shard: {index name: bytes}} of a sharded collection
+def index_sizes(collection):
+    sizes = {}
+    for stats in collection.aggregate([{"$collStats": {"storageStats": {}}}]):
+        sizes[stats.get("shard", "mongod")] = stats["storageStats"]["indexSizes"]
+    return sizes
+
+
+# One createIndexes for every index of a collection, returns its build report
+def build_indexes(collection, specs, quorum=COMMIT_QUORUM):
+    seen = {}
+    done = threading.Event()
+    sampler = threading.Thread(target=_sample_builds,
+                               args=(collection.database.client, collection.full_name, seen, done), daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = collection.database.command("createIndexes", collection.name, indexes=specs,
+                                             commitQuorum=commit_quorum(quorum))
+    finally:
+        done.set()
+        sampler.join()
+    seconds = time.perf_counter() - start
+    shards = result.get("raw", {"mongod": result})
+    return {
+        "collection": collection.name,
+        "seconds": seconds,
+        "created": {shard.split("/")[0]: reply.get("numIndexesAfter", 0) - reply.get("numIndexesBefore", 0)
+                    for shard, reply in shards.items()},
+        "build_seconds": seen,
+        "sizes": index_sizes(collection),
+    }
+
+
+def print_report(report, names):
+    print(f"Built {len(names)} indexes of {report['collection']} in {report['seconds']:.2f}s")
+    for shard, sizes in sorted(report["sizes"].items()):
+        build = report["build_seconds"].get(shard)
+        build = f"{build:.2f}s" if build else f"<{POLL_INTERVAL}s"
+        created = report["created"].get(shard, 0)
+        listed = ", ".join(f"{name} {sizes[name] / 1024:.0f} KB" for name in names if name in sizes)
+        print(f"  {shard}: {created} new, build {build}, {listed}")
+
+
+# Build the catalog's indexes of `collections` in parallel, one command each
+def apply_catalog(db, collections, catalog=None, quorum=COMMIT_QUORUM):
+    catalog = catalog or load_catalog()
+    collections = [name for name in collections if name in catalog]
+    with ThreadPoolExecutor(max_workers=max(len(collections), 1)) as pool:
+        reports = pool.map(lambda name: build_indexes(db[name], catalog[name], quorum), collections)
+        for name, report in zip(collections, reports):
+            print_report(report, [spec["name"] for spec in catalog[name]])
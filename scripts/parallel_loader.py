@@ -0,0 +1,189 @@
+# parallel_loader.py - Multi-process bulk loader fanning out across both mongos routers
+#
+# The data files hold one record per line, so every file is cut into byte
+# ranges that are parsed and loaded independently by a process pool. A range
+# owns every line that starts inside it. Ranges are assigned to the routers
+# round-robin, so router01 and router02 share the load. Within a worker up to
+# --in-flight insert batches are outstanding at once while the next batch is
+# parsed and validated (same coercion and client-side validation as
+# data_loader.py). Full reload: the collections are emptied first.
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from data_loader import (BATCH_SIZE, COLLECTIONS, DATA_DIR, DATABASE, LAYOUTS, VALIDATION_MODES, is_clustered,
+                         load_schema, new_stats, prepare_batch, setup_collection)
+from index_catalog import COMMIT_QUORUM, INDEX_TIMINGS, apply_catalog
+
+ROUTERS = os.environ.get("MONGO_ROUTERS", "router01:27017,router02:27017").split(",")
+CREDENTIALS = os.environ.get("MONGO_CREDENTIALS", "admin:admin")
+
+# Per-process state, set up by _init_worker
+_clients = {}
+_schema = None
+
+
+def router_uri(router):
+    return f"mongodb://{CREDENTIALS}@{router}/?authSource=admin"
+
+
+# Split a file into `count` byte ranges of about the same size
+def byte_ranges(path, count):
+    size = os.path.getsize(path)
+    bounds = [size * i // count for i in range(count + 1)]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+# Records of the lines starting in [start, end) of a one-record-per-line JSON array
+def read_range(path, start, end):
+    with open(path, "rb") as f:
+        if start > 0:
+            # Finish the line that crosses `start`, it belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip().rstrip(b",")
+            if line.startswith(b"{"):
+                yield json.loads(line)
+
+
+def _init_worker(routers, max_pool_size):
+    global _schema
+    _schema = load_schema()
+    for router in routers:
+        _clients[router] = MongoClient(router_uri(router), maxPoolSize=max_pool_size)
+
+
+# Load one byte range through one router, returns its statistics
+def load_range(task):
+    name, path, start, end, router, mode, layout, batch_size, in_flight = task
+    collection = _clients[router][DATABASE][name]
+    # prepare_batch updates `stats` from this thread only, the insert threads
+    # count into `written` under the lock
+    stats = new_stats()
+    written = {"inserted": 0, "rejected": 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(in_flight)
+
+    def insert(batch):
+        try:
+            result = collection.insert_many(batch, ordered=False, bypass_document_validation=(mode == "client"))
+            inserted, rejected = len(result.inserted_ids), 0
+        except BulkWriteError as err:
+            inserted, rejected = err.details["nInserted"], len(err.details["writeErrors"])
+        finally:
+            slots.release()
+        with lock:
+            written["inserted"] += inserted
+            written["rejected"] += rejected
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=in_flight) as pool:
+        futures = []
+
+        def submit(batch):
+            batch = prepare_batch(batch, mode, _schema, stats, layout)
+            if batch:
+                # Blocks while `in_flight` batches are outstanding
+                slots.acquire()
+                futures.append(pool.submit(insert, batch))
+
+        batch = []
+        for document in read_range(path, start, end):
+            batch.append(document)
+            if len(batch) == batch_size:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        for future in futures:
+            future.result()
+    stats["inserted"] += written["inserted"]
+    stats["rejected"] += written["rejected"]
+    stats["seconds"] = time.perf_counter() - began
+    stats["router"] = router
+    stats["collection"] = name
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the weather data with a process pool across both routers")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="byte ranges per file (default: 4 per worker)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="documents per insert, per worker")
+    parser.add_argument("--in-flight", type=int, default=2, help="outstanding insert batches per worker")
+    parser.add_argument("--routers", nargs="*", default=ROUTERS)
+    parser.add_argument("--validation", choices=VALIDATION_MODES, default="client")
+    parser.add_argument("--layout", choices=LAYOUTS, default="objectid")
+    parser.add_argument("--indexes", choices=INDEX_TIMINGS, default="after",
+                        help="build the indexes.json indexes before or after loading")
+    parser.add_argument("--commit-quorum", default=COMMIT_QUORUM)
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--collections", nargs="*", default=list(COLLECTIONS))
+    args = parser.parse_args()
+    partitions = args.partitions or args.workers * 4
+
+    schema = load_schema()
+    with MongoClient(router_uri(args.routers[0])) as client:
+        try:
+            client.admin.command("enableSharding", DATABASE)
+        except OperationFailure as err:
+            print(f"Note: {err}")
+        for name in args.collections:
+            if is_clustered(client[DATABASE], name) == (args.layout != "clustered"):
+                # Full reload, and the layout of an existing collection cannot change
+                client[DATABASE].drop_collection(name)
+            setup_collection(client, name, schema, args.layout).delete_many({})
+        if args.indexes == "before":
+            apply_catalog(client[DATABASE], args.collections, quorum=args.commit_quorum)
+
+    tasks = []
+    for name in args.collections:
+        path = os.path.join(args.data_dir, COLLECTIONS[name])
+        for start, end in byte_ranges(path, partitions):
+            router = args.routers[len(tasks) % len(args.routers)]
+            tasks.append((name, path, start, end, router, args.validation, args.layout, args.batch_size,
+                          args.in_flight))
+    print(f"{len(tasks)} partitions, {args.workers} workers, routers {', '.join(args.routers)}, "
+          f"batch size {args.batch_size}, {args.in_flight} batches in flight per worker")
+
+    totals = {"inserted": 0, "rejected": 0}
+    per_router = {router: 0 for router in args.routers}
+    per_collection = {name: 0 for name in args.collections}
+    began = time.perf_counter()
+    with multiprocessing.Pool(args.workers, _init_worker, (args.routers, args.in_flight + 1)) as pool:
+        for done, stats in enumerate(pool.imap_unordered(load_range, tasks), 1):
+            totals["inserted"] += stats["inserted"]
+            totals["rejected"] += stats["rejected"]
+            per_router[stats["router"]] += stats["inserted"]
+            per_collection[stats["collection"]] += stats["inserted"]
+            elapsed = time.perf_counter() - began
+            print(f"[{done}/{len(tasks)}] {totals['inserted']} documents, "
+                  f"{totals['inserted'] / elapsed:.0f} docs/s", flush=True)
+    elapsed = time.perf_counter() - began
+
+    for name, inserted in per_collection.items():
+        print(f"Inserted {inserted} documents into collection {name}")
+    for router, inserted in per_router.items():
+        print(f"{router}: {inserted} documents")
+    print(f"Loaded {totals['inserted']} documents in {elapsed:.1f}s: {totals['inserted'] / elapsed:.0f} docs/s "
+          f"aggregate, {totals['rejected']} rejected")
+
+    if args.indexes == "after":
+        with MongoClient(router_uri(args.routers[0])) as client:
+            apply_catalog(client[DATABASE], args.collections, quorum=args.commit_quorum)
+
+
+if __name__ == "__main__":
+    main()